@@ -1,17 +1,27 @@
 """
 Custom JSON logger for CloudWatch.
+
+Handlers and formatters are set up on first use rather than on import, to keep the cold start of
+the Lambda functions short. Metrics are written as CloudWatch embedded metric format records.
 """
-import decimal
 import json
 import logging
 import os
-from six import string_types
+import re
+import sys
+import time
+
+
+FIELD = re.compile(r'^%\((\w+)\)s$')
 
 
 def json_formatter(obj):
     """
     Geocoder exceptions get JSON formatted.
     """
+    # only needed for objects json cannot serialize
+    import decimal
+
     if isinstance(obj, decimal.Decimal):
         if abs(obj) % 1 > 0:
             return float(obj)
@@ -49,7 +59,7 @@ class JsonFormatter(logging.Formatter):
         if isinstance(record_dict['msg'], dict):
             log_dict['message'] = record_dict['msg']
         else:
-            if isinstance(record_dict['msg'], string_types):
+            if isinstance(record_dict['msg'], str):
                 # json string
                 log_dict['message'] = record.getMessage()
             else:
@@ -81,22 +91,227 @@ class JsonFormatter(logging.Formatter):
         return json_record
 
 
+class FastJsonFormatter(JsonFormatter):
+    """
+    Faster drop-in for the JsonFormatter. The field template is compiled once, records are read
+    without copying them, messages are only parsed as JSON if they look like JSON and orjson is
+    used for encoding when it is installed.
+    """
+    def __init__(self, **kwargs):
+        json_default = kwargs.pop('json_default', json_formatter)
+        super(FastJsonFormatter, self).__init__(**kwargs)
+        self.default_json_formatter = json_default
+
+        # plain %(attribute)s fields are looked up, anything else is %-formatted
+        self.fields = []
+        self.templates = []
+
+        for k, v in self.format_dict.items():
+            if not v:
+                continue
+
+            field = FIELD.match(v)
+
+            if field:
+                self.fields.append((k, field.group(1)))
+            else:
+                self.templates.append((k, v))
+
+        self.uses_time = any('asctime' in v for v in self.format_dict.values() if v)
+
+    def format(self, record):
+        if self.uses_time:
+            record.asctime = self.formatTime(record)
+
+        attributes = record.__dict__
+        log_dict = {k: str(attributes[name]) for k, name in self.fields}
+
+        for k, v in self.templates:
+            log_dict[k] = v % attributes
+
+        message = record.msg
+
+        if isinstance(message, str):
+            message = record.getMessage()
+
+            # json string
+            if message.lstrip()[:1] in ('{', '['):
+                try:
+                    message = json.loads(message)
+                except ValueError:
+                    pass
+
+        log_dict['message'] = message
+
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+
+        if record.exc_text:
+            log_dict['exception'] = record.exc_text
+
+        return self.dumps(log_dict)
+
+    def dumps(self, log_dict):
+        orjson = _orjson()
+
+        if orjson is not None:
+            try:
+                return orjson.dumps(
+                    log_dict,
+                    default=self.default_json_formatter,
+                    option=orjson.OPT_NON_STR_KEYS
+                ).decode('utf-8')
+            except TypeError:
+                # e.g. integers exceeding 64 bits
+                pass
+
+        return json.dumps(log_dict, default=self.default_json_formatter)
+
+
+_ORJSON = False
+
+
+def _orjson():
+    """
+    The orjson module if it is installed, imported on first use.
+    """
+    global _ORJSON
+
+    if _ORJSON is False:
+        try:
+            import orjson
+        except ImportError:
+            orjson = None
+
+        _ORJSON = orjson
+
+    return _ORJSON
+
+
 # Logging (CloudWatch)
 LOGGER = logging.getLogger()
-LOGGER.setLevel(logging.INFO)
-for handler in logging.root.handlers:
-    handler.setFormatter(JsonFormatter())
+HANDLER = None
+_CONFIGURED = False
+
 
-if not os.getenv('ENVIRONMENT'):
-    # avoid double logging when testing locally
-    HANDLER = logging.StreamHandler()
-    HANDLER.setFormatter(JsonFormatter())
-    LOGGER.addHandler(HANDLER)
-    LOGGER.setLevel(logging.DEBUG)
+def configure():
+    """
+    Install the JSON formatter on the handlers, once.
+    """
+    global HANDLER, _CONFIGURED
+
+    if _CONFIGURED:
+        return
+
+    _CONFIGURED = True
+    LOGGER.setLevel(logging.INFO)
+    for handler in logging.root.handlers:
+        handler.setFormatter(FastJsonFormatter())
+
+    if not os.getenv('ENVIRONMENT'):
+        # avoid double logging when testing locally
+        HANDLER = logging.StreamHandler()
+        HANDLER.setFormatter(FastJsonFormatter())
+        LOGGER.addHandler(HANDLER)
+        LOGGER.setLevel(logging.DEBUG)
 
 
 def log_message(level, message, *args):
+    configure()
     LOGGER.log(level, message, *args)
 
 def log_exception(exception):
+    configure()
     LOGGER.exception(exception)
+
+def log_lazy(level, message_factory, *args):
+    """
+    Log the message returned by message_factory, which is only called if the level is enabled.
+    """
+    configure()
+
+    if LOGGER.isEnabledFor(level):
+        LOGGER.log(level, message_factory(), *args)
+
+
+# Metrics (CloudWatch embedded metric format)
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'CloudFormationMacros')
+
+# limits of a single embedded metric format record
+MAX_METRICS = 100
+MAX_VALUES = 100
+
+
+class Metrics:
+    """
+    Metrics buffered during an invocation and written to standard output as embedded metric
+    format records when flushed, CloudWatch extracts them from the logs of the function. A metric
+    put more than once gets all its values.
+    """
+    def __init__(self, namespace=METRICS_NAMESPACE):
+        self.namespace = namespace
+        self.values = {}
+        self.units = {}
+
+    def put(self, name, value, unit='Count'):
+        self.values.setdefault(name, []).append(value)
+        self.units[name] = unit
+
+    def records(self, dimensions):
+        """
+        Embedded metric format records of the buffered metrics, split to stay within the limits
+        on metrics and values per record.
+        """
+        names = list(self.values)
+        timestamp = int(time.time() * 1000)
+
+        for i in range(0, len(names), MAX_METRICS):
+            group = names[i:i + MAX_METRICS]
+            chunks = max(-(-len(self.values[name]) // MAX_VALUES) for name in group)
+
+            for j in range(0, chunks * MAX_VALUES, MAX_VALUES):
+                values = {
+                    name: self.values[name][j:j + MAX_VALUES]
+                    for name in group
+                    if self.values[name][j:j + MAX_VALUES]
+                }
+                record = {
+                    '_aws': {
+                        'Timestamp': timestamp,
+                        'CloudWatchMetrics': [{
+                            'Namespace': self.namespace,
+                            'Dimensions': [sorted(dimensions)],
+                            'Metrics': [
+                                {'Name': name, 'Unit': self.units[name]} for name in values
+                            ]
+                        }]
+                    }
+                }
+                record.update(dimensions)
+
+                for name, value in values.items():
+                    record[name] = value[0] if len(value) == 1 else value
+
+                yield record
+
+    def flush(self, **dimensions):
+        """
+        Write the buffered metrics with the given dimensions and empty the buffer.
+        """
+        for record in self.records(dimensions):
+            sys.stdout.write(json.dumps(record, default=json_formatter) + '\n')
+
+        sys.stdout.flush()
+        self.values.clear()
+        self.units.clear()
+
+
+METRICS = Metrics()
+
+
+def put_metric(name, value, unit='Count'):
+    METRICS.put(name, value, unit)
+
+def flush_metrics(**dimensions):
+    METRICS.flush(**dimensions)
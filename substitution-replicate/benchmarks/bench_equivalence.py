@@ -0,0 +1,97 @@
+"""
+Differential benchmark of the replication engines against the reference on random resources.
+
+PYTHONPATH=src:.. python benchmarks/bench_equivalence.py --cases 50 --replicates 100
+
+Generates random base resources, defaults and replicates, with Refs to replication variables
+without a value and Fn::Sub functions whose variable maps mention replication variables, and
+replicates them with the recursive Substitutor.traverse without skipping static subtrees, the
+reference, and with the plan and iterative engines without folding. Reports the speedup of each
+engine over the reference per case. Exits with a non-zero status, giving the seed of the case,
+if an engine's output differs from the reference.
+"""
+import argparse
+import collections
+import math
+import statistics
+import sys
+import timeit
+
+import synthetic
+from main import Substitutor
+
+
+ENGINES = ('plan', 'iterative')
+
+
+class Reference(Substitutor):
+    """
+    Substitutor.traverse descending into every subtree. Static subtrees are found by the
+    analysis of the iterative engine, which the reference should not depend on.
+    """
+    def is_static(self, cloudformation):
+        return False
+
+
+def reference(base, defaults, replicates):
+    substitutor = Reference('Base', base, defaults, fold=False)
+    names = substitutor.names(replicates)
+
+    return {
+        names[replication_name]: substitutor.traverse(
+            collections.ChainMap(substitutions, defaults), base
+        )
+        for replication_name, substitutions in replicates.items()
+    }
+
+
+def engine(name):
+    return lambda base, defaults, replicates: Substitutor(
+        'Base', base, defaults, fold=False, engine=name
+    ).process(replicates)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--cases', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first case')
+    parser.add_argument('--variables', type=int, default=4)
+    parser.add_argument('--depth', type=int, default=5)
+    parser.add_argument('--replicates', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    builders = {'reference': reference, **{name: engine(name) for name in ENGINES}}
+    speedups = collections.defaultdict(list)
+
+    print(f'{"seed":>6}{"reference":>15}' + ''.join(f'{name:>12}' for name in ENGINES))
+
+    for seed in range(args.seed, args.seed + args.cases):
+        case = synthetic.random_case(seed, args.variables, args.depth, args.replicates)
+        expected = reference(*case)
+
+        for name in ENGINES:
+            if builders[name](*case) != expected:
+                print(f'{name} differs from the reference for seed {seed}', file=sys.stderr)
+                sys.exit(1)
+
+        times = {
+            name: min(timeit.repeat(lambda: build(*case), number=1, repeat=args.repeat))
+            for name, build in builders.items()
+        }
+
+        for name in ENGINES:
+            speedups[name].append(times['reference'] / times[name])
+
+        print(f'{seed:>6}{times["reference"] * 1000:>12.2f} ms' + ''.join(
+            f'{speedups[name][-1]:>11.2f}x' for name in ENGINES
+        ))
+
+    # geometric mean, statistics.geometric_mean is Python 3.8 and up
+    print(f'{"mean":>21}' + ''.join(
+        f'{math.exp(statistics.mean(map(math.log, speedups[name]))):>11.2f}x' for name in ENGINES
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Micro-benchmark of the JSON log formatters in records per second.
+
+PYTHONPATH=src:.. python benchmarks/bench_logger.py
+"""
+import argparse
+import json
+import logging
+import time
+
+import logger
+
+
+MESSAGES = {
+    'text': 'processed fragment for request %s',
+    'json-text': json.dumps({'requestId': 'one', 'resources': 12}),
+    'summary': {'requestId': 'one', 'stage': 'output', 'resources': 12},
+    'fragment': {
+        'Resources': {
+            f'Role{i}': {
+                'Type': 'AWS::IAM::Role',
+                'Properties': {
+                    'Description': {'Fn::Sub': ['${repl_description}', {'repl_description': i}]}
+                }
+            }
+            for i in range(100)
+        }
+    }
+}
+
+
+def records(message, count):
+    args = ('one',) if isinstance(message, str) and '%s' in message else ()
+
+    return [
+        logging.LogRecord('root', logging.INFO, __file__, 0, message, args, None)
+        for _ in range(count)
+    ]
+
+
+def measure(formatter, batch):
+    start = time.perf_counter()
+
+    for record in batch:
+        formatter.format(record)
+
+    return len(batch) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--records', type=int, default=20000)
+    args = parser.parse_args()
+
+    formatters = [
+        ('JsonFormatter', logger.JsonFormatter()),
+        ('FastJsonFormatter', logger.FastJsonFormatter())
+    ]
+
+    print(f'{"message":<12}' + ''.join(f'{name:>20}' for name, _ in formatters) + f'{"speedup":>10}')
+
+    for kind, message in MESSAGES.items():
+        rates = [
+            measure(formatter, records(message, args.records)) for _, formatter in formatters
+        ]
+
+        print(
+            f'{kind:<12}' + ''.join(f'{rate:>18,.0f}/s' for rate in rates) +
+            f'{rates[-1] / rates[0]:>9.1f}x'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+Benchmark of lambda_handler and Substitutor.process on synthetic templates.
+
+PYTHONPATH=src:.. python benchmarks/bench_macro.py --resources 10 --replicates 100
+
+Reports wall time, peak traced memory and the number of memory blocks held by the result. Exits
+with a non-zero status if the processed template exceeds the size limit or the time limit, so a
+regression can fail a build before deploying.
+"""
+import argparse
+import contextlib
+import copy
+import gc
+import io
+import json
+import logging
+import statistics
+import sys
+import time
+import tracemalloc
+
+import logger
+import main as macro
+import synthetic
+from main import Substitutor, lambda_handler
+
+
+# CloudFormation and MacroFunction limits
+MAX_OUTPUT_BYTES = 6 * 1024 * 1024
+MAX_SECONDS = 60
+
+
+def measure(function, prepare, repeat):
+    """
+    Run function on fresh input from prepare, returns the wall times of the runs and the peak
+    memory and number of blocks allocated by a separate traced run.
+    """
+    times = []
+
+    for _ in range(repeat):
+        argument = prepare()
+        gc.collect()
+        start = time.perf_counter()
+        function(argument)
+        times.append(time.perf_counter() - start)
+
+    argument = prepare()
+    gc.collect()
+    tracemalloc.start()
+
+    try:
+        result = function(argument)
+        _, peak = tracemalloc.get_traced_memory()
+        blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    finally:
+        tracemalloc.stop()
+
+    return times, peak, blocks, result
+
+
+def report(name, times, peak, blocks):
+    print(
+        f'{name:<24}'
+        f'{min(times) * 1000:>12.2f} ms'
+        f'{statistics.mean(times) * 1000:>12.2f} ms'
+        f'{peak / 1024 / 1024:>12.2f} MB'
+        f'{blocks:>12,}'
+    )
+
+
+def process_all(fragment):
+    """
+    Substitutor.process on every replicating resource, without touching the fragment.
+    """
+    processed = []
+
+    for name, resource in fragment['Resources'].items():
+        if 'Replicates' not in resource:
+            continue
+
+        params = resource['Replicates']
+        replicates = params['Elements']
+
+        if isinstance(replicates, str):
+            replicates = fragment['Mappings'][replicates]
+
+        base = {k: v for k, v in resource.items() if k != 'Replicates'}
+        processed.append(
+            Substitutor(name, base, params.get('Defaults', {})).process(replicates)
+        )
+
+    return processed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--resources', type=int, default=10,
+                        help='number of replicating resources')
+    parser.add_argument('--replicates', type=int, default=100,
+                        help='replicates per resource')
+    parser.add_argument('--depth', type=int, default=4, help='depth of the property trees')
+    parser.add_argument('--width', type=int, default=3, help='width of the property trees')
+    parser.add_argument('--sub-density', type=float, default=0.3,
+                        help='fraction of leaves that are Fn::Sub or Ref functions')
+    parser.add_argument('--variables', type=int, default=5, help='replication variables')
+    parser.add_argument('--mappings', action='store_true',
+                        help='declare the replicates in the Mappings section')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-output-bytes', type=int, default=MAX_OUTPUT_BYTES)
+    parser.add_argument('--max-seconds', type=float, default=MAX_SECONDS)
+    args = parser.parse_args()
+
+    # keep the summaries of lambda_handler out of the report
+    logger.configure()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    # synthetic templates go beyond the resource limit of CloudFormation
+    macro.CHECK_LIMITS = False
+
+    fragment = synthetic.template(
+        resources=args.resources,
+        replicates_per_resource=args.replicates,
+        depth=args.depth,
+        width=args.width,
+        sub_density=args.sub_density,
+        variables=args.variables,
+        mappings=args.mappings
+    )
+
+    print(f'{"":<24}{"best":>15}{"mean":>15}{"peak":>15}{"blocks":>12}')
+
+    times, peak, blocks, _ = measure(process_all, lambda: fragment, args.repeat)
+    report('Substitutor.process', times, peak, blocks)
+
+    # keep the metrics of lambda_handler out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        times, peak, blocks, processed = measure(
+            lambda event: lambda_handler(event, None),
+            lambda: {'requestId': 'benchmark', 'fragment': copy.deepcopy(fragment)},
+            args.repeat
+        )
+    report('lambda_handler', times, peak, blocks)
+
+    size = len(json.dumps(processed['fragment']))
+    print(f'input {len(json.dumps(fragment)):,} bytes, output {size:,} bytes, '
+          f'{len(processed["fragment"]["Resources"]):,} resources')
+
+    failures = []
+
+    if size > args.max_output_bytes:
+        failures.append(f'output of {size:,} bytes exceeds {args.max_output_bytes:,} bytes')
+
+    if max(times) > args.max_seconds:
+        failures.append(f'lambda_handler took {max(times):.2f} s, limit {args.max_seconds} s')
+
+    for failure in failures:
+        print(f'FAILED: {failure}', file=sys.stderr)
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""
+Benchmark of sharing identical subtrees between replicates that differ in few variables.
+
+PYTHONPATH=src:.. python benchmarks/bench_sharing.py --replicates 500
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+
+import synthetic
+from main import Substitutor
+
+
+def replicates(count, variables, varying):
+    """
+    Replicates that only differ in the first varying variables.
+    """
+    return {
+        f'replicate_{i}': {
+            variable: f'value-{i}' if j < varying else 'shared'
+            for j, variable in enumerate(variables)
+        }
+        for i in range(count)
+    }
+
+
+def measure(substitutor, elements, shared):
+    gc.collect()
+    start = time.perf_counter()
+    dict(substitutor.iter_process(elements, shared=shared))
+    elapsed = time.perf_counter() - start
+
+    gc.collect()
+    tracemalloc.start()
+
+    try:
+        # keep the result alive while measuring the memory it holds
+        result = dict(substitutor.iter_process(elements, shared=shared))
+        retained, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    del result
+
+    return elapsed, retained
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--replicates', type=int, default=500)
+    parser.add_argument('--variables', type=int, default=8)
+    parser.add_argument('--varying', type=int, default=1,
+                        help='number of variables that differ between replicates')
+    parser.add_argument('--depth', type=int, default=5)
+    parser.add_argument('--width', type=int, default=3)
+    parser.add_argument('--sub-density', type=float, default=0.3)
+    args = parser.parse_args()
+
+    names = synthetic.variable_names(args.variables)
+    fragment = synthetic.template(
+        resources=1,
+        replicates_per_resource=0,
+        depth=args.depth,
+        width=args.width,
+        sub_density=args.sub_density,
+        variables=args.variables,
+        static_resources=0
+    )
+    base = dict(fragment['Resources']['Resource0'])
+    del base['Replicates']
+
+    elements = replicates(args.replicates, names, args.varying)
+    substitutor = Substitutor('Resource', base)
+    substitutor.plan
+
+    print(f'{"":<12}{"time":>15}{"retained":>15}')
+
+    results = {}
+
+    for shared in (False, True):
+        elapsed, retained = results[shared] = measure(substitutor, elements, shared)
+        print(f'{"shared" if shared else "independent":<12}'
+              f'{elapsed * 1000:>12.2f} ms{retained / 1024 / 1024:>12.2f} MB')
+
+    print(f'{"reduction":<12}'
+          f'{1 - results[True][0] / results[False][0]:>15.0%}'
+          f'{1 - results[True][1] / results[False][1]:>15.0%}')
+
+
+if __name__ == '__main__':
+    main()
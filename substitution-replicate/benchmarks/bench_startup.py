@@ -0,0 +1,107 @@
+"""
+Benchmark of the cold start of the macro: import time per module and time to the first response.
+
+PYTHONPATH=src:.. python benchmarks/bench_startup.py
+
+Every run starts a fresh interpreter, as a Lambda cold start does. The import report is the one
+of python -X importtime, restricted to the slowest modules by cumulative time.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+
+FIRST_RESPONSE = '''
+import main
+main.lambda_handler({
+    'requestId': 'startup',
+    'fragment': {
+        'Resources': {
+            'Base': {
+                'Type': 'AWS::SNS::Topic',
+                'Replicates': {'Elements': {'one': {'name': 'one'}}},
+                'Properties': {'TopicName': {'Fn::Sub': '${repl_name}'}}
+            }
+        }
+    }
+}, None)
+'''
+
+
+def run(code, environment, options=()):
+    return subprocess.run(
+        [sys.executable, *options, '-c', code],
+        env=environment,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+
+
+def import_times(environment):
+    """
+    Self and cumulative import time in microseconds per module.
+    """
+    stderr = run('import main', environment, ['-X', 'importtime']).stderr
+    times = []
+
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        times.append((name.rstrip(), int(self_time), int(cumulative)))
+
+    return times
+
+
+def wall_time(code, environment, repeat):
+    """
+    Median wall time in milliseconds of a fresh interpreter running code.
+    """
+    import time
+
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(code, environment)
+        times.append((time.perf_counter() - start) * 1000)
+
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--modules', type=int, default=15, help='number of modules to report')
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    environment = dict(os.environ, ENVIRONMENT='benchmark', LOG_MODE='summary')
+
+    # the deployment package holds precompiled bytecode, warm the bytecode cache
+    environment.pop('PYTHONDONTWRITEBYTECODE', None)
+    run('import main', environment)
+
+    times = import_times(environment)
+    total = next(cumulative for name, _, cumulative in times if name.strip() == 'main')
+
+    print(f'{"module":<40}{"self":>12}{"cumulative":>14}')
+
+    for name, self_time, cumulative in sorted(times, key=lambda t: -t[2])[:args.modules]:
+        print(f'{name:<40}{self_time / 1000:>9.2f} ms{cumulative / 1000:>11.2f} ms')
+
+    baseline = wall_time('pass', environment, args.repeat)
+    first_response = wall_time(FIRST_RESPONSE, environment, args.repeat)
+
+    print()
+    print(f'import main                {total / 1000:>9.2f} ms')
+    print(f'interpreter start          {baseline:>9.2f} ms')
+    print(f'start to first response    {first_response:>9.2f} ms '
+          f'({first_response - baseline:.2f} ms above the interpreter)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Benchmark of the replication engines on deep and wide synthetic resources.
+
+PYTHONPATH=src:.. python benchmarks/bench_traversal.py --depth 100 --width 40
+
+Compares the recursive Substitutor.traverse to the iterative engine, which walks the tree with an
+explicit work stack, and to a compiled plan, all without folding. The deep resource nests a
+policy statement in a chain of dictionaries and lists, the wide resource is a shallow tree with
+many entries per level. Past the recursion limit only the iterative engine replicates the deep
+resource.
+"""
+import argparse
+import random
+import sys
+import timeit
+
+import synthetic
+from main import Substitutor
+from plan import ReplicationPlan
+from traversal import analyse, traverse
+
+
+def deep(rng, variables, depth):
+    """
+    Chain of dictionaries and lists of the given depth, with a leaf and a static entry per level.
+    """
+    root = node = {}
+
+    for _ in range(depth):
+        node['Leaf'] = synthetic.leaf(rng, variables, sub_density=0.5)
+        node['Static'] = ['sts:AssumeRole', 'Allow']
+        node['Nested'] = [{}]
+        node = node['Nested'][0]
+
+    node['Leaf'] = synthetic.leaf(rng, variables, sub_density=1)
+
+    return {'Type': 'AWS::IAM::Policy', 'Properties': {'PolicyDocument': root}}
+
+
+def wide(rng, variables, width):
+    return {
+        'Type': 'AWS::IAM::Policy',
+        'Properties': synthetic.tree(rng, variables, 2, width, sub_density=0.3)
+    }
+
+
+def engines(resource, variables):
+    """
+    Functions building a replicate from its variables, by engine. An engine that runs into the
+    recursion limit on the resource is left out.
+    """
+    substitutor = Substitutor('Base', resource)
+    analysis = analyse(resource)
+    built = {
+        'recursive': lambda variables: substitutor.traverse(variables, resource),
+        'iterative': lambda variables: traverse(variables, resource, analysis)
+    }
+
+    try:
+        plan = ReplicationPlan(resource, fold=False)
+        built['plan'] = lambda variables: plan.build(plan.resolve(variables))
+    except RecursionError:
+        pass
+
+    for engine, build in list(built.items()):
+        try:
+            build(variables)
+        except RecursionError:
+            del built[engine]
+
+    return built
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--depth', type=int, default=100, help='depth of the deep resource')
+    parser.add_argument('--width', type=int, default=40, help='width of the wide resource')
+    parser.add_argument('--variables', type=int, default=5)
+    parser.add_argument('--replicates', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    names = synthetic.variable_names(args.variables)
+    elements = list(synthetic.replicates(args.replicates, names).values())
+    resources = {
+        f'deep ({args.depth})': deep(rng, names, args.depth),
+        f'wide ({args.width})': wide(rng, names, args.width)
+    }
+
+    print(f'recursion limit {sys.getrecursionlimit()}, {args.replicates} replicates')
+    print(f'{"":<16}{"recursive":>15}{"iterative":>15}{"plan":>15}{"speedup":>10}')
+
+    for label, resource in resources.items():
+        times = {}
+
+        for engine, build in engines(resource, elements[0]).items():
+            times[engine] = min(timeit.repeat(
+                lambda: [build(variables) for variables in elements], number=1, repeat=args.repeat
+            ))
+
+        columns = ''.join(
+            f'{times[engine] * 1000:>12.2f} ms' if engine in times else f'{"failed":>15}'
+            for engine in ('recursive', 'iterative', 'plan')
+        )
+        speedup = (
+            f'{times["recursive"] / times["iterative"]:>9.2f}x' if 'recursive' in times else ''
+        )
+
+        print(f'{label:<16}{columns}{speedup}')
+
+
+if __name__ == '__main__':
+    main()
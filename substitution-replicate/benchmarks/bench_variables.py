@@ -0,0 +1,90 @@
+"""
+Micro-benchmark of replication variable lookups on resources with hundreds of Fn::Sub sites.
+
+PYTHONPATH=src:.. python benchmarks/bench_variables.py --sites 500
+
+Compares building replicates with the replication variables in a ChainMap of the replicate entry
+and the defaults, as the macro used to, to building them from a flat table of only the variables
+the resource refers to, resolved once per replicate.
+"""
+import argparse
+import collections
+import random
+import timeit
+
+import synthetic
+from plan import ReplicationPlan
+
+
+def resource(rng, sites, variables):
+    return {
+        'Type': 'AWS::StepFunctions::StateMachine',
+        'Properties': {
+            f'Property{i}': synthetic.leaf(rng, variables, sub_density=1)
+            for i in range(sites)
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sites', type=int, default=500, help='number of Fn::Sub and Ref sites')
+    parser.add_argument('--variables', type=int, default=10,
+                        help='number of variables the resource refers to')
+    parser.add_argument('--unused', type=int, default=40,
+                        help='number of variables per replicate the resource does not refer to')
+    parser.add_argument('--replicates', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    names = synthetic.variable_names(args.variables + args.unused)
+    referenced = names[:args.variables]
+    plan = ReplicationPlan(resource(rng, args.sites, referenced))
+
+    # half of the variables have a default, a replicate sets the others and some defaults
+    defaults = {variable: f'default-{variable}' for variable in names[::2]}
+    elements = [
+        {variable: f'value-{i}-{variable}' for variable in names if rng.random() < 0.6}
+        for i in range(args.replicates)
+    ]
+
+    def chained():
+        for substitutions in elements:
+            variables = collections.ChainMap(substitutions, defaults)
+            plan.root._build(plan.template, variables, None, None)
+
+    def flattened():
+        for substitutions in elements:
+            plan.build(plan.resolve(substitutions, defaults))
+
+    def lookups(variables):
+        for site in plan.sites:
+            for variable in referenced:
+                if variable in variables:
+                    variables[variable]
+
+    def chained_lookups():
+        for substitutions in elements:
+            lookups(collections.ChainMap(substitutions, defaults))
+
+    def flattened_lookups():
+        for substitutions in elements:
+            lookups(plan.resolve(substitutions, defaults))
+
+    print(f'{len(plan.sites)} sites, {args.replicates} replicates')
+    print(f'{"":<20}{"ChainMap":>15}{"flat table":>15}{"speedup":>10}')
+
+    for label, chain, flat in (
+        ('build', chained, flattened),
+        ('lookups', chained_lookups, flattened_lookups)
+    ):
+        chain_time = min(timeit.repeat(chain, number=1, repeat=args.repeat))
+        flat_time = min(timeit.repeat(flat, number=1, repeat=args.repeat))
+
+        print(f'{label:<20}{chain_time * 1000:>12.2f} ms{flat_time * 1000:>12.2f} ms'
+              f'{chain_time / flat_time:>9.2f}x')
+
+
+if __name__ == '__main__':
+    main()
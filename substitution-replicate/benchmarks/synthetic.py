@@ -0,0 +1,176 @@
+"""
+Synthetic SubReplicate templates for benchmarks.
+"""
+import random
+
+
+def variable_names(count):
+    return [f'variable{i}' for i in range(count)]
+
+
+def leaf(rng, variables, sub_density):
+    """
+    Leaf value of a property tree: a Fn::Sub or Ref on replication variables with probability
+    sub_density, a literal otherwise.
+    """
+    if rng.random() >= sub_density:
+        return rng.choice(['sts:AssumeRole', 'Allow', '2012-10-17', 42, True])
+
+    if rng.random() < 0.25:
+        return {'Ref': f'repl_{rng.choice(variables)}'}
+
+    chosen = rng.sample(variables, min(len(variables), rng.randint(1, 3)))
+
+    return {
+        'Fn::Sub': '-'.join(f'${{repl_{variable}}}' for variable in chosen) + '-${AWS::Region}'
+    }
+
+
+def tree(rng, variables, depth, width, sub_density):
+    """
+    Property tree of the given depth, alternating dictionaries and lists of the given width.
+    """
+    if depth == 0:
+        return leaf(rng, variables, sub_density)
+
+    if depth % 2:
+        return [tree(rng, variables, depth - 1, width, sub_density) for _ in range(width)]
+
+    return {
+        f'Property{i}': tree(rng, variables, depth - 1, width, sub_density) for i in range(width)
+    }
+
+
+def replicates(count, variables, missing=0.1, seed=0):
+    rng = random.Random(seed)
+
+    return {
+        f'replicate_{i}': {
+            variable: f'value-{i}-{variable}' for variable in variables if rng.random() >= missing
+        }
+        for i in range(count)
+    }
+
+
+def template(resources=10, replicates_per_resource=100, depth=4, width=3, sub_density=0.3,
+             variables=5, static_resources=10, mappings=False, seed=0):
+    """
+    CloudFormation template with replicating resources and static resources. With mappings the
+    replicates are declared in the Mappings section and referred to by name.
+    """
+    rng = random.Random(seed)
+    names = variable_names(variables)
+    fragment = {
+        'AWSTemplateFormatVersion': '2010-09-09',
+        'Resources': {}
+    }
+
+    if mappings:
+        fragment['Mappings'] = {}
+
+    for i in range(resources):
+        elements = replicates(replicates_per_resource, names, seed=seed + i)
+
+        if mappings:
+            fragment['Mappings'][f'elements{i}'] = elements
+            elements = f'elements{i}'
+
+        fragment['Resources'][f'Resource{i}'] = {
+            'Type': 'AWS::CloudFormation::Stack',
+            'Replicates': {
+                'Elements': elements,
+                'Defaults': {names[0]: 'default'}
+            },
+            'Properties': tree(rng, names, depth, width, sub_density)
+        }
+
+    for i in range(static_resources):
+        fragment['Resources'][f'Static{i}'] = {
+            'Type': 'AWS::SNS::Topic',
+            'Properties': tree(rng, names, depth, width, 0)
+        }
+
+    return fragment
+
+
+def random_leaf(rng, variables):
+    """
+    Random leaf of a resource for the equivalence harness: a literal, a Ref to a replication
+    variable, a parameter or an undeclared variable, or a Fn::Sub function in either form.
+    """
+    variable = rng.choice(variables + ['undeclared'])
+    kind = rng.randrange(7)
+
+    if kind == 0:
+        return rng.choice(['sts:AssumeRole', '${NotSubstituted}', 42, 1.5, True, None, ''])
+    elif kind == 1:
+        return {'Ref': f'repl_{variable}'}
+    elif kind == 2:
+        return {'Ref': rng.choice(['Environment', 'AWS::Region', 'repl_'])}
+    elif kind == 3:
+        # the other entries are kept if the variable has no value
+        return {'Ref': f'repl_{variable}', 'Comment': random_leaf(rng, variables)}
+
+    expression = '-'.join(rng.choice([
+        f'${{repl_{variable}}}', f'${{repl_{rng.choice(variables)}}}', '${AWS::Region}',
+        '${Environment}', '${Queue.Arn}', '${!repl_literal}', 'static'
+    ]) for _ in range(rng.randint(1, 4)))
+
+    if kind == 4:
+        return {'Fn::Sub': expression}
+
+    supplied = {}
+
+    for _ in range(rng.randint(0, 3)):
+        name = rng.choice(['Environment', f'repl_{variable}', 'local'])
+        supplied[name] = random_leaf(rng, variables) if rng.random() < 0.5 else 'supplied'
+
+    if kind == 5:
+        return {'Fn::Sub': [expression, supplied]}
+
+    # a function among other entries
+    return {'Fn::Sub': [expression, supplied], 'Comment': random_leaf(rng, variables)}
+
+
+def random_tree(rng, variables, depth):
+    """
+    Random property tree of dictionaries and lists of at most the given depth.
+    """
+    if depth == 0 or rng.random() < 0.3:
+        return random_leaf(rng, variables)
+
+    width = rng.randint(0, 4)
+
+    if rng.random() < 0.5:
+        return [random_tree(rng, variables, depth - 1) for _ in range(width)]
+
+    return {f'Property{i}': random_tree(rng, variables, depth - 1) for i in range(width)}
+
+
+def random_value(rng):
+    return rng.choice([
+        'value', '', '${Escaped}', 0, 7, 2.5, False, None, {'Ref': 'Environment'},
+        ['a', {'Ref': 'Queue'}]
+    ])
+
+
+def random_case(seed, variables=4, depth=5, replicates=8):
+    """
+    Random base resource, defaults and replicates for the equivalence harness. Replicates lack
+    some variables, some of which have no default either.
+    """
+    rng = random.Random(seed)
+    names = variable_names(variables)
+    base = {
+        'Type': 'AWS::IAM::Policy',
+        'Properties': {f'Property{i}': random_tree(rng, names, depth) for i in range(3)}
+    }
+    defaults = {variable: random_value(rng) for variable in names if rng.random() < 0.3}
+    elements = {
+        f'replicate{i}': {
+            variable: random_value(rng) for variable in names if rng.random() < 0.7
+        }
+        for i in range(replicates)
+    }
+
+    return base, defaults, elements
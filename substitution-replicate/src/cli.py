@@ -0,0 +1,393 @@
+"""
+Command line interface to expand SubReplicate templates locally.
+
+PYTHONPATH=src:.. python -m cli templates --output _build/expanded
+
+Templates are read as YAML (with the CloudFormation short form tags) or JSON, directories are
+searched recursively and their templates expanded in parallel. Each process expands a batch of
+templates, sharing compiled plans between them. With --executor, templates are expanded one at a
+time and their replicating resources in parallel instead. With --incremental, only the resources
+whose inputs changed since the previous expansion into the output are built again. With --shard,
+the replicates of templates that exceed the limits of CloudFormation are moved into nested stacks.
+"""
+import argparse
+import collections
+import concurrent.futures
+import os
+import pathlib
+import sys
+
+import incremental
+import main
+import sharding
+import sources
+import stream
+from plan import PlanCache
+
+
+TEMPLATE_SUFFIXES = ('.json', '.template', '.yaml', '.yml')
+
+# outcome of expanding a template: the replicates per resource, the expanded template if it was
+# not written out, the Diff of an incremental expansion, the number of nested stacks of a sharded
+# one and the error if it failed
+Result = collections.namedtuple(
+    'Result', ['source', 'replicated', 'text', 'diff', 'shards', 'error']
+)
+
+
+def load_template(path, includes=None):
+    """
+    Load a template as the JSON document CloudFormation passes to the macro, with its
+    AWS::Include transforms resolved if an Includes source is given.
+    """
+    template = sources.parse(path.read_text(), path.suffix)
+
+    if includes is None:
+        return template
+
+    return includes.resolve(template)
+
+
+def remove_transform(template, macro_name):
+    """
+    Remove the macro from the Transform section, as CloudFormation does once it has run.
+    """
+    transform = template.get('Transform')
+
+    if transform == macro_name:
+        del template['Transform']
+    elif isinstance(transform, list) and macro_name in transform:
+        transform = [name for name in transform if name != macro_name]
+
+        if transform:
+            template['Transform'] = transform
+        else:
+            del template['Transform']
+
+
+def output_format_of(path, output_format):
+    if output_format:
+        return output_format
+
+    return 'json' if path.suffix == '.json' else 'yaml'
+
+
+def expand_template(source, destination, output_format, macro_name, strict=False, plans=None,
+                    executor=None, includes=None):
+    """
+    Expand a template file. The expanded template is written to destination, or returned if
+    there is none.
+    """
+    template = load_template(source, includes)
+    remove_transform(template, macro_name)
+    replicated = main.expand(template, strict, plans, executor, limit=True)
+
+    if output_format == 'json':
+        text = stream.dump_json(template)
+    else:
+        text = stream.dump_yaml(template)
+
+    if destination is None:
+        return replicated, text
+
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    destination.write_text(text)
+
+    return replicated, None
+
+
+def stream_template(source, destination, output_format, macro_name, strict=False, plans=None,
+                    includes=None):
+    """
+    Expand a template file, writing the replicates to destination as they are built. Peak memory
+    scales with a single replicate instead of with the expanded template.
+    """
+    template = load_template(source, includes)
+    remove_transform(template, macro_name)
+    replicated = {}
+
+    # fail on invalid names and missing variables before writing anything
+    for task in main.replicating_resources(template):
+        replicated[task.name] = len(task.names)
+
+        if strict:
+            replicator = main.Substitutor(task.name, task.base, task.defaults)
+            main.validate(task.name, replicator, task.replicates)
+
+    resources = main.iter_expand(template, plans)
+
+    if destination is None:
+        stream.write(template, resources, sys.stdout, output_format)
+    else:
+        destination.parent.mkdir(parents=True, exist_ok=True)
+
+        with open(destination, 'w') as f:
+            stream.write(template, resources, f, output_format)
+
+    return replicated, None
+
+
+def shard_location(destination, index):
+    return destination.with_name(f'{destination.stem}.shard{index}{destination.suffix}')
+
+
+def shard_template(source, destination, output_format, macro_name, strict=False, plans=None,
+                   executor=None, includes=None):
+    """
+    Expand a template file into destination. If the expanded template exceeds the limits of
+    CloudFormation, its replicates are moved into nested stacks written next to it, which
+    aws cloudformation package uploads. Returns the number of nested stacks as well.
+    """
+    template = load_template(source, includes)
+    remove_transform(template, macro_name)
+    replicate_names = {
+        name for task in main.replicating_resources(template) for name in task.names.values()
+    }
+    replicated = main.expand(template, strict, plans, executor)
+    dump = stream.dump_json if output_format == 'json' else stream.dump_yaml
+    text = dump(template)
+    size = sharding.Estimate(len(template['Resources']), len(text.encode('utf-8')))
+    shards = []
+
+    # the limits apply to the templates as they are written
+    if sharding.exceeds(size):
+        template, shards = sharding.shard(
+            template, replicate_names, lambda index: shard_location(destination, index).name,
+            dump=dump
+        )
+        text = dump(template)
+
+    destination.parent.mkdir(parents=True, exist_ok=True)
+
+    for index, shard in enumerate(shards, 1):
+        shard_location(destination, index).write_text(dump(shard), encoding='utf-8')
+
+    destination.write_text(text, encoding='utf-8')
+
+    return replicated, len(shards)
+
+
+def update_template(source, destination, output_format, macro_name, strict=False, plans=None,
+                    includes=None):
+    """
+    Expand a template file into destination incrementally, see the incremental module. Returns
+    the Diff with the previous expansion.
+    """
+    template = load_template(source, includes)
+    remove_transform(template, macro_name)
+
+    return incremental.expand(template, destination, output_format, strict, plans)
+
+
+def run(job, plans=None, executor=None):
+    """
+    Expand a template and report failures instead of raising, one broken template should not stop
+    the others. Returns a Result.
+    """
+    source, destination, output_format, macro_name, mode, strict, includes = job
+    text = diff = shards = None
+
+    try:
+        if mode == 'incremental':
+            replicated, diff = update_template(
+                source, destination, output_format, macro_name, strict, plans, includes
+            )
+        elif mode == 'shard':
+            replicated, shards = shard_template(
+                source, destination, output_format, macro_name, strict, plans, executor, includes
+            )
+        elif mode == 'stream':
+            replicated, text = stream_template(
+                source, destination, output_format, macro_name, strict, plans, includes
+            )
+        else:
+            replicated, text = expand_template(
+                source, destination, output_format, macro_name, strict, plans, executor, includes
+            )
+
+        return Result(source, replicated, text, diff, shards, None)
+    except Exception as error:
+        return Result(source, None, None, None, None, f'{type(error).__name__}: {error}')
+
+
+def report(source, diff):
+    """
+    Lines reporting the resources an incremental expansion added, changed and removed.
+    """
+    yield (
+        f'{source}: {len(diff.added)} added, {len(diff.changed)} changed, '
+        f'{len(diff.removed)} removed, {len(diff.unchanged)} unchanged'
+    )
+
+    for marker, names in (('+', diff.added), ('~', diff.changed), ('-', diff.removed)):
+        for name in names:
+            yield f'  {marker} {name}'
+
+
+def run_batch(jobs, executor=None):
+    """
+    Expand a batch of templates in one process, sharing compiled plans between them. Given an
+    executor, the replicating resources of each template are expanded in its workers.
+    """
+    plans = PlanCache()
+
+    return [run(job, plans, executor) for job in jobs]
+
+
+def batches(jobs, count):
+    """
+    Split the jobs in count batches of consecutive templates, templates of the same directory
+    tend to share resources.
+    """
+    size = -(-len(jobs) // count)
+
+    return [jobs[i:i + size] for i in range(0, len(jobs), size)]
+
+
+def collect(paths, output, output_format, macro_name, mode='expand', strict=False,
+            includes=None):
+    """
+    List the expansion jobs for the given files and directories. Directories are mirrored in the
+    output directory. The mode is expand, stream, incremental or shard. The jobs of a batch share
+    the includes source, and so its cache.
+    """
+    jobs = []
+
+    for path in map(pathlib.Path, paths):
+        if path.is_dir():
+            sources = [
+                (source, source.relative_to(path))
+                for source in sorted(path.rglob('*'))
+                if source.suffix in TEMPLATE_SUFFIXES and source.is_file()
+            ]
+        else:
+            sources = [(path, pathlib.Path(path.name))]
+
+        for source, relative in sources:
+            source_format = output_format_of(source, output_format)
+
+            if output is None:
+                destination = None
+            elif len(paths) == 1 and not path.is_dir() and output.suffix in TEMPLATE_SUFFIXES:
+                destination = output
+            else:
+                suffix = '.json' if source_format == 'json' else '.yml'
+                destination = output / relative.with_suffix(suffix)
+
+            jobs.append(
+                (source, destination, source_format, macro_name, mode, strict, includes)
+            )
+
+    return jobs
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description='Expand SubReplicate templates locally.')
+    parser.add_argument('paths', nargs='+', help='template files or directories')
+    parser.add_argument('-o', '--output', type=pathlib.Path,
+                        help='output file or directory, standard output if omitted')
+    parser.add_argument('-f', '--format', choices=['json', 'yaml'],
+                        help='output format, defaults to the format of the template')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help='number of processes expanding templates')
+    parser.add_argument('--executor', choices=['process', 'thread'],
+                        help='expand the replicating resources of a template in parallel, '
+                             'with a pool of workers of this kind, instead of the templates')
+    parser.add_argument('--macro-name', default='SubReplicate',
+                        help='name of the macro to remove from the Transform section')
+    parser.add_argument('--stream', action='store_true',
+                        help='write replicates as they are built to bound memory usage')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only rebuild the resources whose inputs changed since the '
+                             'previous expansion into the output')
+    parser.add_argument('--shard', action='store_true',
+                        help='move the replicates of templates exceeding the limits of '
+                             'CloudFormation into nested stacks next to the output')
+    parser.add_argument('--strict', action='store_true',
+                        help='fail on replication variables without a value or default')
+    parser.add_argument('--include-root', type=pathlib.Path, default=pathlib.Path('.'),
+                        help='directory of the relative AWS::Include locations')
+    parser.add_argument('--s3-root', type=pathlib.Path,
+                        help='directory standing in for S3 in AWS::Include locations, with a '
+                             'subdirectory per bucket')
+    parser.add_argument('--include-cache', type=pathlib.Path,
+                        help='directory to cache parsed AWS::Include files in')
+
+    args = parser.parse_args(arguments)
+
+    if args.executor and args.stream:
+        parser.error('--executor cannot be combined with --stream')
+
+    if args.incremental and (args.stream or args.executor):
+        parser.error('--incremental cannot be combined with --stream or --executor')
+
+    if args.incremental and args.output is None:
+        parser.error('--incremental requires --output')
+
+    if args.shard and (args.stream or args.incremental):
+        parser.error('--shard cannot be combined with --stream or --incremental')
+
+    if args.shard and args.output is None:
+        parser.error('--shard requires --output')
+
+    return args
+
+
+def cli(arguments=None):
+    args = parse_arguments(arguments)
+    includes = sources.Includes(args.include_root, args.s3_root, args.include_cache)
+    mode = (
+        'incremental' if args.incremental else 'stream' if args.stream else
+        'shard' if args.shard else 'expand'
+    )
+    jobs = collect(
+        args.paths, args.output, args.format, args.macro_name, mode, args.strict, includes
+    )
+
+    if args.output is None and len(jobs) > 1:
+        print('an output directory is required for more than one template', file=sys.stderr)
+        return 2
+
+    if args.executor:
+        executors = {
+            'process': concurrent.futures.ProcessPoolExecutor,
+            'thread': concurrent.futures.ThreadPoolExecutor
+        }
+
+        with executors[args.executor](max_workers=args.workers) as executor:
+            results = run_batch(jobs, executor)
+    elif args.workers > 1 and len(jobs) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+            results = [
+                result
+                for batch in executor.map(run_batch, batches(jobs, args.workers))
+                for result in batch
+            ]
+    else:
+        results = run_batch(jobs)
+
+    failed = False
+
+    for source, replicated, text, diff, shards, error in results:
+        if error:
+            failed = True
+            print(f'{source}: {error}', file=sys.stderr)
+            continue
+
+        if text is not None:
+            sys.stdout.write(text)
+
+        if shards:
+            print(f'{source}: replicates moved into {shards} nested stacks', file=sys.stderr)
+
+        if diff is not None:
+            print('\n'.join(report(source, diff)), file=sys.stderr)
+
+        print(f'{source}: {sum(replicated.values())} replicates of {len(replicated)} resources',
+              file=sys.stderr)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
@@ -0,0 +1,156 @@
+"""
+Tokenizer for Fn::Sub expressions and replication variable lookups.
+"""
+import collections
+import functools
+import re
+
+
+LITERAL = 'literal'
+VARIABLE = 'variable'
+PSEUDO_PARAMETER = 'pseudo-parameter'
+ATTRIBUTE = 'attribute'
+
+REPLICATION_PREFIX = 'repl_'
+REPLICATION_REFERENCE = re.compile('^repl_(.+)$')
+
+Token = collections.namedtuple('Token', ['kind', 'value'])
+
+
+@functools.lru_cache(maxsize=4096)
+def tokenize(expression):
+    """
+    Split a Fn::Sub expression into literal text and placeholders in a single pass. The result is
+    cached, repeated expressions only cost a lookup.
+
+    "arn:${AWS::Partition}:s3:::${Bucket}/${!Literal}/${Role.Arn}"
+
+    results in the tokens
+
+    [
+        Token(LITERAL, "arn:"),
+        Token(PSEUDO_PARAMETER, "AWS::Partition"),
+        Token(LITERAL, ":s3:::"),
+        Token(VARIABLE, "Bucket"),
+        Token(LITERAL, "/${Literal}/"),
+        Token(ATTRIBUTE, "Role.Arn")
+    ]
+
+    Literal tokens hold the text as CloudFormation renders it, escapes are resolved and adjacent
+    literals merged.
+    """
+    tokens = []
+    literal = []
+    position = 0
+
+    while True:
+        start = expression.find('${', position)
+
+        if start < 0:
+            literal.append(expression[position:])
+            break
+
+        literal.append(expression[position:start])
+
+        if expression.startswith('!', start + 2):
+            # ${!Literal} is rendered as ${Literal}
+            literal.append('${')
+            position = start + 3
+            continue
+
+        end = expression.find('}', start + 2)
+
+        if end < 0 or end == start + 2:
+            # unterminated or empty placeholders are left as text
+            literal.append(expression[start:start + 2])
+            position = start + 2
+            continue
+
+        if any(literal):
+            tokens.append(Token(LITERAL, ''.join(literal)))
+
+        literal = []
+        name = expression[start + 2:end]
+
+        if name.startswith('AWS::'):
+            tokens.append(Token(PSEUDO_PARAMETER, name))
+        elif '.' in name:
+            tokens.append(Token(ATTRIBUTE, name))
+        else:
+            tokens.append(Token(VARIABLE, name))
+
+        position = end + 1
+
+    if any(literal):
+        tokens.append(Token(LITERAL, ''.join(literal)))
+
+    return tuple(tokens)
+
+
+@functools.lru_cache(maxsize=4096)
+def replication_variables(expression):
+    """
+    Names of the replication variables mentioned in a Fn::Sub expression, without their prefix
+    and in order of first appearance.
+    """
+    return tuple(dict.fromkeys(
+        token.value[len(REPLICATION_PREFIX):]
+        for token in tokenize(expression)
+        if token.kind == VARIABLE
+        and token.value.startswith(REPLICATION_PREFIX)
+        and len(token.value) > len(REPLICATION_PREFIX)
+    ))
+
+
+def replication_reference(name):
+    """
+    Name of the replication variable referred to by a Ref, None if it is not one.
+    """
+    search = REPLICATION_REFERENCE.search(name)
+
+    return search.group(1) if search else None
+
+
+def escape(text):
+    """
+    Escape literal text for a Fn::Sub expression.
+    """
+    return text.replace('${', '${!')
+
+
+def is_constant(value):
+    # CloudFormation substitutes strings, booleans are left to it
+    return isinstance(value, str) or (isinstance(value, int) and not isinstance(value, bool))
+
+
+def fold(expression, values):
+    """
+    Substitute the variables of a Fn::Sub expression whose value is a string or an integer.
+    Returns whether no placeholder is left, the string the expression then renders to or else the
+    expression left, and the names of the variables substituted.
+
+    "${AWS::Region}-${repl_name}" with the values {"repl_name": "foo"}
+
+    results in
+
+    (False, "${AWS::Region}-foo", {"repl_name"})
+    """
+    rendered = []
+    escaped = []
+    substituted = set()
+    resolved = True
+
+    for kind, value in tokenize(expression):
+        if kind == LITERAL:
+            rendered.append(value)
+            escaped.append(escape(value))
+        elif kind == VARIABLE and is_constant(values.get(value)):
+            text = str(values[value])
+            rendered.append(text)
+            escaped.append(escape(text))
+            substituted.add(value)
+        else:
+            escaped.append('${' + value + '}')
+            resolved = False
+
+    return resolved, ''.join(rendered if resolved else escaped), substituted
@@ -0,0 +1,123 @@
+"""
+Incremental expansion of templates by the command line interface.
+
+Every resource of the expanded template is fingerprinted by its inputs: a replicate by its base
+resource, defaults, Fold setting and replicate entry, any other resource by itself. The
+fingerprints and the encoded resources are stored next to the output. Expanding the template
+again only builds and encodes the resources whose fingerprint changed, so the work done scales
+with the change rather than with the template.
+"""
+import collections
+import hashlib
+import json
+import os
+
+import main
+import stream
+
+
+# stored state of another version or output format is discarded
+STATE_VERSION = 3
+STATE_SUFFIX = '.fingerprints.json'
+
+Diff = collections.namedtuple('Diff', ['added', 'changed', 'removed', 'unchanged'])
+
+
+def fingerprint(*inputs):
+    # in key order, which the output keeps
+    serialised = json.dumps(inputs, separators=(',', ':'), default=str)
+
+    return hashlib.sha256(serialised.encode('utf-8')).hexdigest()
+
+
+def state_path(destination):
+    return destination.with_name(destination.name + STATE_SUFFIX)
+
+
+def load_state(path, output_format):
+    """
+    Fingerprints and encoded entries by resource name of the previous expansion, empty if there
+    is none to build on.
+    """
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+    if state.get('version') != STATE_VERSION or state.get('format') != output_format:
+        return {}
+
+    return state['resources']
+
+
+def save_state(path, output_format, entries):
+    temporary = path.with_name(path.name + '.tmp')
+    temporary.write_text(json.dumps({
+        'version': STATE_VERSION,
+        'format': output_format,
+        'resources': entries
+    }))
+    os.replace(temporary, path)
+
+
+def iter_inputs(template, tasks, strict=False, plans=None):
+    """
+    Generate the resources of the expanded template as (name, fingerprint, build) tuples, in the
+    order expand leaves them, given its replicating resources. Calling build gives the resource.
+    """
+    for name, resource in template['Resources'].items():
+        if 'Replicates' not in resource:
+            yield name, fingerprint(resource), lambda resource=resource: resource
+
+    for task in tasks:
+        replicator = main.substitutor(
+            task.name, task.base, task.defaults, plans, fold=task.fold, engine=task.engine
+        )
+        base_fingerprint = fingerprint(task.base, task.defaults, task.fold)
+
+        if strict:
+            main.validate(task.name, replicator, task.replicates)
+
+        for replication_name, substitutions in (task.replicates or {}).items():
+            yield (
+                task.names[replication_name],
+                fingerprint(base_fingerprint, substitutions),
+                lambda substitutions=substitutions: replicator.build(substitutions)
+            )
+
+
+def expand(template, destination, output_format, strict=False, plans=None):
+    """
+    Expand a template into destination, building and encoding only the resources whose inputs
+    changed since the previous expansion into destination. Returns the number of replicates per
+    replicating resource and the Diff of the resource names.
+    """
+    path = state_path(destination)
+    previous = load_state(path, output_format)
+    tasks = main.replicating_resources(template)
+    entries = {}
+    diff = Diff([], [], [], [])
+
+    for name, resource_fingerprint, build in iter_inputs(template, tasks, strict, plans):
+        entry = previous.get(name)
+
+        if entry is not None and entry[0] == resource_fingerprint:
+            diff.unchanged.append(name)
+        else:
+            (diff.changed if entry is not None else diff.added).append(name)
+            entry = [resource_fingerprint, stream.entry(name, build(), output_format)]
+
+        entries[name] = entry
+
+    diff.removed.extend(name for name in previous if name not in entries)
+
+    destination.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(destination, 'w') as f:
+        texts = (text for _, text in entries.values())
+        stream.write_entries(template, texts, f, output_format)
+
+    save_state(path, output_format, entries)
+
+    return {task.name: len(task.names) for task in tasks}, diff
@@ -0,0 +1,124 @@
+"""
+Interning of CloudFormation trees.
+
+Equal strings, numbers and subtrees of a fragment are replaced by a single shared object, so the
+keys and literal values repeated across its resources, mappings and replicates are held once.
+Replicates are built from the interned base resources and share their static subtrees, see
+plan.ReplicationPlan, so interning the fragment before expanding it carries over to them.
+
+Trees are expected to be made of plain dictionaries and lists, as CloudFormation passes them.
+Interned trees share structure and should be treated as read only.
+"""
+import sys
+
+
+class Interner:
+    """
+    Table of the strings, numbers and subtrees interned so far, by value. Subtrees are compared by
+    their entries, in order, and the identity of their interned children, so only equal subtrees
+    are shared. Numbers are compared together with their type, 1 and 1.0 are kept apart.
+
+    Dictionaries keep their identity, their keys are interned in place. The objects that
+    interning made redundant are counted, with their size in bytes.
+    """
+    def __init__(self):
+        self.strings = {}
+        self.numbers = {}
+        self.subtrees = {}
+        self.leaves_shared = 0
+        self.subtrees_shared = 0
+        self.bytes_saved = 0
+
+    def intern(self, cloudformation):
+        """
+        Share the equal leaves and subtrees of the tree with each other and with the trees
+        interned before, in place. Returns the tree, or an equal one interned before.
+        """
+        root = [cloudformation]
+        containers = []
+        stack = [(root, 0)]
+
+        # slots of the containers in depth first order, every container before those below it
+        while stack:
+            parent, key = stack.pop()
+            node = parent[key]
+            kind = node.__class__
+
+            if kind is dict:
+                stack.extend((node, k) for k in node)
+            elif kind is list:
+                stack.extend((node, i) for i in range(len(node)))
+            else:
+                continue
+
+            containers.append((parent, key))
+
+        # the children of a container are interned before the container itself
+        for parent, key in reversed(containers):
+            parent[key] = self._subtree(parent[key])
+
+        if cloudformation.__class__ not in (dict, list):
+            root[0] = self._leaf(cloudformation)
+
+        return root[0]
+
+    def summary(self):
+        return {
+            'strings': len(self.strings),
+            'subtrees': len(self.subtrees),
+            'leavesShared': self.leaves_shared,
+            'subtreesShared': self.subtrees_shared,
+            'bytesSaved': self.bytes_saved
+        }
+
+    def _leaf(self, value):
+        kind = value.__class__
+
+        if kind is str:
+            shared = self.strings.setdefault(value, value)
+        elif kind is int or kind is float:
+            shared = self.numbers.setdefault((kind, value), value)
+        else:
+            return value
+
+        if shared is not value:
+            self.leaves_shared += 1
+            self.bytes_saved += sys.getsizeof(value)
+
+        return shared
+
+    def _subtree(self, node):
+        if node.__class__ is dict:
+            keys = [self._leaf(k) for k in node]
+
+            if any(shared is not k for shared, k in zip(keys, node)):
+                # a dictionary only takes the keys it is given, refill it in order
+                values = list(node.values())
+                node.clear()
+                node.update(zip(keys, values))
+
+            for k, v in node.items():
+                shared = self._leaf(v)
+
+                # replacing a value does not change the size of the dictionary being iterated
+                if shared is not v:
+                    node[k] = shared
+
+            key = (dict, tuple((k, id(v)) for k, v in node.items()))
+        else:
+            for i, v in enumerate(node):
+                shared = self._leaf(v)
+
+                if shared is not v:
+                    node[i] = shared
+
+            key = (list, tuple(map(id, node)))
+
+        # the interned children are kept alive by the tables, their ids stay valid
+        shared = self.subtrees.setdefault(key, node)
+
+        if shared is not node:
+            self.subtrees_shared += 1
+            self.bytes_saved += sys.getsizeof(node)
+
+        return shared
@@ -1,24 +1,140 @@
 import collections
-import copy
+import json
 import logging
-import re
+import os
 
 import logger
+import naming
+import profiling
+import sharding
+from expression import replication_reference, replication_variables
+from plan import Memo, PlanCache, ReplicationPlan
+
+
+# summary: counts only, sampled: full fragments for a fraction of invocations, debug: full
+# fragments at debug level
+LOG_MODE = os.getenv('LOG_MODE', 'summary')
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '0.01'))
+
+# log the duration and traced memory of the phases of every invocation
+PROFILE = os.getenv('PROFILE', 'false').lower() == 'true'
+
+# fail before building replicates if the expansion would exceed the limits of CloudFormation
+CHECK_LIMITS = os.getenv('CHECK_LIMITS', 'true').lower() == 'true'
+
+# warn if the expansion is estimated to be too large, which costs about as much as expanding it
+ESTIMATE_SIZE = os.getenv('ESTIMATE_SIZE', 'false').lower() == 'true'
+
+# share the equal keys, literal values and subtrees of a fragment before expanding it
+INTERN = os.getenv('INTERN', 'false').lower() == 'true'
+
+# dimension of the metrics
+MACRO_NAME = os.getenv('MACRO_NAME', 'SubReplicate')
+
+# replication engines selected by the Engine key of the Replicates section
+ENGINES = ('plan', 'iterative')
+
+# compiled plans outlive the invocation, a warm container reuses them
+PLANS = PlanCache(
+    int(os.getenv('PLAN_CACHE_SIZE', '256')),
+    int(os.getenv('PLAN_CACHE_BYTES', str(16 * 2 ** 20)))
+)
+
+
+Task = collections.namedtuple(
+    'Task', ['name', 'base', 'replicates', 'defaults', 'names', 'fold', 'engine']
+)
 
 
 class Substitutor:
-    def __init__(self, base_name, base_resource, defaults={}):
+    def __init__(self, base_name, base_resource, defaults={}, plan=None, strategy=naming.camel,
+                 fold=True, engine='plan'):
         self.base_name = base_name
         self.base_resource = base_resource
         self.repl_defaults = defaults
+        self.strategy = strategy
+        self.fold = fold
+        self.engine = engine
+        self._plan = plan
+        self._analysis = None
+
+    @property
+    def plan(self):
+        """
+        Replication plan of the base resource, compiled on first use.
+        """
+        if self._plan is None:
+            self._plan = ReplicationPlan(self.base_resource, self.fold)
+
+        return self._plan
+
+    @property
+    def variables(self):
+        """
+        Replication variables the base resource refers to.
+        """
+        return self.plan.variables
+
+    @property
+    def analysis(self):
+        """
+        Dynamic and static subtrees of the base resource, analysed on first use.
+        """
+        if self._analysis is None:
+            # only the iterative engine and traverse need it, keep it out of the cold start
+            import traversal
+
+            self._analysis = traversal.analyse(self.base_resource)
+
+        return self._analysis
+
+    def is_static(self, cloudformation):
+        """
+        Whether a subtree of the base resource is left unchanged by traversing it.
+        """
+        # the base resource is alive, no other tree shares the ids of its subtrees
+        return id(cloudformation) in self.analysis.static
+
+    @property
+    def sites(self):
+        """
+        Number of Fn::Sub and Ref sites of the base resource mentioning replication variables,
+        from the analysis of its engine.
+        """
+        if self.engine == 'plan':
+            return len(self.plan.sites)
+
+        return self.analysis.sites
+
+    def missing(self, replicates):
+        """
+        Replication variables without a value or default, per replicate lacking any.
+        """
+        variables = self.variables
+        missing = {}
+
+        for replication_name, substitutions in (replicates or {}).items():
+            names = sorted(
+                variable for variable in variables
+                if variable not in substitutions and variable not in self.repl_defaults
+            )
+
+            if names:
+                missing[replication_name] = names
+
+        return missing
 
     def name(self, replication_name):
         """
         Supply a name for the replicated resource.
         """
-        tokens = re.split('[-_]', replication_name)
+        return self.strategy(self.base_name, replication_name)
 
-        return self.base_name + ''.join(map(lambda x: x.capitalize(), tokens))
+    def names(self, replicates, taken=None):
+        """
+        Validated names of all replicates by replication name, see naming.name_table.
+        """
+        return naming.name_table(self.base_name, replicates or {}, self.strategy, taken)
 
     def __parse_cf_substitution(self, cloudformation):
         """
@@ -49,27 +165,29 @@ class Substitutor:
         else:
             expression, supplied = cloudformation, {}
 
-        print(expression)
-        variables = re.findall(r'\${repl_(.+?)}', expression)
+        variables = replication_variables(expression)
 
         return expression, variables, supplied
 
     def substitute(self, replication_variables, cloudformation):
         """
-        Modifies the CloudFormation substitution function by looking up values in the replication
-        variables for variables mentioned in the substitution expression.
+        Returns the CloudFormation substitution function in list form, with the values of the
+        replication variables mentioned in the substitution expression added to its variable
+        map. The function itself is not modified.
         """
         expression, variables, supplied = self.__parse_cf_substitution(cloudformation)
 
         # recursive calls
-        for variable_name, variable_expression in supplied.items():
-            self.traverse(replication_variables, variable_expression)
+        substituted = {
+            variable_name: self.traverse(replication_variables, variable_expression)
+            for variable_name, variable_expression in supplied.items()
+        }
 
         for variable in variables:
             if variable in replication_variables:
-                supplied[f'repl_{variable}'] = replication_variables[variable]
+                substituted[f'repl_{variable}'] = replication_variables[variable]
 
-        return [ expression, supplied ]
+        return [ expression, substituted ]
 
     def traverse_list(self, replication_variables, cf_list):
         return list(
@@ -78,30 +196,37 @@ class Substitutor:
 
     def traverse_dict(self, replication_variables, cf_dict):
         """
-        Modifies the dictionary recursively. If a key indicates a substitution function, its value
-        is merged with the replication variables.
+        Returns a copy of the dictionary traversed recursively. If a key indicates a substitution
+        function, its value is merged with the replication variables.
         """
+        result = {}
+
         for k, v in cf_dict.items():
             if k == 'Fn::Sub':
-                cf_dict[k] = self.substitute(replication_variables, v)
-            # elif k == 'Ref' and isinstance(v, dict):
-            #     cf_dict[k] = self.traverse(replication_variables, v)
+                result[k] = self.substitute(replication_variables, v)
             elif k == 'Ref':
-                search = re.search('^repl_(.+)$', v)
+                variable = replication_reference(v) if isinstance(v, str) else None
 
-                if search:
-                    if search.group(1) in replication_variables:
-                        return replication_variables[search.group(1)]
+                if variable:
+                    if variable in replication_variables:
+                        return replication_variables[variable]
                     else:
-                        cf_dict[k] = 'AWS::NoValue'
+                        result[k] = 'AWS::NoValue'
                 else:
-                    cf_dict[k] = v
+                    result[k] = v
             else:
-                cf_dict[k] = self.traverse(replication_variables, v)
+                result[k] = self.traverse(replication_variables, v)
 
-        return cf_dict
+        return result
 
     def traverse(self, replication_variables, cloudformation):
+        """
+        Returns the CloudFormation tree with the replication variables substituted. The tree is
+        not modified, static subtrees are returned as they are and shared with the result.
+        """
+        if self.is_static(cloudformation):
+            return cloudformation
+
         if isinstance(cloudformation, dict):
             return self.traverse_dict(replication_variables, cloudformation)
         elif isinstance(cloudformation, list):
@@ -109,63 +234,408 @@ class Substitutor:
         else:
             return cloudformation
 
-    def process(self, replicates):
-        resources = {}
+    def iter_process(self, replicates, shared=True, names=None):
+        """
+        Generate the replicated resources one at a time as (name, resource) pairs. Subtrees
+        whose replication variables resolve identically are built once and shared between the
+        replicates, unless shared is false; sharing keeps every distinct subtree in memory until
+        the generator is done.
 
+        The names are validated before the first replicate is built, unless a name table is
+        given.
+        """
         if not replicates:
-            return resources
+            return
+
+        if names is None:
+            names = self.names(replicates)
+
+        memo = Memo() if shared else None
 
         for replication_name, substitutions in replicates.items():
-            name = self.name(replication_name)
-            replication_variables = collections.ChainMap(substitutions, self.repl_defaults)
+            yield names[replication_name], self.build(substitutions, memo)
 
-            resource = self.traverse(replication_variables, copy.deepcopy(self.base_resource))
+    def build(self, substitutions, memo=None):
+        """
+        Build a single replicate from its substitutions and the defaults. The iterative engine
+        does not share subtrees between replicates, the memo is ignored.
+        """
+        if self.engine == 'iterative':
+            import traversal
+
+            variables = dict(self.repl_defaults)
+            variables.update(substitutions)
+
+            return traversal.traverse(variables, self.base_resource, self.analysis, self.fold)
 
-            resources[name] = resource
+        plan = self.plan
 
-        return resources
+        return plan.build(plan.resolve(substitutions, self.repl_defaults), memo)
+
+    def process(self, replicates):
+        return dict(self.iter_process(replicates))
 
 
 def is_tagged(resource : tuple):
     return 'Replicates' in resource[1]
 
 
-def lambda_handler(event, context):
-    print(event)
-    fragment = event['fragment']
-    logger.log_message(logging.INFO, fragment)
+def summarise(request_id, stage, fragment, replicated, plans=None):
+    summary = {
+        'requestId': request_id,
+        'stage': stage,
+        'resources': len(fragment['Resources'])
+    }
+
+    if replicated is not None:
+        summary['replicated'] = replicated
+
+    if plans is not None:
+        summary['plans'] = plans
+
+    return summary
+
+
+def sample():
+    """
+    Whether to log the full fragments of this invocation in the sampled logging mode.
+    """
+    # random is only needed in the sampled mode, keep it out of the cold start
+    import random
+
+    return random.random() < LOG_SAMPLE_RATE
+
+
+def log_fragment(request_id, stage, fragment, verbose, replicated=None, plans=None):
+    """
+    Log a fragment according to the logging mode. A summary is always logged, the fragment itself
+    only when the mode requires it and then only serialized if the level is enabled.
+    """
+    logger.log_lazy(
+        logging.INFO, lambda: summarise(request_id, stage, fragment, replicated, plans)
+    )
+
+    if LOG_MODE == 'debug':
+        logger.log_lazy(logging.DEBUG, lambda: {
+            'requestId': request_id,
+            'stage': stage,
+            'fragment': fragment
+        })
+    elif verbose:
+        logger.log_message(logging.INFO, {
+            'requestId': request_id,
+            'stage': stage,
+            'fragment': fragment
+        })
+
+
+def replication_parameters(fragment, resource):
+    """
+    Replicates and defaults declared by a replicating resource.
+    """
+    params = resource['Replicates']
+    replicates = params['Elements']
+    defaults = params.get('Defaults', {})
+
+    # check if we need to get data from the Mappings section
+    if isinstance(replicates, str):
+        replicates = fragment['Mappings'][replicates]
+
+    return replicates, defaults
+
+
+def substitutor(name, base_resource, defaults, plans=None, strategy=naming.camel, fold=True,
+                engine='plan'):
+    """
+    Substitutor for a base resource. Given a PlanCache, plans are shared between identical base
+    resources, across fragments as well.
+    """
+    if plans is None or engine != 'plan':
+        return Substitutor(
+            name, base_resource, defaults, strategy=strategy, fold=fold, engine=engine
+        )
+
+    plan = plans.plan(base_resource, fold)
+
+    return Substitutor(name, base_resource, defaults, plan, strategy, fold, engine)
+
 
-    resources = fragment['Resources'].copy()
+def replicating_resources(fragment):
+    """
+    List the replicating resources of the fragment as Tasks. The names of all replicates are
+    validated against each other and the other resources before any replicate is built, a
+    NamingError is raised if one is invalid or taken.
+    """
+    resources = fragment['Resources']
+    taken = {name: None for name, resource in resources.items() if 'Replicates' not in resource}
+    tasks = []
 
     for name, resource in filter(is_tagged, resources.items()):
-        params = resource.pop('Replicates')
-        replicates = params['Elements']
-        defaults = params.get('Defaults', {})
+        replicates, defaults = replication_parameters(fragment, resource)
+        base = {k: v for k, v in resource.items() if k != 'Replicates'}
+        strategy = naming.strategy(resource['Replicates'].get('Naming', 'camel'))
+        names = naming.name_table(name, replicates or {}, strategy, taken)
+        fold = resource['Replicates'].get('Fold', True)
+        engine = resource['Replicates'].get('Engine', 'plan')
+
+        if engine not in ENGINES:
+            raise ValueError(
+                f'unknown engine {engine} for {name}, expected one of {", ".join(ENGINES)}'
+            )
+
+        taken.update(dict.fromkeys(names.values(), name))
+        tasks.append(Task(name, base, replicates, defaults, names, fold, engine))
+
+    return tasks
+
+
+def iter_expand(fragment, plans=None):
+    """
+    Generate the resources of the expanded fragment one at a time as (name, resource) pairs, in
+    the order expand leaves them. Replicates are only built when requested, they do not share
+    memoised subtrees so memory stays bounded, and the fragment is not modified.
+    """
+    tasks = replicating_resources(fragment)
+
+    for name, resource in fragment['Resources'].items():
+        if 'Replicates' not in resource:
+            yield name, resource
+
+    for task in tasks:
+        replicator = substitutor(
+            task.name, task.base, task.defaults, plans, fold=task.fold, engine=task.engine
+        )
+
+        yield from replicator.iter_process(task.replicates, shared=False, names=task.names)
+
+
+def validate(name, substitutor, replicates):
+    """
+    Raise a ValueError if a replicate lacks a value or default for a replication variable.
+    """
+    missing = substitutor.missing(replicates)
+
+    if missing:
+        raise ValueError(f'{name} has no value or default for ' + ', '.join(
+            f'{", ".join(variables)} in {replication_name}'
+            for replication_name, variables in missing.items()
+        ))
+
+
+def replicate(name, base_resource, replicates, defaults, names, fold=True, engine='plan',
+              strict=False, plans=None):
+    """
+    Replicates of a single replicating resource, as a list of (name, resource) pairs, and the
+    number of Fn::Sub and Ref sites substituted in them.
+    """
+    replicator = substitutor(name, base_resource, defaults, plans, fold=fold, engine=engine)
+
+    if strict:
+        validate(name, replicator, replicates)
+
+    resources = list(replicator.iter_process(replicates, names=names))
+
+    return resources, replicator.sites * len(resources)
+
+
+def expand(fragment, strict=False, plans=None, executor=None, profile=None, limit=False,
+           interner=None, estimate=False):
+    """
+    Replace every replicating resource of the fragment by its replicates. The fragment is modified
+    in place, the number of replicates per replicating resource is returned.
+
+    Replication variables without a value become AWS::NoValue, unless strict is set in which case
+    a ValueError is raised. Replicates named invalidly or after another resource raise a
+    NamingError before any replicate is built. With limit, so does a sharding.LimitError if the
+    expanded fragment would have more resources than CloudFormation allows. With estimate as
+    well, a warning is logged if it is estimated to be too large. Plans are shared through the
+    PlanCache plans, if given.
+
+    Given a concurrent.futures executor, the replicating resources are expanded concurrently. The
+    result does not depend on the order in which they finish. Plans are not shared with the
+    workers of a process pool.
+
+    Given an interning.Interner, the fragment is interned first, its replicates share the keys
+    and literal values of its base resources. The phases are recorded in the profiling.Profile
+    profile, if given.
+    """
+    resources = fragment['Resources']
+
+    if interner is not None:
+        with profiling.phase(profile, 'intern'):
+            interner.intern(fragment)
+
+    with profiling.phase(profile, 'parse'):
+        tasks = replicating_resources(fragment)
+
+        if limit:
+            warning = sharding.check(
+                sharding.estimate(fragment, tasks) if estimate
+                else sharding.Estimate(sharding.count(fragment, tasks), None)
+            )
+
+            if warning:
+                logger.log_message(logging.WARNING, {'stage': 'limits', 'warning': warning})
+
+    if executor is None:
+        results = []
 
-        # check if we need to get data from the Mappings section
-        if isinstance(replicates, str):
-            replicates = fragment['Mappings'][replicates]
+        for task in tasks:
+            with profiling.phase(profile, 'replicate', resource=task.name) as details:
+                replicates, details['sites'] = replicate(*task, strict, plans)
+                results.append(replicates)
+    else:
+        import concurrent.futures
 
-        resources = Substitutor(name, resource, defaults).process(replicates)
+        if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+            plans = None
 
-        # add replicated resources
-        fragment['Resources'].update(resources)
+        with profiling.phase(profile, 'replicate') as details:
+            futures = [executor.submit(replicate, *task, strict, plans) for task in tasks]
+            results = [future.result() for future in futures]
+            details['sites'] = sum(sites for _, sites in results)
+            results = [replicates for replicates, _ in results]
 
-        # remove the replicating resource
-        del fragment['Resources'][name]
+    with profiling.phase(profile, 'merge'):
+        # the resources that do not replicate in their order, followed by the replicates in the
+        # order of their replicating resources
+        merged = {
+            name: resource for name, resource in resources.items() if 'Replicates' not in resource
+        }
 
-    logger.log_message(logging.INFO, fragment)
+        for replicates in results:
+            merged.update(replicates)
+
+        resources.clear()
+        resources.update(merged)
+
+    return {task.name: len(replicates) for task, replicates in zip(tasks, results)}
+
+
+def process_event(event, plans=None):
+    """
+    Expand the fragment of a macro event, taking plans from the plans cache or the module level
+    one. The output summary counts the plans found in and missing from the cache. If profiling
+    is enabled, the profile of the invocation is logged as well. What interning the fragment
+    saved is logged at debug level.
+
+    Metrics of the invocation are buffered in the logger, the handlers flush them.
+    """
+    fragment = event['fragment']
+    request_id = event['requestId']
+    verbose = LOG_MODE == 'sampled' and sample()
+    plans = PLANS if plans is None else plans
+    hits, misses = plans.hits, plans.misses
+    profile = profiling.Profile(memory=PROFILE)
+    interner = None
+
+    if INTERN:
+        # interning is opt-in, keep it out of the cold start
+        import interning
+
+        interner = interning.Interner()
+
+    log_fragment(request_id, 'input', fragment, verbose)
+
+    try:
+        replicated = expand(
+            fragment, plans=plans, profile=profile, limit=CHECK_LIMITS, interner=interner,
+            estimate=ESTIMATE_SIZE
+        )
+
+        if PROFILE:
+            # the Lambda runtime serializes the response, measure it the same way
+            with profile.phase('serialize') as details:
+                details['bytes'] = len(json.dumps(fragment))
+
+            logger.log_message(logging.INFO, profile.summary(request_id))
+    finally:
+        profile.stop()
+
+    cache = {
+        'hits': plans.hits - hits,
+        'misses': plans.misses - misses,
+        'cached': len(plans),
+        'bytes': plans.bytes
+    }
+
+    log_fragment(request_id, 'output', fragment, verbose, replicated, cache)
+
+    if interner is not None:
+        logger.log_lazy(logging.DEBUG, lambda: {
+            'requestId': request_id,
+            'stage': 'interning',
+            **interner.summary()
+        })
+
+    put_metrics(replicated, cache, profile)
 
     processed = {
-        'requestId': event['requestId'],
+        'requestId': request_id,
         'status': 'success',
         'fragment': fragment
     }
 
-    print(processed)
     return processed
 
 
+def put_metrics(replicated, cache, profile):
+    logger.put_metric('ReplicatingResources', len(replicated))
+    logger.put_metric('Replicates', sum(replicated.values()))
+
+    for count in replicated.values():
+        logger.put_metric('ReplicatesPerResource', count)
+
+    logger.put_metric('SitesSubstituted', sum(
+        phase.get('sites', 0) for phase in profile.phases
+    ))
+    logger.put_metric('PlanCacheHits', cache['hits'])
+    logger.put_metric('PlanCacheMisses', cache['misses'])
+
+    for phase, duration in profile.durations().items():
+        logger.put_metric(f'{phase.capitalize()}Latency', duration, 'Milliseconds')
+
+
+def process_batch(events):
+    """
+    Process a list of macro events in one go, sharing compiled plans between them. A failing
+    event results in a failure response and does not affect the others.
+    """
+    responses = []
+
+    for event in events:
+        try:
+            responses.append(process_event(event))
+        except Exception as error:
+            logger.log_exception(error)
+            responses.append({
+                'requestId': event.get('requestId'),
+                'status': 'failure',
+                'errorMessage': f'{type(error).__name__}: {error}'
+            })
+
+    return responses
+
+
+def lambda_handler(event, context):
+    try:
+        return process_event(event)
+    finally:
+        logger.flush_metrics(Macro=MACRO_NAME)
+
+
+def batch_handler(event, context):
+    """
+    Handler for a batch of macro events, given as a list under the events key.
+    """
+    try:
+        return {
+            'responses': process_batch(event['events'])
+        }
+    finally:
+        logger.flush_metrics(Macro=MACRO_NAME)
+
+
 if __name__ == '__main__':
     template = {
         'fragment': {
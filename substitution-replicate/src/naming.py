@@ -0,0 +1,101 @@
+"""
+Logical IDs of replicated resources.
+
+The names of all replicates of a resource are computed in one pass before any of them is built,
+and checked against the rules of CloudFormation and the other resources of the template.
+"""
+import hashlib
+import re
+
+
+NAME_SEPARATORS = re.compile('[-_]')
+LOGICAL_ID = re.compile('[A-Za-z0-9]+')
+MAX_LENGTH = 255
+
+# length of the hash suffix of the hashed naming strategy
+HASH_LENGTH = 8
+
+
+class NamingError(ValueError):
+    """
+    Replicates named invalidly or after another resource.
+    """
+
+
+def camel(base_name, replication_name):
+    """
+    The base name followed by the capitalised parts of the replication name, e.g. base name
+    BaseResource and replication name resource_one give BaseResourceOne.
+    """
+    tokens = NAME_SEPARATORS.split(replication_name)
+
+    return base_name + ''.join(map(lambda x: x.capitalize(), tokens))
+
+
+def hashed(base_name, replication_name):
+    """
+    The camel name, unless it is too long for a logical ID. It is then cut short and a hash of
+    the replication name is appended to keep it unique.
+    """
+    name = camel(base_name, replication_name)
+
+    if len(name) <= MAX_LENGTH:
+        return name
+
+    digest = hashlib.sha256(replication_name.encode('utf-8')).hexdigest()
+
+    return name[:MAX_LENGTH - HASH_LENGTH] + digest[:HASH_LENGTH]
+
+
+STRATEGIES = {
+    'camel': camel,
+    'hashed': hashed
+}
+
+
+def strategy(name):
+    """
+    Naming strategy by its name in the Naming key of the Replicates section.
+    """
+    try:
+        return STRATEGIES[name]
+    except KeyError:
+        raise NamingError(
+            f'unknown naming strategy {name}, expected one of {", ".join(STRATEGIES)}'
+        ) from None
+
+
+def name_table(base_name, replication_names, strategy=camel, taken=None):
+    """
+    Logical IDs of the replicates by replication name. Raises a NamingError listing every name
+    that is not a valid logical ID or is taken, taken maps the names in use to the replicating
+    resource they belong to or to None for the other resources.
+    """
+    taken = taken or {}
+    names = {}
+    origins = {}
+    errors = []
+
+    for replication_name in replication_names:
+        name = strategy(base_name, replication_name)
+
+        if not LOGICAL_ID.fullmatch(name):
+            errors.append(f'{name}, a replicate of {base_name}, is not alphanumeric')
+        elif len(name) > MAX_LENGTH:
+            errors.append(
+                f'{name[:32]}..., a replicate of {base_name}, is longer than {MAX_LENGTH} '
+                'characters'
+            )
+        elif name in origins or name in taken:
+            origin = base_name if name in origins else taken[name]
+            other = f'a replicate of {origin}' if origin else 'an existing resource'
+
+            errors.append(f'{name}, a replicate of {base_name}, has the same name as {other}')
+
+        names[replication_name] = name
+        origins[name] = replication_name
+
+    if errors:
+        raise NamingError('; '.join(errors))
+
+    return names
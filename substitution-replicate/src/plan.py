@@ -0,0 +1,443 @@
+"""
+Compiled replication plans for base resources.
+"""
+import collections
+import hashlib
+import itertools
+import json
+import sys
+import threading
+
+from expression import fold, replication_reference, replication_variables
+
+
+class ReplicationPlan:
+    """
+    Analyses a base resource once and records the paths of every Fn::Sub and Ref site mentioning
+    a replication variable. Replicates are built from a normalised template of the base resource:
+    static subtrees are shared between replicates, only the containers on the path to a recorded
+    site are copied.
+
+    With fold, Fn::Sub functions are resolved as far as the values of their variables are known:
+    to a string if all of them are, otherwise to a Fn::Sub function of the remaining variables.
+
+    The base resource is not copied nor modified, the template shares every subtree that needs no
+    normalising with it. Replicates share structure with the plan, the base resource and each
+    other, they should all be treated as read only. Given a memo, subtrees whose replication
+    variables resolve to the same values are built once and shared between replicates as well.
+    """
+    def __init__(self, base_resource, fold=True):
+        self.sites = []
+        self.fold = fold
+        self.template, self.root = self._compile(base_resource, ())
+
+    @property
+    def variables(self):
+        """
+        Replication variables the base resource refers to.
+        """
+        return frozenset(self.root.variables) if self.root else frozenset()
+
+    def build(self, replication_variables, memo=None):
+        """
+        Build a replicate of the base resource for the given replication variables. Pass the same
+        Memo to share identical subtrees between replicates.
+        """
+        if self.root is None:
+            return self.template
+
+        # every site looks up its variables, a flat table is cheaper than a ChainMap
+        if not isinstance(replication_variables, dict):
+            replication_variables = self.resolve(replication_variables)
+
+        if memo is None:
+            return self.root._build(self.template, replication_variables, None, None)
+
+        return self.root.build(self.template, replication_variables, memo, {})
+
+    def resolve(self, substitutions, defaults=()):
+        """
+        Flat table of the values of the replication variables the base resource refers to, taken
+        from the substitutions or else from the defaults. Variables without a value are left out.
+        """
+        table = {}
+
+        for variable in self.root.variables if self.root else ():
+            if variable in substitutions:
+                table[variable] = substitutions[variable]
+            elif variable in defaults:
+                table[variable] = defaults[variable]
+
+        return table
+
+    def _compile(self, cloudformation, path):
+        """
+        Compile a subtree to its normalised template and its node, None if it has no replication
+        sites. The subtree is not modified: its template is the subtree itself, unless a Fn::Sub
+        function below it was normalised, in which case the containers on the path to it are
+        copied.
+        """
+        if isinstance(cloudformation, dict):
+            reference = cloudformation.get('Ref')
+
+            if isinstance(reference, str):
+                variable = replication_reference(reference)
+
+                if variable:
+                    self.sites.append(path)
+
+                    if len(cloudformation) == 1:
+                        return cloudformation, _Reference(variable)
+
+                    # the other entries are replicated if the variable has no value
+                    template, others = self._compile_dict(cloudformation, path)
+
+                    return template, _Reference(variable, others)
+
+            if self.fold and len(cloudformation) == 1 and 'Fn::Sub' in cloudformation:
+                substitution = cloudformation['Fn::Sub']
+                entry, child = self._compile_substitution(substitution, path + ('Fn::Sub',))
+                template = cloudformation if entry is substitution else {'Fn::Sub': entry}
+
+                return template, _Fold(child) if child is not None else None
+
+            return self._compile_dict(cloudformation, path)
+        elif isinstance(cloudformation, list):
+            template = cloudformation
+            children = []
+
+            for i, v in enumerate(cloudformation):
+                entry, child = self._compile(v, path + (i,))
+
+                if entry is not v:
+                    if template is cloudformation:
+                        template = list(cloudformation)
+
+                    template[i] = entry
+
+                if child is not None:
+                    children.append((i, child))
+
+            return template, _Container(children) if children else None
+        else:
+            return cloudformation, None
+
+    def _compile_dict(self, cloudformation, path):
+        template = cloudformation
+        children = []
+
+        for k, v in cloudformation.items():
+            if k == 'Fn::Sub':
+                entry, child = self._compile_substitution(v, path + (k,))
+            else:
+                entry, child = self._compile(v, path + (k,))
+
+            if entry is not v:
+                if template is cloudformation:
+                    template = cloudformation.copy()
+
+                template[k] = entry
+
+            if child is not None:
+                children.append((k, child))
+
+        return template, _Container(children) if children else None
+
+    def _compile_substitution(self, cloudformation, path):
+        """
+        Normalise a Fn::Sub function to its list form and compile it. The list form is shared by
+        all replicates if neither the expression nor the variable map mention replication
+        variables.
+        """
+        if isinstance(cloudformation, list):
+            expression, supplied = cloudformation
+        else:
+            expression, supplied = cloudformation, {}
+
+        variables = replication_variables(expression)
+        supplied_template, children = self._compile(supplied, path + (1,))
+
+        if variables:
+            self.sites.append(path)
+
+        if isinstance(cloudformation, list) and supplied_template is supplied:
+            template = cloudformation
+        else:
+            template = [expression, supplied_template]
+
+        if not variables and children is None:
+            return template, None
+
+        return template, _Substitution(variables, children)
+
+
+class PlanCache:
+    """
+    Bounded LRU cache of replication plans keyed by a hash of the base resource. Kept at module
+    level, a warm Lambda container skips compiling the base resources it has seen before.
+
+    The least recently used plans are evicted once there are more than max_entries of them, or
+    once their size exceeds max_bytes. The size of a plan is approximated by the length of its
+    serialised base resource, larger plans are built but not cached. The cache can be shared
+    between threads.
+    """
+    def __init__(self, max_entries=256, max_bytes=16 * 2 ** 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.plans = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.plans)
+
+    @staticmethod
+    def key(base_resource):
+        """
+        Stable hash and size of the base resource. Replicates keep the key order of their base
+        resource, base resources in another key order do not share a plan.
+        """
+        serialised = json.dumps(base_resource, separators=(',', ':'), default=str).encode('utf-8')
+
+        return hashlib.sha256(serialised).hexdigest(), len(serialised)
+
+    def plan(self, base_resource, fold=True):
+        """
+        Replication plan of the base resource, compiled if it is not cached.
+        """
+        digest, size = self.key(base_resource)
+        key = (digest, fold)
+
+        with self.lock:
+            entry = self.plans.get(key)
+
+            if entry is not None:
+                self.hits += 1
+                self.plans.move_to_end(key)
+
+                return entry[0]
+
+            self.misses += 1
+
+        plan = ReplicationPlan(base_resource, fold)
+
+        with self.lock:
+            if size <= self.max_bytes and key not in self.plans:
+                self.plans[key] = plan, size
+                self.bytes += size
+                self.evict()
+
+        return plan
+
+    def evict(self):
+        while len(self.plans) > self.max_entries or self.bytes > self.max_bytes:
+            _, (_, size) = self.plans.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.plans),
+            'bytes': self.bytes
+        }
+
+
+_MISSING = object()
+
+# consecutive misses after which a subtree is no longer memoised
+MEMO_PROBES = 16
+
+
+class Memo:
+    """
+    Subtrees built for earlier replicates, keyed by compiled subtree and by the values its
+    replication variables resolve to. Values are compared together with their type, so 1, 1.0
+    and True are kept apart. Unhashable values are compared by identity.
+
+    Subtrees that refer to a variable which differs for every replicate are never shared, they
+    are no longer looked up once they missed MEMO_PROBES times in a row.
+    """
+    def __init__(self):
+        self.subtrees = {}
+        self.signatures = {}
+        self.misses = {}
+        self.skipped = set()
+
+    def signature(self, variables, replication_variables):
+        """
+        Small integer identifying the values of the variables.
+        """
+        values = tuple(map(replication_variables.get, variables, itertools.repeat(_MISSING)))
+        key = (values, tuple(map(type, values)))
+
+        try:
+            return self.signatures.setdefault(key, len(self.signatures))
+        except TypeError:
+            key = ('id', tuple(map(id, values)), key[1])
+
+            return self.signatures.setdefault(key, len(self.signatures))
+
+
+class _Node:
+    """
+    Compiled subtree, annotated with the replication variables it refers to.
+    """
+    __slots__ = ('variables',)
+
+    def build(self, template, replication_variables, memo, signatures):
+        """
+        Build the subtree, reusing a memoised one if its variables resolve to the same values.
+        Signatures caches the signature per variable set for the replicate being built, subtrees
+        often refer to the same variables.
+        """
+        if self in memo.skipped:
+            return self._build(template, replication_variables, memo, signatures)
+
+        signature = signatures.get(self.variables)
+
+        if signature is None:
+            signature = signatures[self.variables] = memo.signature(
+                self.variables, replication_variables
+            )
+
+        key = (self, signature)
+        node = memo.subtrees.get(key)
+
+        if node is None:
+            node = memo.subtrees[key] = self._build(
+                template, replication_variables, memo, signatures
+            )
+            misses = memo.misses[self] = memo.misses.get(self, 0) + 1
+
+            if misses >= MEMO_PROBES:
+                memo.skipped.add(self)
+        else:
+            memo.misses[self] = 0
+
+        return node
+
+
+class _Container(_Node):
+    """
+    Dictionary or list with at least one replication site below it.
+    """
+    __slots__ = ('children',)
+
+    def __init__(self, children):
+        self.children = children
+        self.variables = _union(child.variables for _, child in children)
+
+    def _build(self, template, replication_variables, memo, signatures):
+        node = template.copy()
+
+        if memo is None:
+            for k, child in self.children:
+                node[k] = child._build(template[k], replication_variables, None, None)
+        else:
+            for k, child in self.children:
+                node[k] = child.build(template[k], replication_variables, memo, signatures)
+
+        return node
+
+
+class _Reference(_Node):
+    """
+    Ref to a replication variable, replaced by its value or by AWS::NoValue. Given the other
+    entries of the dictionary, these are replicated in the latter case, like by
+    Substitutor.traverse.
+    """
+    __slots__ = ('variable', 'others')
+
+    def __init__(self, variable, others=None):
+        self.variable = variable
+        self.others = others
+        self.variables = _union(((variable,), others.variables if others else ()))
+
+    def build(self, template, replication_variables, memo, signatures):
+        # cheaper than a memo lookup
+        return self._build(template, replication_variables, memo, signatures)
+
+    def _build(self, template, replication_variables, memo, signatures):
+        if self.variable in replication_variables:
+            return replication_variables[self.variable]
+
+        if self.others is None:
+            return dict(template, Ref='AWS::NoValue')
+
+        node = self.others._build(template, replication_variables, memo, signatures)
+        node['Ref'] = 'AWS::NoValue'
+
+        return node
+
+
+class _Substitution(_Node):
+    """
+    Fn::Sub function whose variable map receives replication variables.
+    """
+    __slots__ = ('keys', 'supplied')
+
+    def __init__(self, expression_variables, supplied):
+        # replication variables with their key in the variable map, shared by every replicate
+        self.keys = tuple(
+            (variable, sys.intern(f'repl_{variable}')) for variable in expression_variables
+        )
+        self.supplied = supplied
+        self.variables = _union((expression_variables, supplied.variables if supplied else ()))
+
+    def _build(self, template, replication_variables, memo, signatures):
+        expression, supplied = template
+
+        if self.supplied is None:
+            supplied = supplied.copy()
+        else:
+            # bypass the memo, the variable map is modified below
+            supplied = self.supplied._build(supplied, replication_variables, memo, signatures)
+
+        for variable, key in self.keys:
+            if variable in replication_variables:
+                supplied[key] = replication_variables[variable]
+
+        return [expression, supplied]
+
+
+class _Fold(_Node):
+    """
+    Fn::Sub function with its replication variables folded into the expression, a string if no
+    variable is left. Values that are not strings or numbers are left to CloudFormation.
+    """
+    __slots__ = ('substitution',)
+
+    def __init__(self, substitution):
+        self.substitution = substitution
+        self.variables = substitution.variables
+
+    def _build(self, template, replication_variables, memo, signatures):
+        expression, supplied = self.substitution._build(
+            template['Fn::Sub'], replication_variables, memo, signatures
+        )
+        values = {
+            key: replication_variables[variable]
+            for variable, key in self.substitution.keys
+            if variable in replication_variables
+        }
+        resolved, folded, substituted = fold(expression, values)
+
+        if resolved:
+            return folded
+
+        if not substituted:
+            return {'Fn::Sub': [expression, supplied]}
+
+        remaining = {k: v for k, v in supplied.items() if k not in substituted}
+
+        return {'Fn::Sub': [folded, remaining] if remaining else folded}
+
+
+def _union(variables):
+    return tuple(sorted(set(itertools.chain.from_iterable(variables))))
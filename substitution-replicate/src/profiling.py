@@ -0,0 +1,129 @@
+"""
+Time and memory profile of the phases of an invocation, to size the memory of the macro function.
+
+Memory is traced with tracemalloc, which slows the macro down considerably, so profiling is
+only enabled on request.
+"""
+import contextlib
+import time
+
+
+class Profile:
+    """
+    Duration and traced memory of the phases of an invocation. The peak of a phase is the most
+    memory traced during it above the memory traced when it started, allocated the memory it
+    left traced. Without memory, only the durations are recorded.
+
+    Before Python 3.9 the peak cannot be reset, tracing is restarted for every phase instead and
+    only the memory allocated during the phase is traced. The peak of a phase is left out if
+    tracing was started by someone else, it would be the peak of the whole process.
+    """
+    def __init__(self, memory=True):
+        self.phases = []
+        self.peak = 0
+        self.memory = memory
+        self.tracing = False
+
+        if memory:
+            # tracemalloc is only needed to trace memory, keep it out of the cold start
+            import tracemalloc
+
+            self.tracing = not tracemalloc.is_tracing()
+
+            if self.tracing:
+                tracemalloc.start()
+
+    @contextlib.contextmanager
+    def phase(self, name, **details):
+        """
+        Record a phase. The details are logged with it, more can be added to the dictionary the
+        context returns.
+        """
+        if not self.memory:
+            start = time.perf_counter()
+
+            try:
+                yield details
+            finally:
+                duration = time.perf_counter() - start
+                self.phases.append(dict(details, phase=name, durationMs=round(duration * 1000, 3)))
+
+            return
+
+        import tracemalloc
+
+        offset = 0
+        reset = True
+
+        # Python 3.9 and up, the peak is taken over the whole invocation before
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        elif self.tracing:
+            # the memory traced before the phase is forgotten, count it towards the overall peak
+            offset, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            tracemalloc.start()
+        else:
+            reset = False
+
+        start_memory, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+
+        try:
+            yield details
+        finally:
+            duration = time.perf_counter() - start
+            memory, peak = tracemalloc.get_traced_memory()
+            self.peak = max(self.peak, offset + peak)
+            self.phases.append(dict(
+                details,
+                phase=name,
+                durationMs=round(duration * 1000, 3),
+                allocatedBytes=memory - start_memory
+            ))
+
+            if reset:
+                self.phases[-1]['peakBytes'] = peak - start_memory
+
+    def stop(self):
+        if self.tracing:
+            import tracemalloc
+
+            tracemalloc.stop()
+            self.tracing = False
+
+    def durations(self):
+        """
+        Total duration in milliseconds per phase name, in the order the phases first ran.
+        """
+        durations = {}
+
+        for phase in self.phases:
+            durations[phase['phase']] = durations.get(phase['phase'], 0) + phase['durationMs']
+
+        return durations
+
+    def summary(self, request_id):
+        """
+        The profile as a single log message.
+        """
+        import resource
+
+        return {
+            'requestId': request_id,
+            'stage': 'profile',
+            'phases': self.phases,
+            'peakBytes': self.peak,
+            # kilobytes on Linux
+            'maxRssBytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        }
+
+
+def phase(profile, name, **details):
+    """
+    Context of a phase of the profile, which only returns the details if there is no profile.
+    """
+    if profile is None:
+        return contextlib.nullcontext(details)
+
+    return profile.phase(name, **details)
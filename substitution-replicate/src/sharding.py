@@ -0,0 +1,471 @@
+"""
+Size limits of expanded templates and sharding of replicates into nested stacks.
+
+CloudFormation rejects templates with more than 500 resources or of more than 1 MB, but only
+after the macro returned. The resources of an expansion are counted before any replicate is
+built, so an expansion with too many resources fails fast. Its size can be estimated as well, to
+warn about one that is likely too large, at a cost per replicate. The command line interface can
+instead move the replicates of an oversized template into nested stacks, each a template within
+the limits.
+"""
+import collections
+import json
+
+from expression import (
+    ATTRIBUTE, LITERAL, VARIABLE, is_constant, replication_reference, replication_variables,
+    tokenize
+)
+
+
+MAX_RESOURCES = 500
+MAX_TEMPLATE_BYTES = 2 ** 20
+
+SHARD_NAME = 'ReplicatesShard'
+
+Estimate = collections.namedtuple('Estimate', ['resources', 'bytes'])
+
+# replication sites of a base resource, see sites
+Reference = collections.namedtuple('Reference', ['variable', 'size'])
+Substitution = collections.namedtuple(
+    'Substitution',
+    ['occurrences', 'folded', 'resolvable', 'expression_size', 'escapes', 'size', 'supplied']
+)
+
+# ["expression",{}] instead of "expression"
+LIST_FORM_BYTES = len('[,{}]')
+
+
+class LimitError(ValueError):
+    """
+    An expanded template that exceeds the limits of CloudFormation.
+    """
+
+
+class ShardingError(ValueError):
+    """
+    Replicates that cannot be moved into nested stacks.
+    """
+
+
+def size(cloudformation):
+    """
+    Length of the compact JSON of a tree. Trees nested deeper than the json module can encode are
+    measured with an explicit work stack instead.
+    """
+    try:
+        return len(json.dumps(cloudformation, separators=(',', ':'), default=str))
+    except RecursionError:
+        return _deep_size(cloudformation)
+
+
+def _deep_size(cloudformation):
+    total = 0
+    stack = [cloudformation]
+
+    while stack:
+        node = stack.pop()
+
+        if isinstance(node, dict):
+            # braces, commas and colons
+            total += len(node) * 2 + 1 if node else 2
+
+            for k, v in node.items():
+                # keys that are not strings are encoded as strings, "1", "true"
+                total += len(json.dumps({k: 0}, separators=(',', ':'))) - len('{:0}')
+                stack.append(v)
+        elif isinstance(node, list):
+            total += len(node) + 1 if node else 2
+            stack.extend(node)
+        else:
+            total += len(json.dumps(node, default=str))
+
+    return total
+
+
+def sites(base_resource, fold=True):
+    """
+    Size of the base resource with its Fn::Sub functions in list form, as a replication plan
+    normalises them, and its Reference and Substitution sites. A Substitution is folded if
+    fold is set and it is the only entry of its dictionary, like with a ReplicationPlan.
+    """
+    template_size = size(base_resource)
+    found = []
+    stack = [base_resource]
+
+    while stack:
+        node = stack.pop()
+
+        if isinstance(node, list):
+            stack.extend(node)
+            continue
+        elif not isinstance(node, dict):
+            continue
+
+        reference = node.get('Ref')
+        variable = replication_reference(reference) if isinstance(reference, str) else None
+
+        if variable:
+            found.append(Reference(variable, size(node)))
+            stack.extend(v for k, v in node.items() if k != 'Ref')
+            continue
+
+        for k, v in node.items():
+            if k != 'Fn::Sub':
+                stack.append(v)
+                continue
+
+            expression, supplied = v if isinstance(v, list) else (v, {})
+            stack.append(supplied)
+
+            if not isinstance(v, list):
+                template_size += LIST_FORM_BYTES
+
+            variables = replication_variables(expression)
+
+            if not variables:
+                continue
+
+            tokens = tokenize(expression)
+            occurrences = collections.Counter(
+                value[len('repl_'):] for kind, value in tokens
+                if kind == VARIABLE and value[len('repl_'):] in variables
+            )
+            supplied_sizes = {name: size(value) for name, value in supplied.items()}
+            expression_size = size(expression)
+            found.append(Substitution(
+                occurrences=tuple(occurrences.items()),
+                folded=fold and len(node) == 1,
+                resolvable=sum(kind != LITERAL for kind, _ in tokens) == sum(occurrences.values()),
+                expression_size=expression_size,
+                escapes=expression.count('${!'),
+                size=size(node) + (0 if isinstance(v, list) else LIST_FORM_BYTES),
+                supplied=supplied_sizes
+            ))
+
+    return template_size, found
+
+
+def entries(added, supplied):
+    """
+    Number of bytes a variable map with entries of the given sizes grows by when entries are
+    added, as (key, size of the value) pairs. Entries with a key already in the map replace it.
+    """
+    grown = 0
+    count = len(supplied)
+
+    for key, value_size in added:
+        if key in supplied:
+            grown += value_size - supplied[key]
+        else:
+            # ,"key":value
+            grown += len(key) + 3 + value_size + (1 if count else 0)
+            count += 1
+
+    return grown
+
+
+def growth(site, variables, sizes):
+    """
+    Number of bytes a replicate grows by at a site, given the values of the replication
+    variables and a dictionary caching the sizes of the values for the replicate.
+    """
+    def value_size(variable):
+        if variable not in sizes:
+            sizes[variable] = size(variables[variable])
+
+        return sizes[variable]
+
+    if isinstance(site, Reference):
+        if site.variable in variables:
+            return value_size(site.variable) - site.size
+
+        return len('AWS::NoValue') - len(f'repl_{site.variable}')
+
+    present = [(variable, times) for variable, times in site.occurrences if variable in variables]
+    constant = [
+        (variable, times) for variable, times in present if is_constant(variables[variable])
+    ] if site.folded else []
+
+    if not constant:
+        return entries(((f'repl_{variable}', value_size(variable)) for variable, _ in present),
+                       site.supplied)
+
+    # "${repl_variable}" replaced by the value, without its quotes
+    text = sum(
+        times * (size(str(variables[variable])) - 2 - len(f'${{repl_{variable}}}'))
+        for variable, times in constant
+    )
+
+    if site.resolvable and len(constant) == len(site.occurrences):
+        # a string, escaped placeholders are rendered
+        return site.expression_size + text - site.escapes - site.size
+
+    # placeholders in the values are escaped
+    text += sum(times * str(variables[variable]).count('${') for variable, times in constant)
+    remaining = [
+        (f'repl_{variable}', value_size(variable)) for variable, times in present
+        if (variable, times) not in constant
+    ]
+
+    if not remaining and not site.supplied:
+        return text - LIST_FORM_BYTES
+
+    return text + entries(remaining, site.supplied)
+
+
+def count(fragment, tasks):
+    """
+    Number of resources of a fragment once expanded, given its replicating resources.
+    """
+    return len(fragment['Resources']) - len(tasks) + sum(len(task.names) for task in tasks)
+
+
+def estimate(fragment, tasks):
+    """
+    Estimate the number of resources and the size of a fragment once expanded, given its
+    replicating resources. A replicate is estimated as its base resource grown by its sites,
+    without building it, the resources are counted exactly. The estimate is exact unless
+    variable maps supply replication variables themselves or a replication variable is
+    substituted within a subtree replaced by another.
+    """
+    resources = fragment['Resources']
+    total = size(fragment)
+
+    for task in tasks:
+        template_size, base_sites = sites(task.base, task.fold)
+        # "name":resource,
+        total -= size(task.name) + size(resources[task.name]) + 2
+
+        for replication_name, substitutions in (task.replicates or {}).items():
+            variables = collections.ChainMap(substitutions, task.defaults)
+            sizes = {}
+            total += size(task.names[replication_name]) + template_size + 2 + sum(
+                growth(site, variables, sizes) for site in base_sites
+            )
+
+    return Estimate(count(fragment, tasks), total)
+
+
+def exceeds(estimate, max_resources=MAX_RESOURCES, max_bytes=MAX_TEMPLATE_BYTES):
+    return estimate.resources > max_resources or estimate.bytes > max_bytes
+
+
+def check(estimate):
+    """
+    Raise a LimitError if the expanded template would have more resources than CloudFormation
+    allows. The size is only estimated, if at all, a warning is returned if it would be too
+    large.
+    """
+    if estimate.resources > MAX_RESOURCES:
+        raise LimitError(
+            f'the expanded template would have {estimate.resources} resources, more than the '
+            f'{MAX_RESOURCES} allowed, shard its replicates into nested stacks with the command '
+            f'line interface'
+        )
+
+    if estimate.bytes is not None and estimate.bytes > MAX_TEMPLATE_BYTES:
+        return (
+            f'the expanded template is estimated at {estimate.bytes} bytes, more than the '
+            f'{MAX_TEMPLATE_BYTES} allowed'
+        )
+
+
+def references(cloudformation, names=None, mappings=None):
+    """
+    Names of the parameters, resources and conditions a CloudFormation tree refers to, and the
+    mappings it looks up values in. A mapping of None stands for a lookup in a mapping that is
+    not known until deployment.
+    """
+    names = set() if names is None else names
+    mappings = set() if mappings is None else mappings
+
+    if isinstance(cloudformation, dict):
+        for key, value in cloudformation.items():
+            if key == 'Ref' and isinstance(value, str):
+                names.add(value)
+            elif key == 'Fn::GetAtt' and isinstance(value, (str, list)) and value:
+                target = value.split('.')[0] if isinstance(value, str) else value[0]
+
+                if isinstance(target, str):
+                    names.add(target)
+            elif key == 'Fn::Sub':
+                expression, supplied = value if isinstance(value, list) else (value, {})
+
+                if isinstance(expression, str):
+                    names.update(
+                        token.value.split('.')[0] for token in tokenize(expression)
+                        if token.kind in (VARIABLE, ATTRIBUTE) and token.value not in supplied
+                    )
+            elif key == 'Fn::FindInMap' and isinstance(value, list) and value:
+                mappings.add(value[0] if isinstance(value[0], str) else None)
+            elif key in ('Fn::If', 'Condition') and isinstance(value, (str, list)) and value:
+                condition = value if isinstance(value, str) else value[0]
+
+                if isinstance(condition, str):
+                    names.add(condition)
+
+            references(value, names, mappings)
+    elif isinstance(cloudformation, list):
+        for entry in cloudformation:
+            references(entry, names, mappings)
+
+    return names, mappings
+
+
+def dependencies(resource):
+    """
+    References of a resource, including its DependsOn attribute.
+    """
+    names, mappings = references(resource)
+    depends_on = resource.get('DependsOn', [])
+    names.update([depends_on] if isinstance(depends_on, str) else depends_on)
+
+    return names, mappings
+
+
+def stack_parameter(name, definition):
+    """
+    Parameter declaration of a nested stack and the value the parent passes it. Values of SSM
+    parameters are resolved by the parent, lists are passed as comma delimited strings.
+    """
+    kind = definition.get('Type', 'String')
+
+    if kind.startswith('AWS::SSM::Parameter::Value<'):
+        kind = kind[len('AWS::SSM::Parameter::Value<'):-1]
+
+    if kind == 'List<String>':
+        kind = 'CommaDelimitedList'
+
+    declaration = {'Type': kind}
+
+    if definition.get('NoEcho'):
+        declaration['NoEcho'] = definition['NoEcho']
+
+    if kind.startswith('List<') or kind == 'CommaDelimitedList':
+        return declaration, {'Fn::Join': [',', {'Ref': name}]}
+
+    return declaration, {'Ref': name}
+
+
+def shard_template(template, resources):
+    """
+    Nested stack template of resources, with the parameters and mappings of template they need.
+    Returns the template and the parameters to pass it.
+    """
+    names, mappings = set(), set()
+
+    for resource in resources.values():
+        resource_names, resource_mappings = dependencies(resource)
+        names |= resource_names
+        mappings |= resource_mappings
+
+    shard = {'AWSTemplateFormatVersion': '2010-09-09'}
+    parameters = {}
+    declarations = {}
+
+    for name in sorted(names & set(template.get('Parameters', {}))):
+        declarations[name], parameters[name] = stack_parameter(
+            name, template['Parameters'][name]
+        )
+
+    if declarations:
+        shard['Parameters'] = declarations
+
+    if mappings and 'Mappings' in template:
+        shard['Mappings'] = template['Mappings'] if None in mappings else {
+            name: template['Mappings'][name] for name in template['Mappings'] if name in mappings
+        }
+
+    shard['Resources'] = resources
+
+    return shard, parameters
+
+
+def shard(template, replicate_names, location, max_resources=MAX_RESOURCES,
+          max_bytes=MAX_TEMPLATE_BYTES, dump=None):
+    """
+    Move the replicates of an expanded template, given as a set of names, into nested stacks of at
+    most max_resources resources and max_bytes each, in the order of the template. Returns the
+    parent template, with the other resources and a stack per shard, and the shard templates.
+    The template URL of the n-th shard is location(n), counting from 1. The shards are measured
+    as dump writes them, compact JSON by default.
+
+    Replicates may only refer to parameters and mappings, not to other resources or conditions,
+    and other resources and outputs may not refer to replicates. A ShardingError is raised
+    otherwise, or if the parent template would still exceed max_resources.
+    """
+    resources = template['Resources']
+    replicates = [name for name in resources if name in replicate_names]
+    outside = set(resources) | set(template.get('Conditions', {}))
+    errors = []
+
+    for name, resource in resources.items():
+        if name in replicate_names:
+            targets = sorted(dependencies(resource)[0] & outside)
+            errors.extend(f'{name} refers to {target}' for target in targets)
+        else:
+            targets = sorted(dependencies(resource)[0] & replicate_names)
+            errors.extend(f'{name} refers to the replicate {target}' for target in targets)
+
+    for name, output in template.get('Outputs', {}).items():
+        targets = sorted(references(output)[0] & replicate_names)
+        errors.extend(f'the output {name} refers to the replicate {target}' for target in targets)
+
+    if errors:
+        raise ShardingError('cannot move replicates into nested stacks: ' + '; '.join(errors))
+
+    measure = size if dump is None else lambda tree: len(dump(tree).encode('utf-8'))
+    # the resources of a shard are left after the parameters and mappings it may need
+    header = shard_template(template, {name: resources[name] for name in replicates})[0]
+    # resources are measured after another one, the first one differs by a constant
+    base = measure({'Resources': {' ': None}})
+    first = measure({'Resources': {'': None}}) - measure({'Resources': {}})
+    later = measure({'Resources': {' ': None, '': None}}) - base
+    budget = max_bytes - measure(dict(header, Resources={})) - max(first - later, 0)
+    shards = [[]]
+    used = 0
+
+    for name in replicates:
+        replicate_size = measure({'Resources': {' ': None, name: resources[name]}}) - base
+
+        if replicate_size > budget:
+            raise ShardingError(f'{name} does not fit in a nested stack of {max_bytes} bytes')
+
+        if len(shards[-1]) == max_resources or used + replicate_size > budget:
+            shards.append([])
+            used = 0
+
+        shards[-1].append(name)
+        used += replicate_size
+
+    parent = {k: v for k, v in template.items() if k != 'Resources'}
+    parent['Resources'] = {
+        name: resource for name, resource in resources.items() if name not in replicate_names
+    }
+    templates = []
+
+    for index, names in enumerate(filter(None, shards), 1):
+        shard_name = f'{SHARD_NAME}{index}'
+
+        if shard_name in parent['Resources']:
+            raise ShardingError(f'{shard_name} is the name of an existing resource')
+
+        nested, parameters = shard_template(template, {name: resources[name] for name in names})
+        properties = {'TemplateURL': location(index)}
+
+        if parameters:
+            properties['Parameters'] = parameters
+
+        parent['Resources'][shard_name] = {
+            'Type': 'AWS::CloudFormation::Stack',
+            'Properties': properties
+        }
+        templates.append(nested)
+
+    if len(parent['Resources']) > max_resources:
+        raise ShardingError(
+            f'the parent template would still have {len(parent["Resources"])} resources, more '
+            f'than {max_resources}'
+        )
+
+    return parent, templates
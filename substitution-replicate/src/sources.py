@@ -0,0 +1,190 @@
+"""
+Sources of the AWS::Include transforms of templates expanded offline.
+
+CloudFormation resolves AWS::Include before the macro runs, the command line interface resolves
+them from local files instead: relative locations from a directory, S3 locations from a directory
+standing in for S3 with a subdirectory per bucket. Every file is read and parsed once, however
+many resources include it, and parsed files are kept in a content-addressed cache on disk.
+"""
+import contextlib
+import hashlib
+import json
+import mmap
+import os
+import pathlib
+import re
+import urllib.parse
+
+
+# files from this size on are memory mapped instead of read
+MMAP_THRESHOLD = 2 ** 20
+
+# virtual-hosted (bucket.s3.region.amazonaws.com) and path-style (s3.region.amazonaws.com/bucket)
+S3_HOST = re.compile(r'^(?:(?P<bucket>.+)\.)?s3[.-](?:[a-z0-9-]+\.)?amazonaws\.com$')
+
+
+class SourceError(ValueError):
+    """
+    An included location that cannot be resolved locally.
+    """
+
+
+def parse(data, suffix):
+    """
+    Parse a JSON or YAML (with the CloudFormation short form tags) document to plain dictionaries
+    and lists.
+    """
+    if suffix == '.json':
+        return json.loads(data)
+
+    # cfn_flip is a development dependency, it is not deployed with the macro
+    import cfn_flip
+
+    return json.loads(json.dumps(cfn_flip.load_yaml(data), default=str))
+
+
+@contextlib.contextmanager
+def contents(path, size):
+    """
+    Contents of a file as a bytes-like object, memory mapped if the file is large.
+    """
+    with open(path, 'rb') as f:
+        if size < MMAP_THRESHOLD:
+            yield f.read()
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield mapped
+
+
+def is_include(transform):
+    return isinstance(transform, dict) and transform.get('Name') == 'AWS::Include'
+
+
+class Includes:
+    """
+    Resolves AWS::Include transforms from local files. Relative locations are looked up in
+    directory, S3 locations in s3_directory. Parsed documents are cached in memory by content
+    digest and, given a cache_directory, on disk as well.
+    """
+    def __init__(self, directory='.', s3_directory=None, cache_directory=None):
+        self.directory = pathlib.Path(directory)
+        self.s3_directory = s3_directory and pathlib.Path(s3_directory)
+        self.cache_directory = cache_directory and pathlib.Path(cache_directory)
+        self.digests = {}
+        self.documents = {}
+        self.reads = 0
+        self.parses = 0
+
+    def path(self, location):
+        """
+        Local path of an included location.
+        """
+        url = urllib.parse.urlsplit(location)
+
+        if url.scheme == 's3':
+            bucket, key = url.netloc, url.path.lstrip('/')
+        elif url.scheme in ('http', 'https') and S3_HOST.match(url.netloc):
+            bucket = S3_HOST.match(url.netloc).group('bucket')
+            key = url.path.lstrip('/')
+
+            if bucket is None:
+                bucket, _, key = key.partition('/')
+        elif url.scheme:
+            raise SourceError(f'cannot include {location}, only S3 and local files are supported')
+        else:
+            return self.directory / location
+
+        if self.s3_directory is None:
+            raise SourceError(f'cannot include {location} without a local stand-in for S3')
+
+        return self.s3_directory / bucket / key
+
+    def digest(self, path):
+        """
+        Content digest of a file, only computed again if the file changed.
+        """
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            raise SourceError(f'cannot include {path}, it does not exist') from None
+
+        key = (path, stat.st_mtime_ns, stat.st_size)
+
+        if key not in self.digests:
+            self.reads += 1
+
+            with contents(path, stat.st_size) as data:
+                self.digests[key] = hashlib.sha256(data).hexdigest()
+
+        return self.digests[key]
+
+    def document(self, path, digest):
+        """
+        Parsed document of a file with the given digest, from the disk cache if it is there.
+        """
+        cached = self.cache_directory and self.cache_directory / digest[:2] / f'{digest}.json'
+
+        if cached and cached.exists():
+            with open(cached) as f:
+                return json.load(f)
+
+        self.parses += 1
+
+        # decoded straight from the buffer, a mapped file is not copied to bytes first
+        with contents(path, path.stat().st_size) as data:
+            document = parse(str(data, 'utf-8'), path.suffix)
+
+        if cached:
+            cached.parent.mkdir(parents=True, exist_ok=True)
+
+            # templates are expanded in parallel, write the entry atomically
+            temporary = cached.with_suffix(f'.{os.getpid()}.tmp')
+            temporary.write_text(json.dumps(document))
+            os.replace(temporary, cached)
+
+        return document
+
+    def load(self, location):
+        """
+        Document included from a location. It is shared by every include of the same contents and
+        should not be modified, resolve copies it into the template.
+        """
+        path = self.path(location)
+        digest = self.digest(path)
+
+        if digest not in self.documents:
+            self.documents[digest] = self.document(path, digest)
+
+        return self.documents[digest]
+
+    def resolve(self, cloudformation):
+        """
+        Copy of a CloudFormation tree with its AWS::Include transforms replaced by the included
+        documents. Included mappings are merged with the keys next to the transform, if any.
+        """
+        if isinstance(cloudformation, dict):
+            transform = cloudformation.get('Fn::Transform')
+
+            if not is_include(transform):
+                return {k: self.resolve(v) for k, v in cloudformation.items()}
+
+            resolved = {
+                k: self.resolve(v) for k, v in cloudformation.items() if k != 'Fn::Transform'
+            }
+            document = self.resolve(self.load(transform['Parameters']['Location']))
+
+            if not resolved:
+                return document
+
+            if not isinstance(document, dict):
+                raise SourceError(
+                    f'cannot merge {transform["Parameters"]["Location"]}, it is not a mapping'
+                )
+
+            resolved.update(document)
+
+            return resolved
+        elif isinstance(cloudformation, list):
+            return [self.resolve(entry) for entry in cloudformation]
+        else:
+            return cloudformation
@@ -0,0 +1,124 @@
+"""
+Writers for expanded templates. The streaming writers encode the resources one at a time, so only
+a single replicate has to be held in memory.
+"""
+import functools
+import json
+
+
+def indent(text, prefix):
+    return text.replace('\n', '\n' + prefix)
+
+
+@functools.lru_cache(maxsize=None)
+def yaml_dumper():
+    # cfn_flip is a development dependency, it is not deployed with the macro
+    import cfn_flip.yaml_dumper
+
+    class Dumper(cfn_flip.yaml_dumper.get_dumper()):
+        # replicates share subtrees, write them out in full instead of as anchors
+        def ignore_aliases(self, data):
+            return True
+
+    return Dumper
+
+
+def dump_yaml(data):
+    import yaml
+
+    return yaml.dump(
+        data,
+        Dumper=yaml_dumper(),
+        default_flow_style=False,
+        allow_unicode=True,
+        sort_keys=False
+    )
+
+
+def dump_json(data):
+    return json.dumps(data, indent=2) + '\n'
+
+
+def json_entry(name, resource):
+    """
+    Entry of a resource in the Resources section of a JSON template.
+    """
+    return json.dumps(name) + ': ' + indent(json.dumps(resource, indent=2), '    ')
+
+
+def yaml_entry(name, resource):
+    """
+    Entry of a resource in the Resources section of a YAML template.
+    """
+    return '  ' + indent(dump_yaml({name: resource}).rstrip('\n'), '  ')
+
+
+def entry(name, resource, output_format):
+    if output_format == 'json':
+        return json_entry(name, resource)
+    else:
+        return yaml_entry(name, resource)
+
+
+def write_json(template, entries, fp):
+    """
+    Write a template as JSON, taking the entries of its Resources section from entries instead
+    of the template.
+    """
+    fp.write('{')
+
+    for i, (k, v) in enumerate(template.items()):
+        fp.write(',\n  ' if i else '\n  ')
+        fp.write(json.dumps(k) + ': ')
+
+        if k == 'Resources':
+            separator = '{\n    '
+
+            for text in entries:
+                fp.write(separator + text)
+                separator = ',\n    '
+
+            fp.write('{}' if separator.startswith('{') else '\n  }')
+        else:
+            fp.write(indent(json.dumps(v, indent=2), '  '))
+
+    fp.write('\n}\n')
+
+
+def write_yaml(template, entries, fp):
+    """
+    Write a template as YAML, taking the entries of its Resources section from entries instead
+    of the template.
+    """
+    for k, v in template.items():
+        if k == 'Resources':
+            header = 'Resources:\n'
+
+            for text in entries:
+                fp.write(header + text + '\n')
+                header = ''
+
+            if header:
+                fp.write('Resources: {}\n')
+        else:
+            fp.write(dump_yaml({k: v}))
+
+
+def write_entries(template, entries, fp, output_format):
+    """
+    Write a template with the already encoded entries of its Resources section.
+    """
+    if output_format == 'json':
+        write_json(template, entries, fp)
+    else:
+        write_yaml(template, entries, fp)
+
+
+def write(template, resources, fp, output_format):
+    """
+    Write a template, taking its resources from the (name, resource) pairs instead of the
+    Resources section. Each resource is encoded when it is written.
+    """
+    entries = (entry(name, resource, output_format) for name, resource in resources)
+
+    write_entries(template, entries, fp, output_format)
@@ -0,0 +1,212 @@
+"""
+Iterative replication engine.
+
+Substitutes replication variables like Substitutor.traverse, but walks the tree with an explicit
+work stack instead of a Python call per node, dispatching on the type of a node through a table
+instead of a chain of isinstance checks. Trees of any depth can be replicated, deeply nested
+policy documents do not run into the recursion limit. Parsing and serializing them is left to the
+callers, the json module does run into it.
+
+Trees are expected to be made of plain dictionaries and lists, as CloudFormation passes them.
+"""
+import collections
+import itertools
+
+from expression import fold as fold_expression
+from expression import replication_reference, replication_variables
+
+
+Analysis = collections.namedtuple('Analysis', ['dynamic', 'replicating', 'static', 'sites'])
+
+
+def analyse(cloudformation):
+    """
+    Ids of the dictionaries and lists of a tree that traversing changes, those holding Fn::Sub
+    functions or replication variables, of those referring to replication variables, and of the
+    static ones it leaves unchanged, with the number of Fn::Sub and Ref sites mentioning
+    replication variables. The tree has to be kept alive and unmodified for the ids to stay
+    valid.
+
+    The analysis is shared by both engines walking the tree, Substitutor.traverse skips the
+    static subtrees as well.
+    """
+    containers = []
+    stack = [(cloudformation, None)]
+
+    # containers in depth first order, every container before the containers below it
+    while stack:
+        node, parent = stack.pop()
+        kind = node.__class__
+
+        if kind is dict:
+            children = node.values()
+        elif kind is list:
+            children = node
+        else:
+            continue
+
+        containers.append((node, parent))
+        stack.extend(zip(children, itertools.repeat(id(node))))
+
+    dynamic = set()
+    replicating = set()
+    sites = 0
+
+    for node, parent in reversed(containers):
+        key = id(node)
+
+        if node.__class__ is dict:
+            if 'Fn::Sub' in node:
+                value = node['Fn::Sub']
+                expression = value[0] if isinstance(value, list) else value
+                dynamic.add(key)
+
+                if replication_variables(expression):
+                    replicating.add(key)
+                    sites += 1
+
+            reference = node.get('Ref')
+
+            if isinstance(reference, str) and replication_reference(reference):
+                dynamic.add(key)
+                replicating.add(key)
+                sites += 1
+
+        if parent is not None:
+            if key in dynamic:
+                dynamic.add(parent)
+
+            if key in replicating:
+                replicating.add(parent)
+
+    static = {id(node) for node, _ in containers}
+    static.difference_update(dynamic)
+
+    return Analysis(dynamic, replicating, static, sites)
+
+
+def _push(stack, container, key, value, dynamic):
+    if value.__class__ in HANDLERS and (dynamic is None or id(value) in dynamic):
+        stack.append((container, key))
+
+
+def _substitution(value, variables, stack, dynamic):
+    """
+    Fn::Sub function in list form with the values of its replication variables added to its
+    variable map, the entries of the map are pushed to be traversed.
+    """
+    expression, supplied = value if isinstance(value, list) else (value, {})
+    substituted = dict(supplied)
+    values = {}
+
+    for variable in replication_variables(expression):
+        if variable in variables:
+            values[f'repl_{variable}'] = variables[variable]
+
+    substituted.update(values)
+
+    for k, v in supplied.items():
+        if k not in values:
+            _push(stack, substituted, k, v, dynamic)
+
+    return expression, substituted, values
+
+
+def _dict(node, variables, stack, context):
+    dynamic, replicating, fold = context
+
+    if fold and len(node) == 1 and 'Fn::Sub' in node:
+        value = node['Fn::Sub']
+        supplied = value[1] if isinstance(value, list) else None
+        expression, substituted, values = _substitution(value, variables, stack, dynamic)
+
+        if replication_variables(expression) or id(supplied) in replicating:
+            return _folded(expression, substituted, values)
+
+        return {'Fn::Sub': [expression, substituted]}
+
+    result = {}
+
+    for k, v in node.items():
+        if k == 'Fn::Sub':
+            expression, substituted, _ = _substitution(v, variables, stack, dynamic)
+            result[k] = [expression, substituted]
+        elif k == 'Ref':
+            variable = replication_reference(v) if isinstance(v, str) else None
+
+            if variable:
+                if variable in variables:
+                    # entries pushed for the result are built in vain, like Substitutor.traverse
+                    return variables[variable]
+
+                result[k] = 'AWS::NoValue'
+            else:
+                result[k] = v
+        else:
+            result[k] = v
+
+            # inlined _push, this runs for every entry
+            if v.__class__ in HANDLERS and (dynamic is None or id(v) in dynamic):
+                stack.append((result, k))
+
+    return result
+
+
+def _folded(expression, substituted, values):
+    """
+    Fn::Sub function with the values of its replication variables folded into the expression,
+    like plan._Fold. Entries of the variable map still to be traversed are kept in place.
+    """
+    resolved, folded, names = fold_expression(expression, values)
+
+    if resolved:
+        return folded
+
+    if not names:
+        return {'Fn::Sub': [expression, substituted]}
+
+    for name in names:
+        del substituted[name]
+
+    return {'Fn::Sub': [folded, substituted] if substituted else folded}
+
+
+def _list(node, variables, stack, context):
+    dynamic = context[0]
+    result = list(node)
+
+    stack.extend(
+        (result, i) for i, v in enumerate(result)
+        if v.__class__ in HANDLERS and (dynamic is None or id(v) in dynamic)
+    )
+
+    return result
+
+
+HANDLERS = {
+    dict: _dict,
+    list: _list
+}
+
+
+def traverse(variables, cloudformation, analysis=None, fold=False):
+    """
+    Returns the CloudFormation tree with the replication variables substituted, without
+    modifying it. Given the analysis of the tree, static subtrees are returned as they are and
+    shared with the result. With fold, Fn::Sub functions are folded like with a ReplicationPlan.
+    """
+    if analysis is None and fold:
+        analysis = analyse(cloudformation)
+
+    dynamic, replicating = analysis[:2] if analysis else (None, set())
+    context = (dynamic, replicating, fold)
+    root = [cloudformation]
+    stack = []
+    _push(stack, root, 0, cloudformation, dynamic)
+
+    while stack:
+        container, key = stack.pop()
+        node = container[key]
+        container[key] = HANDLERS[node.__class__](node, variables, stack, context)
+
+    return root[0]
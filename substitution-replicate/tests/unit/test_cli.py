@@ -0,0 +1,227 @@
+import json
+
+import pytest
+
+from cli import cli, load_template, run
+from sharding import MAX_TEMPLATE_BYTES
+
+
+TEMPLATE = '''
+AWSTemplateFormatVersion: 2010-09-09
+Transform:
+  - SubReplicate
+Mappings:
+  roles:
+    step-function:
+      service: states
+    fargate:
+      service: ecs
+Resources:
+  Role:
+    Type: AWS::IAM::Role
+    Replicates:
+      Elements: roles
+    Properties:
+      Path: !Sub /${repl_service}/
+'''
+
+
+class TestCli:
+    @pytest.fixture
+    def templates(self, tmp_path):
+        directory = tmp_path / 'templates'
+        (directory / 'nested').mkdir(parents=True)
+        (directory / 'one.yml').write_text(TEMPLATE)
+        (directory / 'nested' / 'two.yml').write_text(TEMPLATE)
+        (directory / 'README.md').write_text('not a template')
+
+        return directory
+
+    def test_expand_file(self, templates, capsys):
+        assert cli([str(templates / 'one.yml'), '--format', 'json']) == 0
+
+        template = json.loads(capsys.readouterr().out)
+
+        assert 'Transform' not in template
+        assert template['Resources'] == {
+            'RoleStepFunction': {
+                'Type': 'AWS::IAM::Role',
+                'Properties': {
+                    'Path': '/states/'
+                }
+            },
+            'RoleFargate': {
+                'Type': 'AWS::IAM::Role',
+                'Properties': {
+                    'Path': '/ecs/'
+                }
+            }
+        }
+
+    def test_expand_directory(self, templates, tmp_path):
+        """
+        Test that a directory of templates is expanded in parallel into a mirrored directory.
+        """
+        output = tmp_path / 'output'
+
+        assert cli([str(templates), '--output', str(output), '--workers', '2']) == 0
+
+        assert sorted(str(path.relative_to(output)) for path in output.rglob('*.yml')) == [
+            'nested/two.yml',
+            'one.yml'
+        ]
+        assert 'RoleFargate:' in (output / 'nested' / 'two.yml').read_text()
+
+    def test_expand_failure(self, templates, tmp_path, capsys):
+        """
+        Test that a broken template is reported without stopping the others.
+        """
+        (templates / 'broken.yml').write_text('Resources:\n  Role:\n    Replicates: {}\n')
+        output = tmp_path / 'output'
+
+        assert cli([str(templates), '--output', str(output)]) == 1
+
+        assert 'broken.yml: KeyError' in capsys.readouterr().err
+        assert (output / 'one.yml').exists()
+
+    @pytest.mark.parametrize('output_format', ['json', 'yaml'])
+    def test_expand_streaming(self, templates, capsys, output_format):
+        """
+        Test that streaming the replicates gives the same template as expanding it at once.
+        """
+        source = str(templates / 'one.yml')
+
+        assert cli([source, '--format', output_format]) == 0
+        expanded = capsys.readouterr().out
+
+        assert cli([source, '--format', output_format, '--stream']) == 0
+        streamed = capsys.readouterr().out
+
+        assert streamed == expanded
+
+    def test_expand_executor(self, templates, capsys):
+        """
+        Test that expanding the replicating resources in a process pool gives the same template.
+        """
+        source = str(templates / 'one.yml')
+
+        assert cli([source]) == 0
+        expanded = capsys.readouterr().out
+
+        assert cli([source, '--executor', 'process', '--workers', '2']) == 0
+
+        assert capsys.readouterr().out == expanded
+
+    def test_expand_include(self, tmp_path, capsys):
+        """
+        Test that included replicates are read from the local stand-in for S3.
+        """
+        (tmp_path / 's3' / 'bucket').mkdir(parents=True)
+        (tmp_path / 's3' / 'bucket' / 'roles.yml').write_text('batch:\n  service: batch\n')
+        (tmp_path / 'template.yml').write_text(
+            'Resources:\n'
+            '  Role:\n'
+            '    Type: AWS::IAM::Role\n'
+            '    Replicates:\n'
+            '      Elements:\n'
+            '        Fn::Transform:\n'
+            '          Name: AWS::Include\n'
+            '          Parameters:\n'
+            '            Location: s3://bucket/roles.yml\n'
+            '    Properties:\n'
+            '      Path: !Sub /${repl_service}/\n'
+        )
+
+        assert cli([str(tmp_path / 'template.yml'), '--s3-root', str(tmp_path / 's3')]) == 0
+
+        assert 'RoleBatch:' in capsys.readouterr().out
+
+    def test_expand_incremental(self, templates, tmp_path, capsys):
+        """
+        Test that an incremental expansion reports the resources it changed.
+        """
+        output = tmp_path / 'output.yml'
+        source = templates / 'one.yml'
+
+        assert cli([str(source), '--output', str(output), '--incremental']) == 0
+        capsys.readouterr()
+
+        source.write_text(TEMPLATE.replace('service: ecs', 'service: ecs-tasks'))
+
+        assert cli([str(source), '--output', str(output), '--incremental']) == 0
+
+        assert capsys.readouterr().err.splitlines()[:2] == [
+            f'{source}: 0 added, 1 changed, 0 removed, 1 unchanged',
+            '  ~ RoleFargate'
+        ]
+
+    def test_expand_shard(self, tmp_path, capsys):
+        """
+        Test that the replicates of an oversized template are moved into nested stacks, which an
+        expansion without sharding refuses.
+        """
+        source = tmp_path / 'template.yml'
+        source.write_text(
+            'Mappings:\n'
+            '  roles:\n' +
+            ''.join(f'    role-{i}:\n      service: service{i}\n' for i in range(600)) +
+            'Resources:\n'
+            '  Role:\n'
+            '    Type: AWS::IAM::Role\n'
+            '    Replicates:\n'
+            '      Elements: roles\n'
+            '    Properties:\n'
+            '      Path: !Sub /${repl_service}/\n'
+        )
+        output = tmp_path / 'output' / 'template.yml'
+
+        assert cli([str(source), '--output', str(output)]) == 1
+        assert 'LimitError' in capsys.readouterr().err
+
+        assert cli([str(source), '--output', str(output), '--shard']) == 0
+        assert 'replicates moved into 2 nested stacks' in capsys.readouterr().err
+
+        template = load_template(output)
+
+        assert template['Resources']['ReplicatesShard2'] == {
+            'Type': 'AWS::CloudFormation::Stack',
+            'Properties': {
+                'TemplateURL': 'template.shard2.yml'
+            }
+        }
+        assert len(load_template(output.with_name('template.shard1.yml'))['Resources']) == 500
+        assert len(load_template(output.with_name('template.shard2.yml'))['Resources']) == 100
+
+        result = run((source, output, 'yaml', 'SubReplicate', 'shard', False, None))
+
+        assert (result.shards, result.diff, result.error) == (2, None, None)
+
+    def test_expand_shard_bytes(self, tmp_path):
+        """
+        Test that the nested stacks of a template too large to be written in one are each
+        written within the size limit, indented.
+        """
+        source = tmp_path / 'template.yml'
+        source.write_text(
+            'Mappings:\n'
+            '  roles:\n' +
+            ''.join(f'    role-{i}:\n      service: service{i}\n' for i in range(300)) +
+            'Resources:\n'
+            '  Role:\n'
+            '    Type: AWS::IAM::Role\n'
+            '    Replicates:\n'
+            '      Elements: roles\n'
+            '    Properties:\n'
+            '      Tags:\n' +
+            ''.join(f'        - Key: tag{i}\n          Value: !Sub ${{repl_service}}-{"x" * 40}\n'
+                    for i in range(40))
+        )
+        output = tmp_path / 'output' / 'template.json'
+
+        assert cli([str(source), '--output', str(output), '--format', 'json', '--shard']) == 0
+
+        shards = sorted(output.parent.glob('template.shard*.json'))
+
+        assert len(shards) > 1
+        assert all(path.stat().st_size <= MAX_TEMPLATE_BYTES for path in shards)
+        assert sum(len(load_template(path)['Resources']) for path in shards) == 300
@@ -0,0 +1,134 @@
+import collections
+import pathlib
+import re
+import sys
+
+import pytest
+
+import traversal
+from main import Substitutor
+
+# the generator is shared with the equivalence benchmark
+sys.path.insert(0, str(pathlib.Path(__file__).parents[2] / 'benchmarks'))
+
+import synthetic  # noqa: E402
+
+
+CASES = 200
+
+PLACEHOLDER = re.compile(r'\$\{(!?)([^}]*)\}')
+
+
+class Reference(Substitutor):
+    """
+    Substitutor.traverse descending into every subtree. Static subtrees are found by the
+    analysis of the iterative engine, which the reference should not depend on.
+    """
+    def is_static(self, cloudformation):
+        return False
+
+
+def reference(base, defaults, replicates):
+    """
+    Replicates built by the recursive Substitutor.traverse, the reference of the engines.
+    """
+    substitutor = Reference('Base', base, defaults, fold=False)
+    names = substitutor.names(replicates)
+
+    return {
+        names[replication_name]: substitutor.traverse(
+            collections.ChainMap(substitutions, defaults), base
+        )
+        for replication_name, substitutions in replicates.items()
+    }
+
+
+def render(cloudformation):
+    """
+    The tree with every Fn::Sub function rendered to the string CloudFormation substitutes,
+    written independently of expression.fold. Variables whose value is not known before
+    deployment, or not a string or an integer, are rendered as markers.
+    """
+    if isinstance(cloudformation, list):
+        return [render(entry) for entry in cloudformation]
+
+    if not isinstance(cloudformation, dict):
+        return cloudformation
+
+    rendered = {
+        k: render_substitution(v) if k == 'Fn::Sub' else render(v)
+        for k, v in cloudformation.items()
+    }
+
+    return rendered['Fn::Sub'] if list(rendered) == ['Fn::Sub'] else rendered
+
+
+def render_substitution(value):
+    expression, supplied = value if isinstance(value, list) else (value, {})
+    supplied = {k: render(v) for k, v in supplied.items()}
+
+    def placeholder(match):
+        escaped, name = match.groups()
+        value = supplied.get(name)
+
+        if escaped:
+            return '${' + name + '}'
+
+        if isinstance(value, str) or type(value) is int:
+            return str(value)
+
+        return f'\0{name}={value!r}\0'
+
+    return PLACEHOLDER.sub(placeholder, expression)
+
+
+class TestEquivalence:
+    @pytest.mark.parametrize('seed', range(CASES))
+    def test_engines(self, seed):
+        """
+        Test that the engines replicate random resources like the reference, and that the
+        functions they fold render like those of the reference.
+        """
+        base, defaults, replicates = synthetic.random_case(seed)
+        expected = reference(base, defaults, replicates)
+
+        for engine in ('plan', 'iterative'):
+            substitutor = Substitutor('Base', base, defaults, fold=False, engine=engine)
+
+            assert substitutor.process(replicates) == expected, engine
+
+        rendered = render(expected)
+
+        for engine in ('plan', 'iterative'):
+            folded = Substitutor('Base', base, defaults, engine=engine).process(replicates)
+
+            assert render(folded) == rendered, engine
+
+    def test_reference_analysis(self, monkeypatch):
+        """
+        Test that the reference does not share the analysis of the iterative engine, an analysis
+        marking every subtree static is caught.
+        """
+        base, defaults, replicates = synthetic.random_case(0)
+        expected = reference(base, defaults, replicates)
+
+        def analyse(cloudformation):
+            analysis = original(cloudformation)
+
+            return analysis._replace(dynamic=set(), static=analysis.static | analysis.dynamic)
+
+        original = traversal.analyse
+        monkeypatch.setattr(traversal, 'analyse', analyse)
+
+        assert reference(base, defaults, replicates) == expected
+        assert Substitutor(
+            'Base', base, defaults, fold=False, engine='iterative'
+        ).process(replicates) != expected
+
+    def test_render(self):
+        assert render({
+            'Fn::Sub': [
+                '${!Literal}-${AWS::Region}-${name}-${number}-${map}',
+                {'name': 'x', 'number': 2, 'map': {'Fn::Sub': '${AWS::AccountId}'}}
+            ]
+        }) == "${Literal}-\0AWS::Region=None\0-x-2-\0AWS::AccountId=None\0"
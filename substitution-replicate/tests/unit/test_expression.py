@@ -0,0 +1,75 @@
+import pytest
+
+from expression import (
+    ATTRIBUTE, LITERAL, PSEUDO_PARAMETER, VARIABLE, Token,
+    fold, replication_reference, replication_variables, tokenize
+)
+
+
+class TestTokenize:
+    def test_tokenize(self):
+        assert tokenize('arn:${AWS::Partition}:s3:::${Bucket}/${!Literal}/${Role.Arn}') == (
+            Token(LITERAL, 'arn:'),
+            Token(PSEUDO_PARAMETER, 'AWS::Partition'),
+            Token(LITERAL, ':s3:::'),
+            Token(VARIABLE, 'Bucket'),
+            Token(LITERAL, '/${Literal}/'),
+            Token(ATTRIBUTE, 'Role.Arn')
+        )
+
+    @pytest.mark.parametrize('expression,tokens', [
+        ('', ()),
+        ('plain', (Token(LITERAL, 'plain'),)),
+        ('${!Literal}', (Token(LITERAL, '${Literal}'),)),
+        ('${}', (Token(LITERAL, '${}'),)),
+        ('open ${end', (Token(LITERAL, 'open ${end'),)),
+        ('${a}${b}', (Token(VARIABLE, 'a'), Token(VARIABLE, 'b')))
+    ])
+    def test_tokenize_edge_cases(self, expression, tokens):
+        assert tokenize(expression) == tokens
+
+    def test_tokenize_cached(self):
+        """
+        Test that repeated expressions are parsed once.
+        """
+        assert tokenize('${repl_a}-${b}') is tokenize('${repl_a}-${b}')
+
+
+class TestReplicationVariables:
+    def test_replication_variables(self):
+        """
+        Test that only variables with the replication prefix are returned, once each. Escaped
+        placeholders and attributes are not replication variables.
+        """
+        expression = '${repl_a}-${b}-${!repl_c}-${repl_d.Arn}-${repl_a}-${AWS::Region}-${repl_e}'
+
+        assert replication_variables(expression) == ('a', 'e')
+
+    @pytest.mark.parametrize('name,variable', [
+        ('repl_variable', 'variable'),
+        ('repl_', None),
+        ('Variable', None)
+    ])
+    def test_replication_reference(self, name, variable):
+        assert replication_reference(name) == variable
+
+
+class TestFold:
+    @pytest.mark.parametrize('expression,values,result', [
+        ('${repl_a}-${repl_b}', {'repl_a': 'a', 'repl_b': 2}, (True, 'a-2', {'repl_a', 'repl_b'})),
+        ('${!Literal}/${repl_a}', {'repl_a': 'foo'}, (True, '${Literal}/foo', {'repl_a'})),
+        ('${AWS::Region}-${repl_a}', {'repl_a': 'foo'}, (False, '${AWS::Region}-foo', {'repl_a'})),
+        ('${!Literal}/${repl_a}', {}, (False, '${!Literal}/${repl_a}', set())),
+        ('${repl_a}', {'repl_a': True}, (False, '${repl_a}', set())),
+        ('${repl_a}', {'repl_a': {'Ref': 'Parameter'}}, (False, '${repl_a}', set()))
+    ])
+    def test_fold(self, expression, values, result):
+        assert fold(expression, values) == result
+
+    def test_fold_escapes_values(self):
+        """
+        Test that placeholders in substituted values are escaped when variables are left.
+        """
+        assert fold('${repl_a}-${Bucket}', {'repl_a': '${Role}'}) == (
+            False, '${!Role}-${Bucket}', {'repl_a'}
+        )
@@ -0,0 +1,106 @@
+import copy
+import io
+
+import pytest
+
+import incremental
+import main
+import stream
+
+
+class TestIncremental:
+    @pytest.fixture
+    def template(self):
+        return {
+            'Mappings': {
+                'tenants': {
+                    tenant: {'name': tenant} for tenant in ['one', 'two', 'three']
+                }
+            },
+            'Resources': {
+                'Topic': {
+                    'Type': 'AWS::SNS::Topic',
+                    'Replicates': {
+                        'Elements': 'tenants'
+                    },
+                    'Properties': {
+                        'TopicName': {'Fn::Sub': '${AWS::StackName}-${repl_name}'}
+                    }
+                },
+                'Key': {
+                    'Type': 'AWS::KMS::Key'
+                }
+            }
+        }
+
+    def expanded(self, template, output_format):
+        fp = io.StringIO()
+        stream.write(template, main.iter_expand(template), fp, output_format)
+
+        return fp.getvalue()
+
+    @pytest.mark.parametrize('output_format', ['json', 'yaml'])
+    def test_expand(self, template, tmp_path, monkeypatch, output_format):
+        """
+        Test that only added and changed replicates are built again, and that the output matches
+        a full expansion.
+        """
+        destination = tmp_path / 'template'
+        builds = []
+        build = main.Substitutor.build
+
+        def counting_build(self, substitutions, memo=None):
+            builds.append(substitutions['name'])
+            return build(self, substitutions, memo)
+
+        monkeypatch.setattr(main.Substitutor, 'build', counting_build)
+
+        _, diff = incremental.expand(copy.deepcopy(template), destination, output_format)
+
+        assert diff.added == ['Key', 'TopicOne', 'TopicTwo', 'TopicThree']
+        assert incremental.state_path(destination).exists()
+
+        tenants = template['Mappings']['tenants']
+        tenants['two']['name'] = 'second'
+        tenants['four'] = {'name': 'four'}
+        del tenants['three']
+        builds.clear()
+
+        replicated, diff = incremental.expand(copy.deepcopy(template), destination, output_format)
+
+        assert replicated == {'Topic': 3}
+        assert diff == incremental.Diff(
+            added=['TopicFour'],
+            changed=['TopicTwo'],
+            removed=['TopicThree'],
+            unchanged=['Key', 'TopicOne']
+        )
+        assert builds == ['second', 'four']
+        assert destination.read_text() == self.expanded(template, output_format)
+
+    def test_expand_format(self, template, tmp_path):
+        """
+        Test that the previous expansion is not built on if it is in another format.
+        """
+        destination = tmp_path / 'template'
+
+        incremental.expand(copy.deepcopy(template), destination, 'json')
+        _, diff = incremental.expand(copy.deepcopy(template), destination, 'yaml')
+
+        assert len(diff.added) == 4
+        assert destination.read_text() == self.expanded(template, 'yaml')
+
+    def test_expand_key_order(self, template, tmp_path):
+        """
+        Test that a replicate whose base resource only changed key order is built again.
+        """
+        destination = tmp_path / 'template'
+
+        incremental.expand(copy.deepcopy(template), destination, 'json')
+
+        topic = template['Resources']['Topic']
+        template['Resources']['Topic'] = dict(reversed(list(topic.items())))
+        _, diff = incremental.expand(copy.deepcopy(template), destination, 'json')
+
+        assert diff.changed == ['TopicOne', 'TopicTwo', 'TopicThree']
+        assert destination.read_text() == self.expanded(template, 'json')
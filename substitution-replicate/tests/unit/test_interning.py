@@ -0,0 +1,122 @@
+import copy
+import json
+import operator
+
+from interning import Interner
+from main import expand
+
+
+def role(name):
+    # parsed like the fragments CloudFormation passes, without the shared constants of Python
+    return json.loads(json.dumps({
+        'Type': 'AWS::IAM::Role',
+        'Properties': {
+            'RoleName': name,
+            'AssumeRolePolicyDocument': {
+                'Statement': [
+                    {
+                        'Effect': 'Allow',
+                        'Action': ['sts:AssumeRole'],
+                        'Principal': {'Service': ['states.amazonaws.com']}
+                    }
+                ]
+            },
+            'MaxSessionDuration': 3600
+        }
+    }))
+
+
+class TestInterning:
+    def test_intern(self):
+        """
+        Test that equal leaves and subtrees are shared without changing the tree.
+        """
+        fragment = {'Resources': {'One': role('one'), 'Two': role('two')}}
+        original = copy.deepcopy(fragment)
+        interner = Interner()
+
+        assert interner.intern(fragment) is fragment
+        assert fragment == original
+
+        one, two = (fragment['Resources'][name]['Properties'] for name in ('One', 'Two'))
+
+        assert one['AssumeRolePolicyDocument'] is two['AssumeRolePolicyDocument']
+        assert one is not two
+        assert interner.subtrees_shared == 6
+        assert interner.leaves_shared == 15
+        assert interner.bytes_saved > 0
+
+    def test_intern_across_trees(self):
+        interner = Interner()
+        one = interner.intern(role('one'))
+        two = interner.intern(role('one'))
+
+        assert two is one
+        assert interner.intern('one') is one['Properties']['RoleName']
+
+    def test_intern_types(self):
+        """
+        Test that only values of the same type are shared.
+        """
+        interner = Interner()
+        tree = interner.intern([1, 1.0, True, [1], [1.0], [True]])
+
+        assert [type(value) for value in tree[:3]] == [int, float, bool]
+        assert tree[3] is not tree[4] and tree[3] is not tree[5]
+
+    def test_expand(self):
+        """
+        Test that the replicates of an interned fragment share its keys and literal values.
+        """
+        fragment = {
+            'Mappings': {
+                'roles': {
+                    'one': {'name': 'one'},
+                    'two': {'name': 'two'}
+                }
+            },
+            'Resources': {
+                'Static': role('static'),
+                'Role': dict(role({'Ref': 'repl_name'}), Replicates={'Elements': 'roles'})
+            }
+        }
+        expected = copy.deepcopy(fragment)
+        expand(expected)
+
+        expand(fragment, interner=Interner())
+
+        assert fragment == expected
+
+        resources = fragment['Resources']
+        static = resources['Static']['Properties']['AssumeRolePolicyDocument']
+
+        assert resources['RoleOne']['Properties']['AssumeRolePolicyDocument'] is static
+        assert resources['RoleTwo']['Properties']['AssumeRolePolicyDocument'] is static
+
+    def test_intern_keys(self):
+        """
+        Test that the keys of dictionaries parsed separately are shared, across replicates too.
+        """
+        fragment = {
+            'Mappings': {
+                'roles': {
+                    'one': {'name': 'one'},
+                    'two': {'name': 'two'}
+                }
+            },
+            'Resources': {
+                'Static': role('static'),
+                'Role': dict(role({'Ref': 'repl_name'}), Replicates={'Elements': 'roles'})
+            }
+        }
+        static = fragment['Resources']['Static']
+
+        assert not any(map(operator.is_, static, fragment['Resources']['Role']))
+
+        expand(fragment, interner=Interner())
+
+        for name in ('RoleOne', 'RoleTwo'):
+            replicate = fragment['Resources'][name]
+
+            assert all(map(operator.is_, replicate, static))
+            assert all(map(operator.is_, replicate['Properties'], static['Properties']))
@@ -1,4 +1,17 @@
-from main import lambda_handler
+import concurrent.futures
+import copy
+import json
+import logging
+import os
+import subprocess
+import sys
+
+import pytest
+
+import main
+import profiling
+from main import batch_handler, expand, iter_expand, lambda_handler
+from plan import PlanCache
 
 
 class TestLambda:
@@ -23,7 +36,8 @@ class TestLambda:
                         'BaseStack': {
                             'Type': 'AWS::CloudFormation::Stack',
                             'Replicates': {
-                                'Elements': 'stacks'
+                                'Elements': 'stacks',
+                                'Fold': False
                             },
                             'Properties': {
                                 'TemplateURL': {
@@ -155,15 +169,7 @@ class TestLambda:
                     'BaseStackOne': {
                         'Type': 'AWS::CloudFormation::Stack',
                         'Properties': {
-                            'TemplateURL': {
-                                'Fn::Sub': [
-                                    '${repl_url}-${repl_version}',
-                                    {
-                                        'repl_url': 'production.yml',
-                                        'repl_version': 2
-                                    }
-                                ]
-                            }
+                            'TemplateURL': 'production.yml-2'
                         }
                     },
                     'BaseStackTwo': {
@@ -171,9 +177,8 @@ class TestLambda:
                         'Properties': {
                             'TemplateURL': {
                                 'Fn::Sub': [
-                                    '${repl_url}-${repl_version}',
+                                    'development.yml-${repl_version}',
                                     {
-                                        'repl_url': 'development.yml',
                                         'repl_version': 1
                                     }
                                 ]
@@ -189,3 +194,332 @@ class TestLambda:
                 }
             }
         }
+
+    def test_log_summary(self, caplog, monkeypatch):
+        """
+        Test that only a summary of the fragments is logged in the default logging mode.
+        """
+        monkeypatch.setattr(main, 'PLANS', PlanCache())
+
+        with caplog.at_level(logging.DEBUG):
+            lambda_handler(
+                {
+                    'requestId': 'one',
+                    'fragment': {
+                        'Resources': {
+                            'BaseStack': {
+                                'Type': 'AWS::CloudFormation::Stack',
+                                'Replicates': {
+                                    'Elements': {
+                                        'one': {
+                                            'url': 'production.yml'
+                                        }
+                                    }
+                                },
+                                'Properties': {
+                                    'TemplateURL': {
+                                        'Ref': 'repl_url'
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }, None
+            )
+
+        assert [record.msg for record in caplog.records] == [
+            {
+                'requestId': 'one',
+                'stage': 'input',
+                'resources': 1
+            },
+            {
+                'requestId': 'one',
+                'stage': 'output',
+                'resources': 1,
+                'replicated': {
+                    'BaseStack': 1
+                },
+                'plans': {
+                    'hits': 0,
+                    'misses': 1,
+                    'cached': 1,
+                    'bytes': main.PLANS.bytes
+                }
+            }
+        ]
+
+    def test_log_interning(self, caplog, monkeypatch):
+        """
+        Test that what interning saved is logged at debug level.
+        """
+        monkeypatch.setattr(main, 'INTERN', True)
+        statement = {'Effect': 'Allow', 'Action': 'sqs:SendMessage', 'Resource': '*'}
+
+        with caplog.at_level(logging.DEBUG):
+            lambda_handler({
+                'requestId': 'one',
+                'fragment': json.loads(json.dumps({
+                    'Resources': {
+                        'One': {'Type': 'AWS::IAM::Policy', 'Properties': {'Statement': statement}},
+                        'Two': {'Type': 'AWS::IAM::Policy', 'Properties': {'Statement': statement}}
+                    }
+                }))
+            }, None)
+
+        record = caplog.records[-1]
+
+        assert record.levelno == logging.DEBUG
+        assert record.msg['stage'] == 'interning'
+        assert record.msg['subtreesShared'] == 3
+        assert record.msg['bytesSaved'] > 0
+
+    def test_cold_start_imports(self):
+        """
+        Test that the modules of opt-in features are not imported with the handler.
+        """
+        imported = subprocess.run(
+            [sys.executable, '-c', 'import sys, main; print(*sys.modules)'],
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)),
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.split()
+
+        assert {'interning', 'traversal', 'tracemalloc'}.isdisjoint(imported)
+
+    def test_iter_expand(self):
+        """
+        Test that the lazily expanded resources match the expanded fragment, without modifying
+        the fragment.
+        """
+        fragment = {
+            'Resources': {
+                'BaseStack': {
+                    'Type': 'AWS::CloudFormation::Stack',
+                    'Replicates': {
+                        'Elements': {
+                            'one': {'url': 'production.yml'},
+                            'two': {'url': 'development.yml'}
+                        }
+                    },
+                    'Properties': {
+                        'TemplateURL': {'Ref': 'repl_url'}
+                    }
+                },
+                'OtherStack': {
+                    'Type': 'AWS::CloudFormation::Stack',
+                    'Properties': {
+                        'TemplateURL': 'template.yml'
+                    }
+                }
+            }
+        }
+        original = copy.deepcopy(fragment)
+
+        resources = list(iter_expand(fragment))
+
+        assert fragment == original
+
+        expand(fragment)
+
+        assert resources == list(fragment['Resources'].items())
+
+    def test_batch(self):
+        """
+        Test that a batch of events shares the plans of identical base resources and that a
+        failing event does not affect the others.
+        """
+        def event(request_id, elements):
+            return {
+                'requestId': request_id,
+                'fragment': {
+                    'Resources': {
+                        'BaseStack': {
+                            'Type': 'AWS::CloudFormation::Stack',
+                            'Replicates': {
+                                'Elements': elements
+                            },
+                            'Properties': {
+                                'TemplateURL': {'Ref': 'repl_url'},
+                                'Parameters': {'Static': 'value'}
+                            }
+                        }
+                    }
+                }
+            }
+
+        responses = batch_handler({
+            'events': [
+                event('one', {'one': {'url': 'one.yml'}}),
+                event('two', 'missing'),
+                event('three', {'three': {'url': 'three.yml'}})
+            ]
+        }, None)['responses']
+
+        assert [response['status'] for response in responses] == [
+            'success', 'failure', 'success'
+        ]
+        assert responses[1] == {
+            'requestId': 'two',
+            'status': 'failure',
+            'errorMessage': "KeyError: 'Mappings'"
+        }
+
+        one = responses[0]['fragment']['Resources']['BaseStackOne']
+        three = responses[2]['fragment']['Resources']['BaseStackThree']
+
+        assert one['Properties']['TemplateURL'] == 'one.yml'
+        assert three['Properties']['TemplateURL'] == 'three.yml'
+        assert one['Properties']['Parameters'] is three['Properties']['Parameters']
+
+    def fragment(self, families):
+        return {
+            'Resources': {
+                f'{family}Role': {
+                    'Type': 'AWS::IAM::Role',
+                    'Replicates': {
+                        'Elements': {
+                            element: {'service': f'{family}-{element}'}
+                            for element in ['one', 'two', 'three']
+                        }
+                    },
+                    'Properties': {
+                        'Path': {'Fn::Sub': '/${repl_service}/'}
+                    }
+                }
+                for family in families
+            }
+        }
+
+    @pytest.mark.parametrize('executor_class', [
+        concurrent.futures.ThreadPoolExecutor,
+        concurrent.futures.ProcessPoolExecutor
+    ])
+    def test_expand_executor(self, executor_class):
+        """
+        Test that expanding the replicating resources concurrently gives the fragment expanding
+        them one after the other does, in the same order.
+        """
+        sequential = self.fragment(['Batch', 'Ecs', 'Lambda', 'States'])
+        concurrent_ = copy.deepcopy(sequential)
+
+        replicated = expand(sequential)
+
+        with executor_class(max_workers=2) as executor:
+            assert expand(concurrent_, executor=executor) == replicated
+
+        assert list(concurrent_['Resources'].items()) == list(sequential['Resources'].items())
+
+    def test_expand_collision(self):
+        """
+        Test that a replicate named after another resource is refused instead of replacing it.
+        """
+        fragment = self.fragment(['Ecs'])
+        fragment['Resources']['EcsRoleOne'] = {'Type': 'AWS::IAM::Role'}
+
+        with pytest.raises(ValueError, match='EcsRoleOne, a replicate of EcsRole, has the same '
+                                             'name as an existing resource'):
+            expand(fragment)
+
+        fragment = self.fragment(['Ecs'])
+        fragment['Resources']['EcsRole']['Replicates']['Elements']['one-'] = {}
+
+        with pytest.raises(ValueError, match='as a replicate of EcsRole'):
+            expand(fragment)
+
+        assert 'EcsRole' in fragment['Resources']
+
+    def test_expand_naming(self):
+        """
+        Test that the naming strategy is taken from the Naming key of the Replicates section.
+        """
+        fragment = self.fragment(['Ecs'])
+        fragment['Resources']['EcsRole']['Replicates']['Naming'] = 'hashed'
+        fragment['Resources']['EcsRole']['Replicates']['Elements']['x' * 300] = {}
+
+        expand(fragment)
+
+        assert sorted(map(len, fragment['Resources'])) == [10, 10, 12, 255]
+
+    def test_expand_engine(self):
+        """
+        Test that the iterative engine, selected by the Engine key of the Replicates section,
+        expands like the plan engine.
+        """
+        planned = self.fragment(['Ecs', 'States'])
+        iterative = copy.deepcopy(planned)
+        iterative['Resources']['EcsRole']['Replicates']['Engine'] = 'iterative'
+
+        expand(planned)
+        expand(iterative)
+
+        assert iterative == planned
+
+        unknown = self.fragment(['Ecs'])
+        unknown['Resources']['EcsRole']['Replicates']['Engine'] = 'recursive'
+
+        with pytest.raises(ValueError, match='unknown engine recursive for EcsRole'):
+            expand(unknown)
+
+    def test_profile(self, caplog, monkeypatch):
+        """
+        Test that the profile of an invocation is logged as a single message when profiling is
+        enabled.
+        """
+        monkeypatch.setattr(main, 'PROFILE', True)
+
+        with caplog.at_level(logging.INFO):
+            lambda_handler({'requestId': 'one', 'fragment': self.fragment(['Ecs', 'States'])}, None)
+
+        profile, = [record.msg for record in caplog.records if record.msg['stage'] == 'profile']
+
+        assert profile['requestId'] == 'one'
+        assert [(phase['phase'], phase.get('resource')) for phase in profile['phases']] == [
+            ('parse', None),
+            ('replicate', 'EcsRole'),
+            ('replicate', 'StatesRole'),
+            ('merge', None),
+            ('serialize', None)
+        ]
+        assert profile['phases'][-1]['bytes'] > 0
+        assert all(phase['peakBytes'] >= 0 for phase in profile['phases'])
+        assert profile['maxRssBytes'] > 0
+
+    @pytest.mark.parametrize('engine', ['plan', 'iterative'])
+    @pytest.mark.parametrize('executor_class', [None, concurrent.futures.ThreadPoolExecutor])
+    def test_sites(self, engine, executor_class):
+        """
+        Test that the sites substituted are counted with both engines, sequentially and with an
+        executor.
+        """
+        fragment = self.fragment(['Ecs', 'States'])
+        profile = profiling.Profile(memory=False)
+
+        for resource in fragment['Resources'].values():
+            resource['Replicates']['Engine'] = engine
+
+        if executor_class is None:
+            expand(fragment, profile=profile)
+        else:
+            with executor_class(2) as executor:
+                expand(fragment, executor=executor, profile=profile)
+
+        assert sum(phase.get('sites', 0) for phase in profile.phases) == 6
+
+    def test_metrics(self, capsys):
+        """
+        Test that the metrics of an invocation are written to standard output once.
+        """
+        lambda_handler({'requestId': 'one', 'fragment': self.fragment(['Ecs', 'States'])}, None)
+
+        lines = capsys.readouterr().out.splitlines()
+        record, = [json.loads(line) for line in lines if line.startswith('{"_aws"')]
+        metrics = [metric['Name'] for metric in record['_aws']['CloudWatchMetrics'][0]['Metrics']]
+
+        assert record['Macro'] == main.MACRO_NAME
+        assert record['ReplicatingResources'] == 2
+        assert record['Replicates'] == 6
+        assert record['ReplicatesPerResource'] == [3, 3]
+        assert record['SitesSubstituted'] == 6
+        assert {'ParseLatency', 'ReplicateLatency', 'MergeLatency'} <= set(metrics)
@@ -0,0 +1,112 @@
+import decimal
+import json
+import logging
+import sys
+
+import pytest
+
+from logger import MAX_VALUES, FastJsonFormatter, JsonFormatter, Metrics
+
+
+class TestFastJsonFormatter:
+    def record(self, message, args=()):
+        return logging.LogRecord('root', logging.INFO, __file__, 0, message, args, None)
+
+    @pytest.mark.parametrize('message,args', [
+        ('plain %s', ('text',)),
+        ('{"embedded": ["json"]}', ()),
+        ({'Resources': {'Role': {'Type': 'AWS::IAM::Role'}}}, ()),
+        ([decimal.Decimal('1.5'), decimal.Decimal('2')], ())
+    ])
+    def test_format(self, message, args):
+        """
+        Test that the fast formatter logs the same fields as the reference formatter.
+        """
+        record = self.record(message, args)
+
+        expected = json.loads(JsonFormatter().format(record))
+        result = json.loads(FastJsonFormatter().format(record))
+
+        assert result == expected
+
+    def test_format_custom_fields(self):
+        formatter = FastJsonFormatter(
+            function='%(funcName)s', location='%(filename)s:%(lineno)d', name=None
+        )
+
+        result = json.loads(formatter.format(self.record('message')))
+
+        assert result['function'] == 'None'
+        assert result['location'] == 'test_logger.py:0'
+        assert 'name' not in result
+
+    def test_format_exception(self):
+        try:
+            raise ValueError('failure')
+        except ValueError:
+            record = logging.LogRecord(
+                'root', logging.ERROR, __file__, 0, 'message', (), sys.exc_info()
+            )
+
+        result = json.loads(FastJsonFormatter().format(record))
+
+        assert 'ValueError: failure' in result['exception']
+
+
+class TestMetrics:
+    def records(self, capsys):
+        return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+    def test_flush(self, capsys):
+        """
+        Test that buffered metrics are written as a single embedded metric format record.
+        """
+        metrics = Metrics('Macros')
+        metrics.put('Replicates', 3)
+        metrics.put('ReplicatesPerResource', 1)
+        metrics.put('ReplicatesPerResource', 2)
+        metrics.put('ExpandLatency', 1.5, 'Milliseconds')
+
+        metrics.flush(Macro='SubReplicate')
+
+        record, = self.records(capsys)
+
+        assert record['_aws']['CloudWatchMetrics'] == [{
+            'Namespace': 'Macros',
+            'Dimensions': [['Macro']],
+            'Metrics': [
+                {'Name': 'Replicates', 'Unit': 'Count'},
+                {'Name': 'ReplicatesPerResource', 'Unit': 'Count'},
+                {'Name': 'ExpandLatency', 'Unit': 'Milliseconds'}
+            ]
+        }]
+        assert record['Macro'] == 'SubReplicate'
+        assert record['Replicates'] == 3
+        assert record['ReplicatesPerResource'] == [1, 2]
+        assert record['ExpandLatency'] == 1.5
+
+        metrics.flush(Macro='SubReplicate')
+
+        assert self.records(capsys) == []
+
+    def test_flush_limits(self, capsys):
+        """
+        Test that metrics with more values than a record holds are split over records.
+        """
+        metrics = Metrics()
+        metrics.put('Replicates', 1)
+
+        for i in range(MAX_VALUES + 1):
+            metrics.put('ReplicatesPerResource', i)
+
+        metrics.flush()
+
+        first, second = self.records(capsys)
+
+        assert first['Replicates'] == 1
+        assert first['ReplicatesPerResource'] == list(range(MAX_VALUES))
+        assert 'Replicates' not in second
+        assert second['ReplicatesPerResource'] == MAX_VALUES
+        assert second['_aws']['CloudWatchMetrics'][0]['Metrics'] == [
+            {'Name': 'ReplicatesPerResource', 'Unit': 'Count'}
+        ]
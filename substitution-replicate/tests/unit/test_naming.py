@@ -0,0 +1,45 @@
+import pytest
+
+from naming import MAX_LENGTH, NamingError, camel, hashed, name_table, strategy
+
+
+class TestNaming:
+    def test_camel(self):
+        assert camel('BaseResource', 'resource_one-two') == 'BaseResourceResourceOneTwo'
+
+    def test_hashed(self):
+        """
+        Test that names too long for a logical ID are cut short with a suffix that keeps them
+        apart.
+        """
+        one = hashed('Base', 'x' * 300)
+        two = hashed('Base', 'x' * 301)
+
+        assert hashed('Base', 'one') == 'BaseOne'
+        assert len(one) == len(two) == MAX_LENGTH
+        assert one != two
+
+    def test_strategy(self):
+        assert strategy('hashed') is hashed
+
+        with pytest.raises(NamingError, match='unknown naming strategy snake'):
+            strategy('snake')
+
+    def test_name_table(self):
+        assert name_table('Role', ['one', 'two'], taken={'Other': None}) == {
+            'one': 'RoleOne',
+            'two': 'RoleTwo'
+        }
+
+    @pytest.mark.parametrize('replication_names, taken, message', [
+        (['one.two'], {}, 'RoleOne.two, a replicate of Role, is not alphanumeric'),
+        (['one\n'], {}, 'a replicate of Role, is not alphanumeric'),
+        (['x' * 300], {}, 'is longer than 255 characters'),
+        (['foo-bar', 'foo_bar'], {}, 'RoleFooBar, a replicate of Role, has the same name as a '
+                                     'replicate of Role'),
+        (['one'], {'RoleOne': None}, 'has the same name as an existing resource'),
+        (['one'], {'RoleOne': 'Role2'}, 'has the same name as a replicate of Role2')
+    ])
+    def test_name_table_invalid(self, replication_names, taken, message):
+        with pytest.raises(NamingError, match=message):
+            name_table('Role', replication_names, taken=taken)
@@ -0,0 +1,340 @@
+import copy
+
+import pytest
+
+from plan import Memo, PlanCache, ReplicationPlan
+
+
+class TestReplicationPlan:
+    @pytest.fixture
+    def base(self):
+        return {
+            'Type': 'AWS::IAM::Role',
+            'Properties': {
+                'Description': {
+                    'Ref': 'repl_description'
+                },
+                'AssumeRolePolicyDocument': {
+                    'Version': '2012-10-17',
+                    'Statement': [
+                        {
+                            'Effect': 'Allow',
+                            'Action': [
+                                'sts:AssumeRole'
+                            ],
+                            'Principal': {
+                                'Service': [
+                                    {
+                                        'Fn::Sub': '${repl_service}.amazonaws.com'
+                                    }
+                                ]
+                            }
+                        }
+                    ]
+                },
+                'Path': {
+                    'Fn::Sub': '/${AWS::StackName}/'
+                }
+            }
+        }
+
+    def test_sites(self, base):
+        """
+        Test that only Fn::Sub and Ref sites mentioning replication variables are recorded.
+        """
+        plan = ReplicationPlan(base)
+
+        assert plan.sites == [
+            ('Properties', 'Description'),
+            ('Properties', 'AssumeRolePolicyDocument', 'Statement', 0, 'Principal', 'Service', 0,
+             'Fn::Sub')
+        ]
+
+    def test_build(self, base):
+        plan = ReplicationPlan(base, fold=False)
+
+        resource = plan.build({'service': 'states'})
+
+        assert resource == {
+            'Type': 'AWS::IAM::Role',
+            'Properties': {
+                'Description': {
+                    'Ref': 'AWS::NoValue'
+                },
+                'AssumeRolePolicyDocument': {
+                    'Version': '2012-10-17',
+                    'Statement': [
+                        {
+                            'Effect': 'Allow',
+                            'Action': [
+                                'sts:AssumeRole'
+                            ],
+                            'Principal': {
+                                'Service': [
+                                    {
+                                        'Fn::Sub': [
+                                            '${repl_service}.amazonaws.com',
+                                            {
+                                                'repl_service': 'states'
+                                            }
+                                        ]
+                                    }
+                                ]
+                            }
+                        }
+                    ]
+                },
+                'Path': {
+                    'Fn::Sub': [
+                        '/${AWS::StackName}/',
+                        {}
+                    ]
+                }
+            }
+        }
+
+    def test_build_fold(self, base):
+        """
+        Test that Fn::Sub functions are folded as far as the replication variables have values.
+        """
+        plan = ReplicationPlan({
+            'Resolved': {
+                'Fn::Sub': '${repl_service}.${!Literal}'
+            },
+            'Partial': {
+                'Fn::Sub': [
+                    '${repl_service}-${AWS::Region}-${variable}-${repl_flag}',
+                    {
+                        'variable': {
+                            'Ref': 'Parameter'
+                        }
+                    }
+                ]
+            },
+            'Unresolved': {
+                'Fn::Sub': '${repl_missing}-${AWS::Region}'
+            }
+        })
+
+        assert plan.build({'service': 'states', 'flag': True}) == {
+            'Resolved': 'states.${Literal}',
+            'Partial': {
+                'Fn::Sub': [
+                    'states-${AWS::Region}-${variable}-${repl_flag}',
+                    {
+                        'variable': {
+                            'Ref': 'Parameter'
+                        },
+                        'repl_flag': True
+                    }
+                ]
+            },
+            'Unresolved': {
+                'Fn::Sub': ['${repl_missing}-${AWS::Region}', {}]
+            }
+        }
+        assert plan.build({'service': '${AWS::Region}', 'flag': 'on'})['Partial'] == {
+            'Fn::Sub': [
+                '${!AWS::Region}-${AWS::Region}-${variable}-on',
+                {
+                    'variable': {
+                        'Ref': 'Parameter'
+                    }
+                }
+            ]
+        }
+
+    def test_build_shares_static_subtrees(self, base):
+        """
+        Test that subtrees without replication sites are shared between replicates, while the
+        base resource itself is left untouched.
+        """
+        original = copy.deepcopy(base)
+        plan = ReplicationPlan(base)
+
+        one = plan.build({'service': 'states', 'description': 'one'})
+        two = plan.build({'service': 'ecs', 'description': 'two'})
+
+        statement_one = one['Properties']['AssumeRolePolicyDocument']['Statement'][0]
+        statement_two = two['Properties']['AssumeRolePolicyDocument']['Statement'][0]
+
+        assert one['Properties']['Description'] == 'one'
+        assert two['Properties']['Description'] == 'two'
+        assert statement_one is not statement_two
+        assert statement_one['Action'] is statement_two['Action']
+        assert one['Properties']['Path'] is two['Properties']['Path']
+        assert base == original
+
+    def test_build_nested(self):
+        """
+        Test that replication sites inside the variable map of a Fn::Sub function are built.
+        """
+        plan = ReplicationPlan({
+            'Fn::Sub': [
+                '${repl_variable1}-${variable2}',
+                {
+                    'variable2': {
+                        'Ref': 'repl_variable2'
+                    }
+                }
+            ]
+        }, fold=False)
+
+        assert plan.build({'variable1': 'foo', 'variable2': 'bar'}) == {
+            'Fn::Sub': [
+                '${repl_variable1}-${variable2}',
+                {
+                    'repl_variable1': 'foo',
+                    'variable2': 'bar'
+                }
+            ]
+        }
+
+    def test_build_reference_siblings(self):
+        """
+        Test that the other entries of a Ref to a replication variable without a value are
+        built, like by Substitutor.traverse.
+        """
+        plan = ReplicationPlan({
+            'Ref': 'repl_missing',
+            'Name': {
+                'Fn::Sub': '${repl_name}'
+            }
+        }, fold=False)
+
+        assert plan.build({'name': 'one'}) == {
+            'Ref': 'AWS::NoValue',
+            'Name': {
+                'Fn::Sub': ['${repl_name}', {'repl_name': 'one'}]
+            }
+        }
+        assert plan.build({'missing': 'value', 'name': 'one'}) == 'value'
+
+    def test_build_memo(self, base):
+        """
+        Test that subtrees whose replication variables resolve identically are shared between
+        replicates built with the same Memo.
+        """
+        plan = ReplicationPlan(base)
+        memo = Memo()
+
+        one = plan.build({'service': 'states', 'description': 'one'}, memo)
+        two = plan.build({'service': 'states', 'description': 'two'}, memo)
+        three = plan.build({'service': 'states', 'description': 'one'}, memo)
+
+        assert one is three
+        assert one is not two
+        assert one['Properties']['Description'] == 'one'
+        assert two['Properties']['Description'] == 'two'
+        assert (
+            one['Properties']['AssumeRolePolicyDocument'] is
+            two['Properties']['AssumeRolePolicyDocument']
+        )
+
+    def test_resolve(self, base):
+        """
+        Test that the table holds the variables the base resource refers to, taken from the
+        substitutions before the defaults.
+        """
+        plan = ReplicationPlan(base)
+
+        assert plan.resolve(
+            {'service': 'states', 'unused': 'value'},
+            {'service': 'ecs', 'description': 'default'}
+        ) == {
+            'service': 'states',
+            'description': 'default'
+        }
+        assert plan.resolve({}) == {}
+
+    @pytest.mark.parametrize('values', [
+        (1, True),
+        (1, 1.0),
+        ({'a': 1}, {'a': 2})
+    ])
+    def test_build_memo_distinct_values(self, values):
+        """
+        Test that equal values of different types and unhashable values are not mixed up.
+        """
+        plan = ReplicationPlan({'Properties': {'Fn::Sub': '${repl_value}'}}, fold=False)
+        memo = Memo()
+
+        results = [plan.build({'value': value}, memo) for value in values]
+
+        assert [result['Properties']['Fn::Sub'][1]['repl_value'] for result in results] == list(
+            values
+        )
+        assert [type(result['Properties']['Fn::Sub'][1]['repl_value']) for result in results] == [
+            type(value) for value in values
+        ]
+
+
+class TestPlanCache:
+    def resource(self, name):
+        return {'Type': 'AWS::SNS::Topic', 'Properties': {'TopicName': {'Fn::Sub': name}}}
+
+    def test_plan(self):
+        """
+        Test that equal base resources share a plan.
+        """
+        cache = PlanCache()
+        resource = self.resource('${repl_name}')
+
+        plan = cache.plan(resource)
+
+        assert cache.plan(copy.deepcopy(resource)) is plan
+        assert cache.plan(self.resource('${repl_other}')) is not plan
+        assert cache.stats() == {
+            'hits': 1,
+            'misses': 2,
+            'evictions': 0,
+            'entries': 2,
+            'bytes': cache.bytes
+        }
+
+    def test_plan_key_order(self):
+        """
+        Test that replicates keep the key order of their base resource, whichever base resource
+        in another key order was compiled first.
+        """
+        cache = PlanCache()
+        resource = self.resource('${repl_name}')
+        reordered = dict(reversed(list(resource.items())))
+
+        one = cache.plan(resource).build({'name': 'one'})
+        two = cache.plan(reordered).build({'name': 'one'})
+
+        assert one == two
+        assert list(one) == ['Type', 'Properties']
+        assert list(two) == ['Properties', 'Type']
+
+    def test_evict_entries(self):
+        """
+        Test that the least recently used plan is evicted first.
+        """
+        cache = PlanCache(max_entries=2)
+
+        one = cache.plan(self.resource('one'))
+        cache.plan(self.resource('two'))
+        cache.plan(self.resource('one'))
+        cache.plan(self.resource('three'))
+
+        assert cache.evictions == 1
+        assert cache.plan(self.resource('one')) is one
+        assert cache.misses == 3
+
+    def test_evict_bytes(self):
+        _, size = PlanCache.key(self.resource('one'))
+        cache = PlanCache(max_bytes=size + 1)
+
+        cache.plan(self.resource('one'))
+        cache.plan(self.resource('two'))
+
+        assert len(cache) == 1
+        assert cache.bytes == size
+        assert cache.evictions == 1
+
+        cache.plan(self.resource('a resource too large to be cached'))
+
+        assert len(cache) == 1
+
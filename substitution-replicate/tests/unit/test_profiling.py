@@ -0,0 +1,53 @@
+import tracemalloc
+
+import pytest
+
+from profiling import Profile
+
+
+class TestProfile:
+    @pytest.fixture(params=[True, False], ids=['reset_peak', 'restart'])
+    def profile(self, request, monkeypatch):
+        if not request.param:
+            # Python 3.8 and before
+            monkeypatch.delattr(tracemalloc, 'reset_peak', raising=False)
+
+        profile = Profile()
+        yield profile
+        profile.stop()
+
+    def test_phase_peak(self, profile):
+        """
+        Test that the peak of a phase does not include the peaks of the phases before it.
+        """
+        with profile.phase('large'):
+            large = bytearray(2 ** 22)
+            del large
+
+        with profile.phase('small'):
+            small = bytearray(2 ** 10)
+            del small
+
+        large, small = profile.phases
+
+        assert large['peakBytes'] >= 2 ** 22
+        assert small['peakBytes'] < 2 ** 20
+        assert profile.peak >= 2 ** 22
+
+    def test_phase_peak_tracing(self, monkeypatch):
+        """
+        Test that without reset_peak the peak is left out if tracing was started by someone else.
+        """
+        monkeypatch.delattr(tracemalloc, 'reset_peak', raising=False)
+        tracemalloc.start()
+
+        try:
+            profile = Profile()
+
+            with profile.phase('one'):
+                pass
+        finally:
+            tracemalloc.stop()
+
+        assert 'peakBytes' not in profile.phases[0]
+        assert 'allocatedBytes' in profile.phases[0]
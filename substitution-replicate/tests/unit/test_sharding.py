@@ -0,0 +1,256 @@
+import copy
+import json
+import logging
+import sys
+
+import pytest
+
+import sharding
+import stream
+from main import expand, replicating_resources
+from sharding import (
+    MAX_RESOURCES, MAX_TEMPLATE_BYTES, Estimate, LimitError, ShardingError, check, estimate,
+    references, shard, size
+)
+
+
+def fragment(count):
+    return {
+        'Parameters': {
+            'Environment': {
+                'Type': 'String'
+            },
+            'Subnets': {
+                'Type': 'List<AWS::EC2::Subnet::Id>'
+            }
+        },
+        'Mappings': {
+            'queues': {
+                f'queue-{i}': {'suffix': f'{i:04}'} for i in range(count)
+            }
+        },
+        'Resources': {
+            'Topic': {
+                'Type': 'AWS::SNS::Topic'
+            },
+            'Queue': {
+                'Type': 'AWS::SQS::Queue',
+                'Replicates': {
+                    'Elements': 'queues',
+                    'Defaults': {
+                        'retention': 345600
+                    }
+                },
+                'Properties': {
+                    'QueueName': {
+                        'Fn::Sub': '${Environment}-${repl_suffix}'
+                    },
+                    'MessageRetentionPeriod': {
+                        'Ref': 'repl_retention'
+                    }
+                }
+            }
+        }
+    }
+
+
+def replicate_names(template):
+    return {
+        name for task in replicating_resources(template) for name in task.names.values()
+    }
+
+
+class TestSharding:
+    @pytest.mark.parametrize('fold', [True, False])
+    def test_estimate(self, fold):
+        """
+        Test that the resources are counted and the size is estimated exactly, with and without
+        folding.
+        """
+        template = fragment(100)
+        template['Mappings']['queues']['queue-0']['delay'] = {'Ref': 'Delay'}
+        queue = template['Resources']['Queue']
+        queue['Replicates']['Fold'] = fold
+        queue['Properties'].update({
+            'DelaySeconds': {'Ref': 'repl_delay'},
+            'Tags': [
+                {'Key': 'path', 'Value': {'Fn::Sub': '/${AWS::StackName}/${!Literal}/'}},
+                {'Key': 'suffix', 'Value': {'Fn::Sub': '${repl_suffix}.${!Literal}'}},
+                {'Key': 'delay', 'Value': {'Fn::Sub': ['${repl_delay}-${x}', {'x': 'y'}]}},
+                {'Key': 'other', 'Value': {'Fn::Sub': '${repl_suffix}', 'Other': 1}}
+            ]
+        })
+        result = estimate(template, replicating_resources(template))
+
+        expand(template)
+
+        assert result == Estimate(101, size(template))
+
+    def test_estimate_folded(self):
+        """
+        Test that functions folded to a string are estimated as such.
+        """
+        template = fragment(50)
+        template['Resources']['Queue']['Properties'] = {
+            f'Property{i}': {'Fn::Sub': '${repl_suffix}' * 200} for i in range(12)
+        }
+        result = estimate(template, replicating_resources(template))
+
+        expand(template)
+
+        assert result.bytes == size(template)
+
+    def test_size_deep(self):
+        """
+        Test that trees too deep for the json module are measured like it would.
+        """
+        deep = leaf = {}
+
+        for i in range(1500):
+            leaf['Nested'] = [{}, i, {1: True}, 'é']
+            leaf = leaf['Nested'][0]
+
+        result = size(deep)
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(10000)
+
+        try:
+            assert result == len(json.dumps(deep, separators=(',', ':')))
+        finally:
+            sys.setrecursionlimit(limit)
+
+    def test_check(self):
+        assert check(Estimate(MAX_RESOURCES, 1000)) is None
+        assert check(Estimate(MAX_RESOURCES, None)) is None
+        assert check(Estimate(MAX_RESOURCES, MAX_TEMPLATE_BYTES + 1)) == (
+            'the expanded template is estimated at 1048577 bytes, more than the 1048576 allowed'
+        )
+
+        with pytest.raises(LimitError, match='501 resources, more than the 500 allowed'):
+            check(Estimate(MAX_RESOURCES + 1, 1000))
+
+    def test_expand_limit(self):
+        """
+        Test that an oversized expansion fails before any replicate is built.
+        """
+        template = fragment(MAX_RESOURCES)
+        original = copy.deepcopy(template)
+
+        with pytest.raises(LimitError):
+            expand(template, limit=True)
+
+        assert template == original
+
+    def test_expand_size(self, caplog):
+        """
+        Test that an expansion estimated to be too large is warned about, not failed.
+        """
+        template = fragment(120)
+        template['Resources']['Queue']['Properties'] = {
+            f'Property{i}': {'Fn::Sub': '${repl_suffix}' * 200} for i in range(12)
+        }
+
+        with caplog.at_level(logging.WARNING):
+            expand(template, limit=True, estimate=True)
+
+        assert size(template) > MAX_TEMPLATE_BYTES
+        assert [record.msg['stage'] for record in caplog.records] == ['limits']
+
+    def test_expand_count(self, monkeypatch):
+        """
+        Test that only the resources are counted unless the size is to be estimated.
+        """
+        monkeypatch.setattr(sharding, 'estimate', None)
+        template = fragment(MAX_RESOURCES - 1)
+
+        assert expand(copy.deepcopy(template), limit=True) == {'Queue': MAX_RESOURCES - 1}
+
+        template['Mappings']['queues']['one-more'] = {'suffix': 'x'}
+
+        with pytest.raises(LimitError, match='501 resources'):
+            expand(template, limit=True)
+
+    def test_references(self):
+        assert references({
+            'A': {'Ref': 'Parameter'},
+            'B': {'Fn::GetAtt': ['Resource', 'Arn']},
+            'C': {'Fn::Sub': ['${Other.Arn}-${variable}-${AWS::Region}', {'variable': 'x'}]},
+            'D': {'Fn::FindInMap': ['map', 'key', 'value']},
+            'E': {'Fn::If': ['IsProduction', 1, 2]}
+        }) == ({'Parameter', 'Resource', 'Other', 'IsProduction'}, {'map'})
+
+    def test_shard(self):
+        """
+        Test that replicates are packed into nested stacks that get the parameters they need.
+        """
+        template = fragment(1200)
+        names = replicate_names(template)
+        expand(template)
+
+        parent, shards = shard(template, names, lambda index: f'shard{index}.json')
+
+        assert list(parent['Resources']) == [
+            'Topic', 'ReplicatesShard1', 'ReplicatesShard2', 'ReplicatesShard3'
+        ]
+        assert parent['Resources']['ReplicatesShard2'] == {
+            'Type': 'AWS::CloudFormation::Stack',
+            'Properties': {
+                'TemplateURL': 'shard2.json',
+                'Parameters': {
+                    'Environment': {
+                        'Ref': 'Environment'
+                    }
+                }
+            }
+        }
+        assert [len(nested['Resources']) for nested in shards] == [500, 500, 200]
+        assert shards[0]['Parameters'] == {'Environment': {'Type': 'String'}}
+        assert 'Mappings' not in shards[0]
+        assert list(shards[2]['Resources'])[-1] == 'QueueQueue1199'
+
+    def test_shard_bytes(self):
+        """
+        Test that nested stacks are kept within the given size.
+        """
+        template = fragment(100)
+        names = replicate_names(template)
+        expand(template)
+
+        _, shards = shard(template, names, str, max_bytes=4000)
+
+        assert len(shards) > 1
+        assert all(size(nested) <= 4000 for nested in shards)
+
+    @pytest.mark.parametrize('dump', [stream.dump_json, stream.dump_yaml])
+    def test_shard_dump(self, dump):
+        """
+        Test that nested stacks are kept within the given size as they are written.
+        """
+        template = fragment(100)
+        names = replicate_names(template)
+        expand(template)
+
+        _, shards = shard(template, names, str, max_bytes=8000, dump=dump)
+        sizes = [len(dump(nested).encode('utf-8')) for nested in shards]
+
+        assert len(shards) > 1
+        assert all(written <= 8000 for written in sizes)
+        assert all(written > 7000 for written in sizes[:-1])
+
+    def test_shard_references(self):
+        """
+        Test that replicates referring to resources, or referred to, are not moved.
+        """
+        template = fragment(2)
+        template['Resources']['Queue']['Properties']['Topic'] = {'Ref': 'Topic'}
+        template['Outputs'] = {'Queue': {'Value': {'Ref': 'QueueQueue0'}}}
+        names = replicate_names(template)
+        expand(template)
+
+        with pytest.raises(ShardingError) as error:
+            shard(template, names, str)
+
+        assert str(error.value) == (
+            'cannot move replicates into nested stacks: QueueQueue0 refers to Topic; '
+            'QueueQueue1 refers to Topic; the output Queue refers to the replicate QueueQueue0'
+        )
@@ -0,0 +1,95 @@
+import pytest
+
+import sources
+from sources import Includes, SourceError
+
+
+def include(location):
+    return {
+        'Fn::Transform': {
+            'Name': 'AWS::Include',
+            'Parameters': {
+                'Location': location
+            }
+        }
+    }
+
+
+class TestIncludes:
+    @pytest.fixture
+    def s3(self, tmp_path):
+        bucket = tmp_path / 's3' / 'bucket'
+        bucket.mkdir(parents=True)
+        (bucket / 'versions.yml').write_text('one:\n  version: 1\ntwo:\n  version: !Ref Version\n')
+
+        return tmp_path / 's3'
+
+    @pytest.mark.parametrize('location', [
+        's3://bucket/config/versions.yml',
+        'https://bucket.s3.amazonaws.com/config/versions.yml',
+        'https://bucket.s3.eu-west-1.amazonaws.com/config/versions.yml',
+        'https://s3.eu-west-1.amazonaws.com/bucket/config/versions.yml'
+    ])
+    def test_path(self, tmp_path, location):
+        includes = Includes(tmp_path, tmp_path / 's3')
+
+        assert includes.path(location) == tmp_path / 's3' / 'bucket' / 'config' / 'versions.yml'
+        assert includes.path('_build/versions.yml') == tmp_path / '_build' / 'versions.yml'
+
+    def test_path_unsupported(self, tmp_path):
+        with pytest.raises(SourceError, match='without a local stand-in for S3'):
+            Includes(tmp_path).path('s3://bucket/versions.yml')
+
+        with pytest.raises(SourceError, match='only S3 and local files'):
+            Includes(tmp_path).path('https://example.com/versions.yml')
+
+    def test_resolve(self, s3):
+        """
+        Test that includes are replaced by the included document, which is parsed once however
+        often it is included, and merged with the keys next to them.
+        """
+        includes = Includes(s3, s3)
+        template = {
+            'Resources': {
+                'One': {'Replicates': {'Elements': include('s3://bucket/versions.yml')}},
+                'Two': {'Replicates': {'Elements': include('bucket/versions.yml')}},
+                'Three': {'Replicates': {
+                    'Elements': dict(include('bucket/versions.yml'), three={'version': 3})
+                }}
+            }
+        }
+
+        resolved = includes.resolve(template)
+        elements = [
+            resource['Replicates']['Elements'] for resource in resolved['Resources'].values()
+        ]
+
+        assert elements[0] == elements[1] == {
+            'one': {'version': 1},
+            'two': {'version': {'Ref': 'Version'}}
+        }
+        assert elements[0] is not elements[1]
+        assert list(elements[2]) == ['three', 'one', 'two']
+        assert (includes.reads, includes.parses) == (1, 1)
+        assert template['Resources']['One']['Replicates']['Elements'] == include(
+            's3://bucket/versions.yml'
+        )
+
+    def test_cache(self, s3, tmp_path, monkeypatch):
+        """
+        Test that parsed documents are taken from the disk cache, and that large files are read
+        memory mapped.
+        """
+        monkeypatch.setattr(sources, 'MMAP_THRESHOLD', 1)
+        template = include('s3://bucket/versions.yml')
+
+        first = Includes(tmp_path, s3, tmp_path / 'cache')
+        second = Includes(tmp_path, s3, tmp_path / 'cache')
+
+        assert first.resolve(template) == second.resolve(template)
+        assert (first.parses, second.parses) == (1, 0)
+        assert len(list((tmp_path / 'cache').rglob('*.json'))) == 1
+
+    def test_missing(self, tmp_path):
+        with pytest.raises(SourceError, match='does not exist'):
+            Includes(tmp_path).resolve(include('versions.yml'))
@@ -1,3 +1,5 @@
+import copy
+
 import pytest
 
 from main import Substitutor
@@ -179,9 +181,12 @@ class TestSubstitutor:
 
         obj = Substitutor('Base', base)
 
-        obj.traverse(replications['resource_one'], base)
+        result = obj.traverse(replications['resource_one'], base)
 
-        assert base == {
+        assert base['Properties']['Property1'] == {
+            'Fn::Sub': '${repl_variable1}-${repl_variable2}'
+        }
+        assert result == {
             'Type': 'AWS::Service::Resource',
             'Properties': {
                 'Property1': {
@@ -211,7 +216,7 @@ class TestSubstitutor:
             }
         }
 
-        obj = Substitutor('Base', base)
+        obj = Substitutor('Base', base, fold=False)
 
         resources = obj.process(replications)
 
@@ -245,3 +250,165 @@ class TestSubstitutor:
                 }
             }
         }
+
+    def test_process_fold(self, replications):
+        """
+        Test that Fn::Sub functions resolved by replication variables are folded into strings.
+        """
+        base = {
+            'Type': 'AWS::Service::Resource',
+            'Properties': {
+                'Property1': {
+                    'Fn::Sub': '${repl_variable1}-${repl_variable2}'
+                }
+            }
+        }
+
+        obj = Substitutor('Base', base)
+
+        assert obj.process(replications) == {
+            'BaseResourceOne': {
+                'Type': 'AWS::Service::Resource',
+                'Properties': {
+                    'Property1': 'foo-bar'
+                }
+            },
+            'BaseResourceTwo': {
+                'Type': 'AWS::Service::Resource',
+                'Properties': {
+                    'Property1': 'fuu-bor'
+                }
+            }
+        }
+
+    def test_substitute_supplied_reference(self, replications):
+        """
+        Test that a Ref to a replication variable in the variable map is replaced by its value.
+        """
+        obj = Substitutor('Base', None)
+
+        result = obj.substitute(replications['resource_one'], [
+            '${repl_variable1}-${variable3}',
+            {
+                'variable3': {
+                    'Ref': 'repl_variable2'
+                }
+            }
+        ])
+
+        assert result == [
+            '${repl_variable1}-${variable3}',
+            {
+                'variable3': 'bar',
+                'repl_variable1': 'foo'
+            }
+        ]
+
+    def test_process_leaves_base_untouched(self):
+        """
+        Test that the base resource is left untouched by building many replicates from it, with
+        both the compiled plan and traverse.
+        """
+        base = {
+            'Type': 'AWS::Service::Resource',
+            'Properties': {
+                'Property1': {
+                    'Fn::Sub': [
+                        '${repl_variable1}-${variable2}',
+                        {
+                            'variable2': {
+                                'Ref': 'repl_variable2'
+                            }
+                        }
+                    ]
+                },
+                'Property2': {
+                    'Fn::Sub': '${repl_variable1}'
+                },
+                'Property3': [
+                    {
+                        'Ref': 'repl_variable3'
+                    },
+                    'static'
+                ]
+            }
+        }
+        original = copy.deepcopy(base)
+        replicates = {
+            f'replicate_{i}': {'variable1': f'one-{i}', 'variable2': i % 7}
+            for i in range(1000)
+        }
+
+        obj = Substitutor('Base', base)
+        resources = obj.process(replicates)
+
+        for substitutions in replicates.values():
+            obj.traverse(substitutions, base)
+
+        assert base == original
+        assert len(resources) == 1000
+        assert resources['BaseReplicate999']['Properties'] == {
+            'Property1': {
+                'Fn::Sub': ['one-999-${variable2}', {'variable2': 5}]
+            },
+            'Property2': 'one-999',
+            'Property3': [
+                {
+                    'Ref': 'AWS::NoValue'
+                },
+                'static'
+            ]
+        }
+
+    def test_traverse_static(self, replications):
+        """
+        Test that subtrees without replication variables or Fn::Sub functions are skipped.
+        """
+        static = {
+            'Effect': 'Allow',
+            'Action': ['sts:AssumeRole']
+        }
+        base = {
+            'Type': 'AWS::Service::Resource',
+            'Properties': {
+                'Property1': {
+                    'Ref': 'repl_variable1'
+                },
+                'Property2': static
+            }
+        }
+
+        obj = Substitutor('Base', base)
+
+        assert obj.is_static(static)
+        assert not obj.is_static(base)
+
+        result = obj.traverse(replications['resource_one'], base)
+
+        assert result['Properties']['Property1'] == 'foo'
+        assert result['Properties']['Property2'] is static
+
+    def test_missing(self, replications):
+        """
+        Test that replicates without a value or default for a referenced replication variable are
+        reported.
+        """
+        base = {
+            'Type': 'AWS::Service::Resource',
+            'Properties': {
+                'Property1': {
+                    'Fn::Sub': '${repl_variable1}-${repl_variable3}'
+                },
+                'Property2': {
+                    'Ref': 'repl_variable4'
+                }
+            }
+        }
+
+        obj = Substitutor('Base', base, {'variable4': 'default'})
+
+        assert obj.variables == {'variable1', 'variable3', 'variable4'}
+        assert obj.missing(replications) == {
+            'resource_one': ['variable3'],
+            'resource_two': ['variable3']
+        }
@@ -0,0 +1,170 @@
+import copy
+
+import pytest
+
+from main import Substitutor, lambda_handler
+from plan import ReplicationPlan
+from traversal import analyse, traverse
+
+
+BASE = {
+    'Type': 'AWS::IAM::Role',
+    'Properties': {
+        'Description': {
+            'Ref': 'repl_description'
+        },
+        'RoleName': {
+            'Fn::Sub': [
+                '${repl_service}-${AWS::Region}-${suffix}',
+                {
+                    'suffix': {
+                        'Ref': 'repl_suffix'
+                    },
+                    'repl_service': 'overwritten'
+                }
+            ]
+        },
+        'AssumeRolePolicyDocument': {
+            'Statement': [
+                {
+                    'Effect': 'Allow',
+                    'Action': ['sts:AssumeRole'],
+                    'Principal': {
+                        'Service': [{'Fn::Sub': '${repl_service}.amazonaws.com'}]
+                    }
+                }
+            ]
+        },
+        'Path': {
+            'Fn::Sub': '/${AWS::StackName}/'
+        },
+        'Tags': [
+            {'Key': 'flag', 'Value': {'Fn::Sub': '${repl_flag}'}},
+            {'Key': 'static', 'Value': 'static'}
+        ]
+    }
+}
+
+VARIABLES = [
+    {'service': 'states', 'description': 'one', 'suffix': 'a', 'flag': True},
+    {'service': 'ecs', 'suffix': {'Ref': 'Suffix'}},
+    {}
+]
+
+
+class TestTraversal:
+    def test_analyse(self):
+        statement = {
+            'Effect': 'Allow',
+            'Action': ['sts:AssumeRole']
+        }
+        path = {
+            'Fn::Sub': ['/${AWS::StackName}/${path}', {'path': {'Ref': 'repl_path'}}]
+        }
+        properties = {
+            'Statement': [statement],
+            'Description': {'Fn::Sub': '${AWS::Region}'},
+            'Path': path
+        }
+
+        dynamic, replicating, static, sites = analyse(properties)
+
+        assert static == {id(properties['Statement']), id(statement), id(statement['Action'])}
+        assert id(properties['Description']) in dynamic - replicating
+        assert id(path) in replicating
+        assert id(properties) in replicating
+        assert sites == 1
+
+    @pytest.mark.parametrize('variables', VARIABLES)
+    def test_traverse(self, variables):
+        """
+        Test that the iterative engine replicates like the recursive traverse, with and without
+        the analysis of the base resource.
+        """
+        original = copy.deepcopy(BASE)
+        expected = Substitutor('Base', BASE).traverse(variables, BASE)
+
+        assert traverse(variables, BASE) == expected
+        assert traverse(variables, BASE, analyse(BASE)) == expected
+        assert BASE == original
+
+    @pytest.mark.parametrize('variables', VARIABLES)
+    def test_traverse_fold(self, variables):
+        """
+        Test that the iterative engine folds Fn::Sub functions like a ReplicationPlan.
+        """
+        plan = ReplicationPlan(BASE)
+
+        assert traverse(variables, BASE, fold=True) == plan.build(plan.resolve(variables))
+
+    def test_traverse_shares_static_subtrees(self):
+        result = traverse({'service': 'states'}, BASE, analyse(BASE))
+
+        assert result['Properties']['Tags'][1] is BASE['Properties']['Tags'][1]
+        assert result['Properties']['Tags'][0] is not BASE['Properties']['Tags'][0]
+
+    def test_traverse_deep(self):
+        """
+        Test that trees deeper than the recursion limit are replicated.
+        """
+        deep = leaf = {}
+
+        for _ in range(5000):
+            leaf['Nested'] = [{}]
+            leaf = leaf['Nested'][0]
+
+        leaf['Fn::Sub'] = '${repl_service}'
+        result = traverse({'service': 'states'}, deep, fold=True)
+
+        for _ in range(5000):
+            result = result['Nested'][0]
+
+        assert result == 'states'
+
+        with pytest.raises(RecursionError):
+            Substitutor('Base', deep).traverse({'service': 'states'}, deep)
+
+    def test_build(self):
+        """
+        Test that the iterative engine builds replicates from the substitutions and defaults.
+        """
+        substitutions = {'service': 'ecs'}
+        defaults = {'service': 'states', 'description': 'default'}
+        iterative = Substitutor('Base', BASE, defaults, engine='iterative')
+        plan = Substitutor('Base', BASE, defaults)
+
+        assert iterative.build(substitutions) == plan.build(substitutions)
+
+    def test_lambda_handler_deep(self):
+        """
+        Test that the handler replicates a resource deeper than the recursion limit with the
+        iterative engine, the limits included.
+        """
+        deep = leaf = {}
+
+        for _ in range(1500):
+            leaf['Nested'] = [{}]
+            leaf = leaf['Nested'][0]
+
+        leaf['Name'] = {'Fn::Sub': '${repl_name}'}
+        response = lambda_handler({
+            'requestId': 'deep',
+            'fragment': {
+                'Resources': {
+                    'Policy': {
+                        'Type': 'AWS::IAM::Policy',
+                        'Replicates': {
+                            'Elements': {'one': {'name': 'one'}},
+                            'Engine': 'iterative'
+                        },
+                        'Properties': {'PolicyDocument': deep}
+                    }
+                }
+            }
+        }, None)
+        result = response['fragment']['Resources']['PolicyOne']['Properties']['PolicyDocument']
+
+        for _ in range(1500):
+            result = result['Nested'][0]
+
+        assert result == {'Name': 'one'}